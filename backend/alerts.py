@@ -0,0 +1,375 @@
+"""
+Alertas de qualidade do ar avaliados na ingestão.
+
+Uma regra diz: campo (aqi, pm25, ...) comparado a um limite, mantido por
+`duration_minutes`, em todas as cidades ou numa lista delas. Ex: AQI > 150 por
+2 horas. Cada (regra, cidade) passa por:
+
+  ok -> pending (condição verdadeira) -> firing (verdadeira por toda a duração)
+  firing -> ok quando o valor cruza `clear_threshold` (histerese)
+
+Só as transições para firing/resolved geram eventos, então um alerta ativo não
+é reenviado a cada leitura (deduplicação).
+
+Avaliação incremental: as regras globais ficam ordenadas por limite para cada
+(campo, operador). Uma leitura só visita as regras cuja condição ficou
+verdadeira (busca binária) e as que já estão pending/firing naquela cidade;
+regras em estado ok com condição falsa não custam nada.
+
+Os eventos vão para um registro JSONL (fila local) e, se ALERT_WEBHOOK_URL
+estiver definido, são enviados em lote ao fim de cada coleta.
+
+Com vários workers, cada processo tem seu motor: as regras criadas/removidas
+pela API vão para o arquivo de regras, e os outros processos (inclusive o
+coletor) o releem quando ele muda, antes de avaliar a próxima leitura.
+"""
+
+import bisect
+import json
+import math
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import httpx
+
+from city_registry import normalize_city_key
+from history_index import parse_timestamp
+
+ALERT_FIELDS = ["aqi", "pm25", "temperature", "humidity"]
+ALERT_OPERATORS = [">", ">=", "<", "<="]
+
+DEFAULT_ALERT_RULES = [
+  {"id": "aqi-insalubre-2h", "name": "AQI insalubre por 2 horas", "field": "aqi", "op": ">",
+   "threshold": 150, "clear_threshold": 130, "duration_minutes": 120, "cities": None},
+  {"id": "aqi-sensiveis-1h", "name": "AQI insalubre para grupos sensíveis por 1 hora", "field": "aqi", "op": ">",
+   "threshold": 100, "clear_threshold": 90, "duration_minutes": 60, "cities": None},
+]
+
+_COMPARE = {
+  ">": lambda v, t: v > t,
+  ">=": lambda v, t: v >= t,
+  "<": lambda v, t: v < t,
+  "<=": lambda v, t: v <= t,
+}
+
+
+def alerts_path_for(csv_path: Path) -> Path:
+  """Registro de eventos de alerta ao lado do CSV (ex: dados_qualidade_ar.alertas.jsonl)"""
+  csv_path = Path(csv_path)
+  return csv_path.with_name(f"{csv_path.stem}.alertas.jsonl")
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    number = float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+  return number if number is not None and math.isfinite(number) else None
+
+
+def validate_rule(rule: dict) -> dict:
+  """Normaliza uma regra; ValueError se for inválida"""
+  if rule.get("field") not in ALERT_FIELDS:
+    raise ValueError(f"Campo inválido: '{rule.get('field')}' (use {', '.join(ALERT_FIELDS)})")
+  if rule.get("op") not in ALERT_OPERATORS:
+    raise ValueError(f"Operador inválido: '{rule.get('op')}' (use {', '.join(ALERT_OPERATORS)})")
+  threshold = float(rule["threshold"])
+  clear = float(rule["clear_threshold"]) if rule.get("clear_threshold") is not None else threshold
+  if (rule["op"] in (">", ">=") and clear > threshold) or (rule["op"] in ("<", "<=") and clear < threshold):
+    raise ValueError("clear_threshold deve ficar do lado 'normal' do limite (histerese)")
+  cities = rule.get("cities")
+  return {
+    "id": str(rule.get("id") or uuid.uuid4().hex[:12]),
+    "name": rule.get("name") or f"{rule['field']} {rule['op']} {threshold:g}",
+    "field": rule["field"],
+    "op": rule["op"],
+    "threshold": threshold,
+    "clear_threshold": clear,
+    "duration_minutes": float(rule.get("duration_minutes") or 0),
+    "cities": sorted({normalize_city_key(c) for c in cities}) if cities else None,
+  }
+
+
+class _RuleState:
+  __slots__ = ("status", "pending_since", "fired_at", "value", "timestamp")
+
+  def __init__(self):
+    self.status = "ok"
+    self.pending_since: Optional[float] = None
+    self.fired_at: Optional[str] = None
+    self.value: Optional[float] = None
+    self.timestamp: Optional[str] = None
+
+
+class AlertEngine:
+  """Regras registradas uma vez; cada leitura atualiza só as regras relevantes"""
+
+  def __init__(self, rules: Iterable[dict] = (), get_log_path: Optional[Callable[[], Path]] = None,
+               webhook_url: Optional[str] = None, queue_size: int = 10000, rules_path: Optional[Path] = None):
+    self._lock = threading.RLock()
+    self.rules_path = Path(rules_path) if rules_path is not None else None
+    self._rules_signature: Optional[tuple] = ()  # () = arquivo ainda não lido
+    self.get_log_path = get_log_path
+    self.webhook_url = webhook_url
+    self.rules: Dict[str, dict] = {}
+    self._global: Dict[Tuple[str, str], Tuple[List[float], List[str]]] = {}
+    self._by_city: Dict[str, List[str]] = {}
+    self._states: Dict[Tuple[str, str], _RuleState] = {}
+    self._active: Dict[str, Set[str]] = {}  # cidade -> regras pending/firing
+    self._last_epoch: Dict[str, float] = {}
+    self.outbox: deque = deque(maxlen=queue_size)  # eventos aguardando o webhook
+    self.delivered = 0
+    self.delivery_failures = 0
+    for rule in rules:
+      self.add_rule(rule, rebuild=False)
+    self._rebuild_index()
+    self.reload_rules_if_changed()
+
+  # --- Regras ---
+
+  def _rules_file_signature(self) -> Optional[tuple]:
+    try:
+      stat = self.rules_path.stat()
+    except FileNotFoundError:
+      return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+  def reload_rules_if_changed(self) -> bool:
+    """Relê o arquivo de regras se ele mudou (ex: regra criada em outro worker)"""
+    if self.rules_path is None:
+      return False
+    signature = self._rules_file_signature()
+    with self._lock:
+      if signature == self._rules_signature:
+        return False
+      try:
+        self.replace_rules(load_rules(self.rules_path))
+      except (ValueError, KeyError, TypeError) as e:
+        print(f"⚠️  Regras de alerta inválidas em {self.rules_path}: {e}")
+      self._rules_signature = signature
+    return True
+
+  def replace_rules(self, rules: Iterable[dict]) -> None:
+    """Troca o conjunto de regras; as que não mudaram mantêm o estado (pending/firing)"""
+    validated = {rule["id"]: rule for rule in map(validate_rule, rules)}
+    with self._lock:
+      for rule_id in [i for i, rule in self.rules.items() if validated.get(i) != rule]:
+        self.remove_rule(rule_id, rebuild=False)
+      for rule_id, rule in validated.items():
+        self.rules.setdefault(rule_id, rule)
+      self._rebuild_index()
+
+  def save_rules(self) -> None:
+    """Grava as regras no arquivo (a própria gravação não provoca releitura)"""
+    with self._lock:
+      save_rules(self.rules_path, self.rules.values())
+      self._rules_signature = self._rules_file_signature()
+
+  def _rebuild_index(self) -> None:
+    global_index: Dict[Tuple[str, str], List[Tuple[float, str]]] = {}
+    by_city: Dict[str, List[str]] = {}
+    for rule in self.rules.values():
+      if rule["cities"]:
+        for city in rule["cities"]:
+          by_city.setdefault(city, []).append(rule["id"])
+      else:
+        global_index.setdefault((rule["field"], rule["op"]), []).append((rule["threshold"], rule["id"]))
+    # (campo, operador) -> (limites em ordem crescente, ids na mesma ordem)
+    self._global = {
+      key: ([t for t, _ in sorted(entries)], [rule_id for _, rule_id in sorted(entries)])
+      for key, entries in global_index.items()
+    }
+    self._by_city = by_city
+
+  def add_rule(self, rule: dict, rebuild: bool = True) -> dict:
+    rule = validate_rule(rule)
+    with self._lock:
+      self.remove_rule(rule["id"], rebuild=False)
+      self.rules[rule["id"]] = rule
+      if rebuild:
+        self._rebuild_index()
+    return rule
+
+  def remove_rule(self, rule_id: str, rebuild: bool = True) -> bool:
+    with self._lock:
+      if self.rules.pop(rule_id, None) is None:
+        return False
+      for key in [k for k in self._states if k[0] == rule_id]:
+        del self._states[key]
+      for active in self._active.values():
+        active.discard(rule_id)
+      if rebuild:
+        self._rebuild_index()
+      return True
+
+  def _triggered_global(self, field: str, value: float) -> Iterable[str]:
+    """Regras globais do campo cuja condição é verdadeira para o valor (busca binária)"""
+    for op in ALERT_OPERATORS:
+      entry = self._global.get((field, op))
+      if not entry:
+        continue
+      thresholds, rule_ids = entry
+      if op == ">":
+        yield from rule_ids[:bisect.bisect_left(thresholds, value)]
+      elif op == ">=":
+        yield from rule_ids[:bisect.bisect_right(thresholds, value)]
+      elif op == "<":
+        yield from rule_ids[bisect.bisect_right(thresholds, value):]
+      else:
+        yield from rule_ids[bisect.bisect_left(thresholds, value):]
+
+  # --- Avaliação ---
+
+  def ingest(self, row: dict) -> List[dict]:
+    """Avalia uma leitura; retorna os eventos gerados (firing/resolved)"""
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      return []
+    city = normalize_city_key(row.get("city"))
+    self.reload_rules_if_changed()
+
+    events = []
+    with self._lock:
+      if epoch <= self._last_epoch.get(city, float("-inf")):
+        return []  # leitura repetida ou atrasada
+      self._last_epoch[city] = epoch
+
+      values = {field: _to_float(row.get(field)) for field in ALERT_FIELDS}
+      candidates = set(self._active.get(city, ()))
+      candidates.update(self._by_city.get(city, ()))
+      for field, value in values.items():
+        if value is not None:
+          candidates.update(self._triggered_global(field, value))
+
+      for rule_id in candidates:
+        rule = self.rules.get(rule_id)
+        value = values.get(rule["field"]) if rule else None
+        if value is None:
+          continue
+        event = self._evaluate(rule, city, value, epoch, row)
+        if event:
+          events.append(event)
+
+    self._deliver(events)
+    return events
+
+  def _evaluate(self, rule: dict, city: str, value: float, epoch: float, row: dict) -> Optional[dict]:
+    key = (rule["id"], city)
+    state = self._states.get(key)
+    if state is None:
+      state = self._states[key] = _RuleState()
+    compare = _COMPARE[rule["op"]]
+    triggered = compare(value, rule["threshold"])
+    state.value, state.timestamp = value, row.get("timestamp")
+
+    event = None
+    if state.status == "firing":
+      if not compare(value, rule["clear_threshold"]):
+        event = self._event("resolved", rule, row, value, state)
+        state.status, state.pending_since, state.fired_at = "ok", None, None
+    elif triggered:
+      if state.status == "ok":
+        state.status, state.pending_since = "pending", epoch
+      if epoch - state.pending_since >= rule["duration_minutes"] * 60:
+        state.status = "firing"
+        state.fired_at = row.get("timestamp")
+        event = self._event("firing", rule, row, value, state)
+    else:
+      state.status, state.pending_since = "ok", None
+
+    active = self._active.setdefault(city, set())
+    if state.status == "ok":
+      active.discard(rule["id"])
+      del self._states[key]
+    else:
+      active.add(rule["id"])
+    return event
+
+  def _event(self, kind: str, rule: dict, row: dict, value: float, state: _RuleState) -> dict:
+    return {
+      "event": kind,
+      "rule_id": rule["id"],
+      "rule": rule["name"],
+      "city": row.get("city"),
+      "state": row.get("state"),
+      "country": row.get("country"),
+      "field": rule["field"],
+      "value": value,
+      "threshold": rule["threshold"],
+      "timestamp": row.get("timestamp"),
+      "fired_at": state.fired_at,
+      "emitted_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+  # --- Entrega ---
+
+  def _deliver(self, events: List[dict]) -> None:
+    if not events:
+      return
+    if self.get_log_path is not None:
+      with open(self.get_log_path(), "a", encoding="utf-8") as f:
+        for event in events:
+          f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    if self.webhook_url:
+      self.outbox.extend(events)
+    for event in events:
+      icon = "🚨" if event["event"] == "firing" else "✅"
+      print(f"{icon} Alerta {event['event']}: {event['rule']} em {event['city']} ({event['field']}={event['value']:g})")
+
+  async def flush_webhook(self, client: httpx.AsyncClient, batch_size: int = 500) -> int:
+    """Envia os eventos pendentes ao webhook em lotes; mantém na fila se falhar"""
+    sent = 0
+    while self.webhook_url and self.outbox:
+      batch = [self.outbox[i] for i in range(min(batch_size, len(self.outbox)))]
+      try:
+        response = await client.post(self.webhook_url, json={"events": batch})
+        response.raise_for_status()
+      except httpx.HTTPError as e:
+        self.delivery_failures += 1
+        print(f"⚠️  Falha ao entregar {len(batch)} alertas ao webhook: {e}")
+        break
+      for _ in batch:
+        self.outbox.popleft()
+      sent += len(batch)
+    self.delivered += sent
+    return sent
+
+  # --- Consulta ---
+
+  def active_alerts(self, city: Optional[str] = None, include_pending: bool = False) -> List[dict]:
+    city_key = normalize_city_key(city) if city else None
+    result = []
+    with self._lock:
+      for (rule_id, state_city), state in self._states.items():
+        if city_key and state_city != city_key:
+          continue
+        if state.status != "firing" and not include_pending:
+          continue
+        rule = self.rules[rule_id]
+        result.append({
+          "rule_id": rule_id, "rule": rule["name"], "city": state_city, "status": state.status,
+          "field": rule["field"], "value": state.value, "threshold": rule["threshold"],
+          "since": state.fired_at if state.status == "firing" else
+          datetime.fromtimestamp(state.pending_since, tz=timezone.utc).isoformat(),
+          "last_timestamp": state.timestamp,
+        })
+    return result
+
+
+def load_rules(path: Path) -> List[dict]:
+  """Regras do arquivo JSON (ou as padrão, se o arquivo não existir)"""
+  if path.exists():
+    return json.loads(path.read_text(encoding="utf-8"))
+  return [dict(rule) for rule in DEFAULT_ALERT_RULES]
+
+
+def save_rules(path: Path, rules: Iterable[dict]) -> None:
+  tmp = path.with_suffix(path.suffix + ".tmp")
+  tmp.write_text(json.dumps(list(rules), ensure_ascii=False, indent=2), encoding="utf-8")
+  os.replace(tmp, path)
@@ -0,0 +1,260 @@
+"""
+Detecção de anomalias na ingestão (antes de gravar no CSV).
+
+Para cada cidade e campo numérico mantém estatísticas móveis atualizadas em
+O(1)/O(janela) por leitura, sem reler o histórico:
+- EWMA (média e variância exponenciais)
+- mediana e MAD (desvio absoluto mediano) das últimas `window` leituras
+- contagem de leituras consecutivas com o mesmo valor
+
+Tipos de anomalia:
+- missing: campo vazio ("") ou não numérico
+- out_of_range: valor fisicamente impossível (ex: umidade > 100%)
+- spike: z robusto (|x - mediana| / 1,4826·MAD) acima do limite, com desvio
+  mínimo em relação à mediana e à EWMA
+- stuck: o mesmo valor em leituras distintas por `stuck_hours` horas
+
+Leituras repetidas (mesmo timestamp da anterior, comum porque a IQAir atualiza
+de hora em hora e a coleta é a cada 5 min) não alteram as estatísticas.
+
+Com ANOMALY_MODE=quarantine, leituras com spike/out_of_range não vão para o
+CSV; ficam só no registro de anomalias (JSONL ao lado do CSV).
+"""
+
+import bisect
+import json
+import math
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from city_registry import normalize_city_key
+from history_index import parse_timestamp
+
+ANOMALY_MODES = ("flag", "quarantine", "off")
+QUARANTINE_KINDS = {"spike", "out_of_range"}
+
+# campo -> (mínimo, máximo, desvio mínimo para spike, verifica valor travado)
+FIELD_RULES = {
+  "aqi": (0.0, 1000.0, 40.0, True),
+  "pm25": (0.0, 1000.0, 40.0, True),
+  "temperature": (-60.0, 60.0, 10.0, False),
+  "humidity": (0.0, 100.0, 30.0, False),
+}
+
+
+def anomalies_path_for(csv_path: Path) -> Path:
+  """Registro de anomalias ao lado do CSV (ex: dados_qualidade_ar.anomalias.jsonl)"""
+  csv_path = Path(csv_path)
+  return csv_path.with_name(f"{csv_path.stem}.anomalias.jsonl")
+
+
+class RollingStats:
+  """Estatísticas móveis de um campo de uma cidade"""
+
+  __slots__ = ("window", "values", "sorted_values", "ewma", "ewmvar", "alpha", "last_value", "stuck_since", "count")
+
+  def __init__(self, window: int = 24, alpha: float = 0.2):
+    self.window = window
+    self.values: deque = deque()
+    self.sorted_values: List[float] = []
+    self.ewma: Optional[float] = None
+    self.ewmvar = 0.0
+    self.alpha = alpha
+    self.last_value: Optional[float] = None
+    self.stuck_since: Optional[float] = None
+    self.count = 0
+
+  def median(self) -> Optional[float]:
+    n = len(self.sorted_values)
+    if not n:
+      return None
+    mid = n // 2
+    return self.sorted_values[mid] if n % 2 else (self.sorted_values[mid - 1] + self.sorted_values[mid]) / 2
+
+  def mad(self, median: float) -> float:
+    deviations = sorted(abs(v - median) for v in self.sorted_values)
+    n = len(deviations)
+    mid = n // 2
+    return deviations[mid] if n % 2 else (deviations[mid - 1] + deviations[mid]) / 2
+
+  def push(self, value: float, epoch: float) -> None:
+    self.values.append(value)
+    bisect.insort(self.sorted_values, value)
+    if len(self.values) > self.window:
+      old = self.values.popleft()
+      del self.sorted_values[bisect.bisect_left(self.sorted_values, old)]
+
+    if self.ewma is None:
+      self.ewma = value
+    else:
+      delta = value - self.ewma
+      self.ewma += self.alpha * delta
+      self.ewmvar = (1 - self.alpha) * (self.ewmvar + self.alpha * delta * delta)
+
+    if value != self.last_value:
+      self.stuck_since = epoch
+    self.last_value = value
+    self.count += 1
+
+
+class AnomalyDetector:
+  """Verifica cada leitura contra as estatísticas da cidade e registra as anomalias"""
+
+  def __init__(self, window: int = 24, z_threshold: float = 6.0, min_samples: int = 8,
+               stuck_hours: float = 12.0, mode: str = "flag",
+               seed_rows: Optional[Callable[[str], Iterable[dict]]] = None):
+    if mode not in ANOMALY_MODES:
+      raise ValueError(f"ANOMALY_MODE inválido: '{mode}' (use {', '.join(ANOMALY_MODES)})")
+    self.window = window
+    self.z_threshold = z_threshold
+    self.min_samples = min_samples
+    self.stuck_seconds = stuck_hours * 3600
+    self.mode = mode
+    self.seed_rows = seed_rows
+    self._lock = threading.Lock()
+    self._stats: Dict[str, Dict[str, RollingStats]] = {}
+    self._last_epoch: Dict[str, float] = {}
+    self.counts: Dict[str, int] = {}
+
+  def _city_stats(self, key: str) -> Dict[str, RollingStats]:
+    stats = self._stats.get(key)
+    if stats is None:
+      stats = self._stats[key] = {name: RollingStats(self.window) for name in FIELD_RULES}
+      # Aquece com as últimas leituras da cidade (limitadas à janela), uma única vez
+      if self.seed_rows is not None:
+        for row in self.seed_rows(key):
+          self._observe(key, row, stats)
+    return stats
+
+  def _observe(self, key: str, row: dict, stats: Dict[str, RollingStats]) -> None:
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      return
+    if epoch <= self._last_epoch.get(key, float("-inf")):
+      return
+    self._last_epoch[key] = epoch
+    for name, (low, high, _, _) in FIELD_RULES.items():
+      value = _to_float(row.get(name))
+      if value is not None and low <= value <= high:
+        stats[name].push(value, epoch)
+
+  def check(self, row: dict) -> List[dict]:
+    """Retorna as anomalias da leitura (lista vazia se normal) e atualiza as estatísticas"""
+    if self.mode == "off":
+      return []
+    key = normalize_city_key(row.get("city"))
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      return [{"kind": "missing", "field": "timestamp", "value": row.get("timestamp")}]
+
+    with self._lock:
+      stats = self._city_stats(key)
+      if epoch <= self._last_epoch.get(key, float("-inf")):
+        return []  # leitura repetida ou atrasada: já avaliada
+
+      found = []
+      for name, (low, high, min_delta, check_stuck) in FIELD_RULES.items():
+        raw = row.get(name)
+        value = _to_float(raw)
+        field = stats[name]
+        if value is None:
+          found.append({"kind": "missing", "field": name, "value": raw})
+          continue
+        if not low <= value <= high:
+          found.append({"kind": "out_of_range", "field": name, "value": value})
+          continue
+
+        median = field.median()
+        if median is not None and field.count >= self.min_samples:
+          mad = field.mad(median)
+          deviation = abs(value - median)
+          robust_z = deviation / (1.4826 * mad) if mad > 0 else math.inf
+          if robust_z > self.z_threshold and deviation >= min_delta and abs(value - field.ewma) >= min_delta:
+            found.append({
+              "kind": "spike", "field": name, "value": value,
+              "median": median, "mad": round(mad, 2), "ewma": round(field.ewma, 2),
+              "robust_z": None if math.isinf(robust_z) else round(robust_z, 1)
+            })
+
+        if (check_stuck and value == field.last_value and field.stuck_since is not None
+            and epoch - field.stuck_since >= self.stuck_seconds):
+          found.append({"kind": "stuck", "field": name, "value": value,
+                        "since": datetime.fromtimestamp(field.stuck_since, tz=timezone.utc).isoformat()})
+
+      # Valores em quarentena não entram nas estatísticas (não contaminam a mediana)
+      if not (self.mode == "quarantine" and self.should_quarantine(found)):
+        self._observe(key, row, stats)
+      for anomaly in found:
+        self.counts[anomaly["kind"]] = self.counts.get(anomaly["kind"], 0) + 1
+      return found
+
+  def should_quarantine(self, anomalies: List[dict]) -> bool:
+    return self.mode == "quarantine" and any(a["kind"] in QUARANTINE_KINDS for a in anomalies)
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    number = float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+  return number if number is not None and math.isfinite(number) else None
+
+
+def record_anomalies(path: Path, row: dict, anomalies: List[dict], quarantined: bool) -> None:
+  """Acrescenta uma linha ao registro de anomalias (JSONL)"""
+  entry = {
+    "detected_at": datetime.now(timezone.utc).isoformat(),
+    "timestamp": row.get("timestamp"),
+    "city": row.get("city"),
+    "state": row.get("state"),
+    "quarantined": quarantined,
+    "anomalies": anomalies,
+    "row": row,
+  }
+  with open(path, "a", encoding="utf-8") as f:
+    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+
+
+def tail_jsonl(path: Path, max_bytes: int = 1 << 20) -> List[dict]:
+  """Entradas de um registro JSONL, mais recentes primeiro, lendo só o final do arquivo"""
+  if not path.exists():
+    return []
+  with open(path, "rb") as f:
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(max(0, size - max_bytes))
+    chunk = f.read()
+  lines = chunk.split(b"\n")
+  if size > max_bytes:
+    lines = lines[1:]  # primeira linha pode estar cortada
+
+  entries = []
+  for line in reversed(lines):
+    if not line.strip():
+      continue
+    try:
+      entries.append(json.loads(line))
+    except ValueError:
+      continue
+  return entries
+
+
+def read_anomalies(path: Path, city: Optional[str] = None, kind: Optional[str] = None,
+                   limit: int = 100, max_bytes: int = 1 << 20) -> List[dict]:
+  """Anomalias mais recentes primeiro, lendo só o final do registro"""
+  city_key = normalize_city_key(city) if city else None
+  result = []
+  for entry in tail_jsonl(path, max_bytes):
+    if city_key and normalize_city_key(entry.get("city")) != city_key:
+      continue
+    if kind and not any(a.get("kind") == kind for a in entry.get("anomalies", [])):
+      continue
+    result.append(entry)
+    if len(result) >= limit:
+      break
+  return result
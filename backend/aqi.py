@@ -0,0 +1,183 @@
+"""
+Cálculo vetorizado (NumPy) de índices de qualidade do ar.
+
+Converte concentrações de poluentes (como retornadas pelo OpenWeatherMap, em
+µg/m³) em:
+- AQI US (EPA, tabela de 2024)
+- IQAr brasileiro (Resolução CONAMA 491/2018, Guia Técnico do MMA)
+
+O lookup das faixas usa `np.searchsorted` sobre a série inteira, sem loop por
+ponto. As concentrações horárias são usadas diretamente (sem as médias móveis
+de 8h/24h das normas), então o resultado é um índice "instantâneo".
+"""
+
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+POLLUTANTS = ["pm25", "pm10", "o3", "no2", "so2", "co"]
+
+# Massa molar (g/mol) para converter µg/m³ -> ppb a 25 °C (volume molar 24,45 L)
+MOLAR_MASS = {"o3": 48.00, "no2": 46.01, "so2": 64.07, "co": 28.01}
+
+# --- EPA (AQI US) ---
+# (concentração baixa, concentração alta) por faixa, nas unidades da EPA
+EPA_INDEX_BREAKPOINTS = [(0, 50), (51, 100), (101, 150), (151, 200), (201, 300), (301, 500)]
+EPA_BREAKPOINTS = {
+  "pm25": [(0.0, 9.0), (9.1, 35.4), (35.5, 55.4), (55.5, 125.4), (125.5, 225.4), (225.5, 325.4)],  # µg/m³
+  "pm10": [(0, 54), (55, 154), (155, 254), (255, 354), (355, 424), (425, 604)],                     # µg/m³
+  "o3": [(0, 54), (55, 70), (71, 85), (86, 105), (106, 200)],                                        # ppb
+  "no2": [(0, 53), (54, 100), (101, 360), (361, 649), (650, 1249), (1250, 2049)],                    # ppb
+  "so2": [(0, 35), (36, 75), (76, 185), (186, 304), (305, 604), (605, 1004)],                        # ppb
+  "co": [(0.0, 4.4), (4.5, 9.4), (9.5, 12.4), (12.5, 15.4), (15.5, 30.4), (30.5, 50.4)],             # ppm
+}
+# Casas decimais de truncamento exigidas pela EPA antes do cálculo
+EPA_TRUNCATE = {"pm25": 1, "pm10": 0, "o3": 0, "no2": 0, "so2": 0, "co": 1}
+EPA_CATEGORIES = [
+  (50, "Boa"),
+  (100, "Moderada"),
+  (150, "Insalubre para grupos sensíveis"),
+  (200, "Insalubre"),
+  (300, "Muito insalubre"),
+  (np.inf, "Perigosa"),
+]
+
+# --- CONAMA 491/2018 (IQAr) ---
+CONAMA_INDEX_BREAKPOINTS = [(0, 40), (41, 80), (81, 120), (121, 200), (201, 400)]
+CONAMA_BREAKPOINTS = {
+  "pm10": [(0, 50), (50, 100), (100, 150), (150, 250), (250, 600)],        # µg/m³
+  "pm25": [(0, 25), (25, 50), (50, 75), (75, 125), (125, 300)],            # µg/m³
+  "o3": [(0, 100), (100, 130), (130, 160), (160, 200), (200, 800)],        # µg/m³
+  "co": [(0, 9), (9, 11), (11, 13), (13, 15), (15, 50)],                   # ppm
+  "no2": [(0, 200), (200, 240), (240, 320), (320, 1130), (1130, 3750)],    # µg/m³
+  "so2": [(0, 20), (20, 40), (40, 365), (365, 800), (800, 2620)],          # µg/m³
+}
+CONAMA_CATEGORIES = [
+  (40, "Boa"),
+  (80, "Moderada"),
+  (120, "Ruim"),
+  (200, "Muito ruim"),
+  (np.inf, "Péssima"),
+]
+
+
+def _as_array(values: Sequence[Optional[float]]) -> np.ndarray:
+  """Lista com None/"" -> array float com NaN"""
+  return np.array([np.nan if v in (None, "") else float(v) for v in values], dtype=float)
+
+
+def _to_epa_units(pollutant: str, ugm3: np.ndarray) -> np.ndarray:
+  if pollutant in ("o3", "no2", "so2"):
+    return ugm3 * 24.45 / MOLAR_MASS[pollutant]
+  if pollutant == "co":
+    return ugm3 * 24.45 / MOLAR_MASS["co"] / 1000
+  return ugm3
+
+
+def _to_conama_units(pollutant: str, ugm3: np.ndarray) -> np.ndarray:
+  if pollutant == "co":
+    return ugm3 * 24.45 / MOLAR_MASS["co"] / 1000
+  return ugm3
+
+
+def _interpolate(conc: np.ndarray, breakpoints: List[tuple], index_breakpoints: List[tuple]) -> np.ndarray:
+  """Interpolação linear por faixa, vetorizada; acima da última faixa satura no topo"""
+  c_lo = np.array([b[0] for b in breakpoints], dtype=float)
+  c_hi = np.array([b[1] for b in breakpoints], dtype=float)
+  i_lo = np.array([b[0] for b in index_breakpoints[:len(breakpoints)]], dtype=float)
+  i_hi = np.array([b[1] for b in index_breakpoints[:len(breakpoints)]], dtype=float)
+
+  band = np.clip(np.searchsorted(c_hi, conc, side="left"), 0, len(c_hi) - 1)
+  clipped = np.clip(conc, c_lo[band], c_hi[band])
+  index = (i_hi[band] - i_lo[band]) / (c_hi[band] - c_lo[band]) * (clipped - c_lo[band]) + i_lo[band]
+  return np.where(np.isnan(conc), np.nan, np.round(index))
+
+
+def epa_aqi(pollutant: str, ugm3: Sequence[Optional[float]]) -> np.ndarray:
+  """Sub-índice AQI US de um poluente para uma série de concentrações em µg/m³"""
+  conc = _to_epa_units(pollutant, _as_array(ugm3))
+  factor = 10 ** EPA_TRUNCATE[pollutant]
+  conc = np.floor(conc * factor) / factor
+  return _interpolate(conc, EPA_BREAKPOINTS[pollutant], EPA_INDEX_BREAKPOINTS)
+
+
+def conama_index(pollutant: str, ugm3: Sequence[Optional[float]]) -> np.ndarray:
+  """Sub-índice IQAr (CONAMA 491/2018) de um poluente para uma série em µg/m³"""
+  conc = _to_conama_units(pollutant, _as_array(ugm3))
+  return _interpolate(conc, CONAMA_BREAKPOINTS[pollutant], CONAMA_INDEX_BREAKPOINTS)
+
+
+def categorize(index: Sequence[Optional[float]], categories: List[tuple]) -> List[Optional[str]]:
+  """Classifica uma série de índices nas categorias (None quando não há índice)"""
+  values = _as_array(index)
+  limits = np.array([limit for limit, _ in categories], dtype=float)
+  labels = [label for _, label in categories]
+  positions = np.searchsorted(limits, values, side="left")
+  return [None if np.isnan(v) else labels[p] for v, p in zip(values, positions)]
+
+
+def epa_category(aqi: Optional[float]) -> Optional[str]:
+  """Categoria de um único valor de AQI US (ex: o `aqius` da IQAir)"""
+  return categorize([aqi], EPA_CATEGORIES)[0]
+
+
+def with_aqi_category(rows: List[Dict]) -> List[Dict]:
+  """
+  Linhas do histórico com `aqi_category` (categoria EPA do AQI US). A categoria
+  é gravada na ingestão; só as linhas antigas (coluna vazia) são calculadas
+  aqui, de uma vez. Valores vazios/ilegíveis ficam sem categoria.
+  """
+  missing = [i for i, row in enumerate(rows) if not row.get("aqi_category")]
+  if not missing:
+    return rows
+  values = []
+  for i in missing:
+    try:
+      values.append(float(rows[i].get("aqi")))
+    except (TypeError, ValueError):
+      values.append(None)
+  rows = list(rows)
+  for i, category in zip(missing, categorize(values, EPA_CATEGORIES)):
+    rows[i] = {**rows[i], "aqi_category": category}
+  return rows
+
+
+def _overall(sub_indices: Dict[str, np.ndarray], length: int):
+  """Índice geral = maior sub-índice; retorna (índice, poluente dominante)"""
+  if not sub_indices:
+    return np.full(length, np.nan), [None] * length
+  names = list(sub_indices.keys())
+  matrix = np.vstack([sub_indices[name] for name in names])
+  all_nan = np.all(np.isnan(matrix), axis=0)
+  filled = np.where(np.isnan(matrix), -np.inf, matrix)
+  overall = np.where(all_nan, np.nan, filled.max(axis=0))
+  dominant_idx = filled.argmax(axis=0)
+  dominant = [None if missing else names[i] for i, missing in zip(dominant_idx, all_nan)]
+  return overall, dominant
+
+
+def enrich_pollution_series(points: List[Dict]) -> List[Dict]:
+  """
+  Acrescenta a cada ponto da série os índices AQI US e IQAr (valor, categoria
+  e poluente dominante), calculados de uma vez para a série inteira.
+  """
+  if not points:
+    return points
+
+  concentrations = {p: [point.get(p) for point in points] for p in POLLUTANTS}
+  epa = {p: epa_aqi(p, values) for p, values in concentrations.items()}
+  conama = {p: conama_index(p, values) for p, values in concentrations.items()}
+
+  aqi_us, aqi_us_dominant = _overall(epa, len(points))
+  iqar, iqar_dominant = _overall(conama, len(points))
+  aqi_us_category = categorize(aqi_us, EPA_CATEGORIES)
+  iqar_category = categorize(iqar, CONAMA_CATEGORIES)
+
+  for i, point in enumerate(points):
+    point["aqi_us"] = None if np.isnan(aqi_us[i]) else int(aqi_us[i])
+    point["aqi_us_category"] = aqi_us_category[i]
+    point["aqi_us_dominant"] = aqi_us_dominant[i]
+    point["iqar"] = None if np.isnan(iqar[i]) else int(iqar[i])
+    point["iqar_category"] = iqar_category[i]
+    point["iqar_dominant"] = iqar_dominant[i]
+  return points
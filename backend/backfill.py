@@ -0,0 +1,198 @@
+"""
+Backfill do histórico a partir do OpenWeatherMap (air_pollution/history).
+
+Carrega períodos passados para várias cidades em paralelo, dividindo o
+intervalo em blocos (chunks), gravando em lotes e registrando o progresso em um
+checkpoint para retomar de onde parou após uma interrupção.
+
+Os pontos vão para o histórico principal (dados_qualidade_ar.csv) com
+source=openweather, na grade horária, e horas que a cidade já tem nessa fonte
+não são gravadas de novo.
+
+Exemplos:
+  python backfill.py --start 2025-10-01 --end 2025-11-01
+  python backfill.py --start 2025-10-01 --end 2025-11-01 --cities "São Paulo" Fortaleza
+  python backfill.py --start 2025-10-01 --end 2025-11-01 --from-files gravacoes/
+
+Com --from-files, lê respostas gravadas (JSON do air_pollution/history) de
+`<dir>/<cidade>/*.json` em vez de chamar a API. Se o processo cair entre
+gravar um lote e atualizar o checkpoint, o lote é buscado de novo na retomada,
+mas as horas já gravadas são ignoradas.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+import main
+from city_registry import normalize_city_key
+from timeline import openweather_rows
+
+
+def split_range(start: int, end: int, chunk_seconds: int) -> List[tuple]:
+  """Divide [start, end) em blocos de no máximo chunk_seconds"""
+  chunks = []
+  cursor = start
+  while cursor < end:
+    chunks.append((cursor, min(cursor + chunk_seconds, end)))
+    cursor += chunk_seconds
+  return chunks
+
+
+class Checkpoint:
+  """Conjunto de blocos (cidade, início) já gravados, persistido em JSON"""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.done = set()
+    if path.exists():
+      self.done = {tuple(item) for item in json.loads(path.read_text(encoding='utf-8'))}
+
+  def key(self, city_info: dict, chunk_start: int) -> tuple:
+    return (normalize_city_key(city_info["city"]), normalize_city_key(city_info.get("state")), chunk_start)
+
+  def is_done(self, city_info: dict, chunk_start: int) -> bool:
+    return self.key(city_info, chunk_start) in self.done
+
+  def mark(self, keys: List[tuple]) -> None:
+    self.done.update(keys)
+    tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+    tmp.write_text(json.dumps(sorted(self.done), ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, self.path)
+
+
+def load_recorded_history(directory: Path, city_info: dict, start: int, end: int) -> Dict:
+  """Junta as respostas gravadas da cidade e filtra os pontos do bloco"""
+  city_dir = directory / normalize_city_key(city_info["city"]).replace(" ", "_")
+  points = []
+  for file in sorted(city_dir.glob("*.json")):
+    data = json.loads(file.read_text(encoding='utf-8'))
+    points.extend(item for item in data.get("list", []) if start <= item.get("dt", 0) < end)
+  return {"list": points}
+
+
+class Backfill:
+  """Executa o backfill de várias cidades em paralelo"""
+
+  def __init__(self, output: Path, checkpoint: Checkpoint, concurrency: int = 4,
+               batch_size: int = 5000, from_files: Optional[Path] = None):
+    self.output = output
+    self.checkpoint = checkpoint
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.batch_size = batch_size
+    self.from_files = from_files
+    self.buffer: List[dict] = []
+    self.buffer_keys: List[tuple] = []
+    self.rows_written = 0
+    self.chunks_failed = 0
+
+  def flush(self) -> None:
+    self.rows_written += main.save_source_rows(self.buffer, self.output)
+    self.checkpoint.mark(self.buffer_keys)
+    self.buffer, self.buffer_keys = [], []
+
+  async def fetch_chunk(self, client: httpx.AsyncClient, city_info: dict, start: int, end: int) -> List[dict]:
+    if self.from_files:
+      return main.format_pollution_history(load_recorded_history(self.from_files, city_info, start, end))
+    # O bloco é [start, end), mas o `end` da API é inclusivo: sem o -1 a hora da
+    # borda viria duplicada no bloco seguinte
+    return await main.fetch_pollution_history(client, city_info["lat"], city_info["lon"], start, end - 1)
+
+  async def run_chunk(self, client: httpx.AsyncClient, city_info: dict, start: int, end: int) -> None:
+    async with self.semaphore:
+      try:
+        points = await self.fetch_chunk(client, city_info, start, end)
+      except Exception as e:
+        self.chunks_failed += 1
+        print(f"❌ {city_info['city']} [{start}-{end}]: {e}")
+        return
+
+    self.buffer.extend(openweather_rows(city_info, points))
+    self.buffer_keys.append(self.checkpoint.key(city_info, start))
+    if len(self.buffer) >= self.batch_size:
+      self.flush()
+
+  async def resolve_coordinates(self, client: httpx.AsyncClient, cities: List[dict]) -> List[dict]:
+    """Garante lat/lon (cache do registro ou geocoding) para cada cidade"""
+    resolved = []
+    for city_info in cities:
+      if self.from_files or city_info.get("lat") is not None:
+        resolved.append(city_info)
+        continue
+      coords = await main.get_coordinates_from_city(client, city_info["city"], city_info["state"], city_info["country"])
+      if coords:
+        resolved.append({**city_info, "lat": coords["lat"], "lon": coords["lon"]})
+      else:
+        print(f"⚠️  {city_info['city']}: coordenadas não encontradas, ignorada")
+    return resolved
+
+  async def run(self, cities: List[dict], start: int, end: int, chunk_seconds: int) -> float:
+    """Executa o backfill e retorna a vazão em linhas/segundo"""
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=30.0) as client:
+      cities = await self.resolve_coordinates(client, cities)
+      tasks = [
+        self.run_chunk(client, city_info, chunk_start, chunk_end)
+        for city_info in cities
+        for chunk_start, chunk_end in split_range(start, end, chunk_seconds)
+        if not self.checkpoint.is_done(city_info, chunk_start)
+      ]
+      print(f"📦 {len(tasks)} blocos pendentes para {len(cities)} cidades")
+      await asyncio.gather(*tasks)
+    self.flush()
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    rate = self.rows_written / elapsed
+    print(f"✅ Backfill concluído: {self.rows_written} linhas em {elapsed:.1f}s ({rate:.0f} linhas/s)"
+          f"{f', {self.chunks_failed} blocos com erro' if self.chunks_failed else ''}")
+    return rate
+
+
+def parse_date(value: str) -> int:
+  parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+  if parsed.tzinfo is None:
+    parsed = parsed.replace(tzinfo=timezone.utc)
+  return int(parsed.timestamp())
+
+
+def main_cli(argv: Optional[List[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description="Backfill do histórico de poluição (OpenWeatherMap)")
+  parser.add_argument("--start", required=True, help="Início do período (ISO, ex: 2025-10-01)")
+  parser.add_argument("--end", help="Fim do período (ISO, padrão: agora)")
+  parser.add_argument("--cities", nargs="*", help="Cidades do registro (padrão: todas)")
+  parser.add_argument("--chunk-days", type=float, default=7, help="Tamanho de cada bloco em dias")
+  parser.add_argument("--concurrency", type=int, default=4, help="Requisições simultâneas")
+  parser.add_argument("--batch-size", type=int, default=5000, help="Linhas por gravação")
+  parser.add_argument("--output", type=Path, default=main.CSV_FILE, help="Histórico de saída (padrão: o principal)")
+  parser.add_argument("--checkpoint", type=Path, default=Path("backfill_checkpoint.json"))
+  parser.add_argument("--from-files", type=Path, help="Diretório com respostas gravadas (sem chamar a API)")
+  args = parser.parse_args(argv)
+
+  # Sem chave ou com READ_ONLY=1 não há como consultar a API: falha antes de
+  # começar (com --from-files as respostas já estão gravadas)
+  reason = None if args.from_files else main.settings.upstream_unavailable_reason()
+  if reason:
+    raise SystemExit(f"❌ Backfill não pode consultar o OpenWeatherMap: {reason}")
+
+  start = parse_date(args.start)
+  end = parse_date(args.end) if args.end else int(datetime.now(timezone.utc).timestamp())
+
+  cities = main.city_registry.all()
+  if args.cities:
+    cities = [c for c in (main.city_registry.get(name) for name in args.cities) if c]
+  if not cities:
+    raise SystemExit("Nenhuma cidade encontrada no registro")
+
+  backfill = Backfill(args.output, Checkpoint(args.checkpoint), args.concurrency, args.batch_size, args.from_files)
+  asyncio.run(backfill.run(cities, start, end, int(timedelta(days=args.chunk_days).total_seconds())))
+
+
+if __name__ == "__main__":
+  main_cli()
@@ -0,0 +1,107 @@
+"""
+Benchmark do ajuste dos modelos de previsão.
+
+Gera um histórico sintético (ciclo diário + ruído) para N cidades, mede o tempo
+de ajuste por cidade (serial), o tempo total para todas as cidades no pool de
+processos e o custo da atualização incremental de uma hora nova.
+
+  python bench_forecast.py --cities 1000 --days 7
+  python bench_forecast.py --cities 1000 --days 3 --interval-minutes 5 --workers 4
+"""
+
+import argparse
+import csv
+import math
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from forecast import fit_model, fit_models_from_csv
+from history_index import CsvHistoryIndex
+
+HEADERS = ["timestamp", "city", "state", "country", "pm25", "temperature", "humidity", "aqi"]
+
+
+def write_history(path: Path, cities: int, days: int, interval_minutes: int) -> float:
+  """Grava o histórico sintético em ordem de tempo (como o coletor) e retorna o fim (epoch)"""
+  end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0).timestamp()
+  start = end - days * 86400
+  step = interval_minutes * 60
+  rng = random.Random(42)
+  bases = [rng.uniform(20, 90) for _ in range(cities)]
+  with open(path, "w", newline="", encoding="utf-8") as f:
+    writer = csv.writer(f)
+    writer.writerow(HEADERS)
+    epoch = start
+    while epoch < end:
+      ts = datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat()
+      hour = (epoch % 86400) / 3600
+      for i, base in enumerate(bases):
+        aqi = max(1, round(base + 0.4 * base * math.cos((hour - 18) / 24 * 2 * math.pi) + rng.gauss(0, 4)))
+        writer.writerow([ts, f"Cidade {i:05d}", "Estado", "Brazil", aqi, "", "", aqi])
+      epoch += step
+  return end
+
+
+def run(cities: int, days: int, interval_minutes: int, workers: int) -> None:
+  with tempfile.TemporaryDirectory() as tmp:
+    path = Path(tmp) / "bench_forecast.csv"
+    started = time.perf_counter()
+    end = write_history(path, cities, days, interval_minutes)
+    index = CsvHistoryIndex(path)
+    index.refresh()
+    prepare_seconds = time.perf_counter() - started
+    offsets_by_city = {key: index.offsets_for(key) for key in index.city_keys()}
+
+    # Ajuste serial de uma amostra (tempo por cidade, inclui a leitura das linhas)
+    per_city = []
+    for key in list(offsets_by_city)[:min(50, cities)]:
+      t0 = time.perf_counter()
+      rows = list(index.read_rows_at(offsets_by_city[key]))
+      fit_model(rows, now_epoch=end)
+      per_city.append((time.perf_counter() - t0) * 1000)
+    per_city.sort()
+
+    # Todas as cidades no pool, em lotes
+    keys = list(offsets_by_city)
+    batch = max(1, math.ceil(len(keys) / (workers * 4)))
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      futures = [
+        pool.submit(fit_models_from_csv, str(path), index.fieldnames,
+                    {k: offsets_by_city[k] for k in keys[i:i + batch]}, "aqi", end)
+        for i in range(0, len(keys), batch)
+      ]
+      models = {}
+      for future in futures:
+        models.update(future.result())
+    total_seconds = time.perf_counter() - t0
+
+    # Atualização incremental: uma hora nova por cidade
+    t0 = time.perf_counter()
+    for i, model in enumerate(models.values()):
+      model.add_rows([(10 ** 12 + i, {"timestamp": datetime.fromtimestamp(end + 60, tz=timezone.utc).isoformat(), "aqi": "50"})])
+      model.close_pending(end + 3600)
+      model.forecast(6)
+    incremental_us = (time.perf_counter() - t0) / len(models) * 1e6
+
+  rows = index.total_rows
+  print(f"\n📦 Histórico: {cities} cidades x {days} dias a cada {interval_minutes} min = {rows} linhas ({prepare_seconds:.1f}s)")
+  print(f"⏱️  Ajuste por cidade (serial): p50 {statistics.median(per_city):.2f} ms, "
+        f"p95 {per_city[int(len(per_city) * 0.95) - 1]:.2f} ms")
+  print(f"🚀 Todas as cidades ({workers} processos): {total_seconds:.2f}s ({len(models) / total_seconds:.0f} cidades/s)")
+  print(f"🔁 Atualização incremental + previsão 6h: {incremental_us:.0f} µs por cidade")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark do ajuste dos modelos de previsão")
+  parser.add_argument("--cities", type=int, default=1000)
+  parser.add_argument("--days", type=int, default=7)
+  parser.add_argument("--interval-minutes", type=int, default=60)
+  parser.add_argument("--workers", type=int, default=2)
+  args = parser.parse_args()
+  run(args.cities, args.days, args.interval_minutes, args.workers)
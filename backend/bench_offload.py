@@ -0,0 +1,135 @@
+"""
+Benchmark da latência do event loop durante consultas grandes ao histórico.
+
+Gera um CSV sintético, dispara consultas grandes (/history/all) em paralelo com
+requisições pequenas (/latest/{cidade}) e mede, ao mesmo tempo, o atraso do
+event loop (quanto um `sleep` de 5 ms demora a mais para acordar). Roda duas
+vezes: com a leitura direto no handler (como antes) e com o pool em lotes.
+
+  python bench_offload.py --cities 500 --readings 400 --big-queries 4
+"""
+
+import argparse
+import asyncio
+import csv
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+import main
+from history_index import get_history_index
+from latest_readings import get_latest_readings
+from reports import get_report_pool, shutdown_report_pool
+from settings import Settings
+
+TICK_SECONDS = 0.005
+
+
+def write_history(path: Path, cities: int, readings: int) -> None:
+  """Leituras a cada 5 min nas últimas horas, em ordem de tempo (como o coletor)"""
+  now = datetime.now(timezone.utc)
+  rng = random.Random(42)
+  with open(path, "w", newline="", encoding="utf-8") as f:
+    writer = csv.writer(f)
+    writer.writerow(main.CSV_HEADERS)
+    for step in range(readings, 0, -1):
+      ts = (now - timedelta(minutes=5 * step)).isoformat()
+      for i in range(cities):
+        aqi = rng.randint(10, 160)
+        writer.writerow([ts, f"Cidade {i:04d}", "Estado", "Brazil", aqi, round(rng.uniform(15, 35), 1), rng.randint(30, 90), aqi])
+
+
+def percentile(values, q: float) -> float:
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_mode(cities: int, big_queries: int, small_requests: int, hours: int) -> dict:
+  lags = []
+  running = True
+
+  async def ticker():
+    while running:
+      started = time.perf_counter()
+      await asyncio.sleep(TICK_SECONDS)
+      lags.append((time.perf_counter() - started - TICK_SECONDS) * 1000)
+
+  transport = httpx.ASGITransport(app=main.app)
+  async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+    async def big():
+      started = time.perf_counter()
+      response = await client.get(f"/history/all?hours={hours}")
+      assert response.status_code == 200, response.text[:200]
+      return time.perf_counter() - started, len(response.content)
+
+    async def small(i: int):
+      started = time.perf_counter()
+      response = await client.get(f"/latest/Cidade {i % cities:04d}")
+      assert response.status_code == 200
+      return (time.perf_counter() - started) * 1000
+
+    async def smalls():
+      latencies = []
+      for i in range(small_requests):
+        latencies.append(await small(i))
+        await asyncio.sleep(0.002)
+      return latencies
+
+    tick_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(big() for _ in range(big_queries)), smalls())
+    wall = time.perf_counter() - started
+    running = False
+    await tick_task
+
+  big_results, small_latencies = results[:-1], results[-1]
+  return {
+    "wall": wall,
+    "big_mean": statistics.mean(t for t, _ in big_results),
+    "bytes": big_results[0][1],
+    "lag_p50": statistics.median(lags),
+    "lag_p99": percentile(lags, 0.99),
+    "lag_max": max(lags),
+    "small_p50": statistics.median(small_latencies),
+    "small_p99": percentile(small_latencies, 0.99),
+  }
+
+
+def run(cities: int, readings: int, big_queries: int, small_requests: int) -> None:
+  with tempfile.TemporaryDirectory() as tmp:
+    path = Path(tmp) / "bench_offload.csv"
+    write_history(path, cities, readings)
+    main.CSV_FILE = path
+    main.settings = Settings(read_only="1")
+    index = get_history_index(path)
+    get_latest_readings(path).sync(index)
+    get_report_pool()  # processos já iniciados antes da medição
+    hours = readings * 5 // 60 + 1
+    print(f"\n📦 {index.total_rows} linhas, {cities} cidades, {big_queries} consultas de {hours}h em paralelo")
+
+    offloader = main.query_offloader
+    defaults = (offloader.inline_rows, offloader.max_pending)
+    for label, inline_rows in [("Direto no handler", 10 ** 12), ("Pool em lotes", defaults[0])]:
+      offloader.inline_rows, offloader.max_pending = inline_rows, max(defaults[1], big_queries)
+      result = asyncio.run(run_mode(cities, big_queries, small_requests, hours))
+      print(f"\n{label}:")
+      print(f"  ⏱️  consulta grande: {result['big_mean']:.2f}s em média ({result['bytes'] / 1e6:.1f} MB), total {result['wall']:.2f}s")
+      print(f"  🔁 atraso do event loop: p50 {result['lag_p50']:.1f} ms, p99 {result['lag_p99']:.1f} ms, máx {result['lag_max']:.1f} ms")
+      print(f"  ⚡ /latest durante as consultas: p50 {result['small_p50']:.1f} ms, p99 {result['small_p99']:.1f} ms")
+    offloader.inline_rows, offloader.max_pending = defaults
+  shutdown_report_pool()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Latência do event loop durante consultas grandes ao histórico")
+  parser.add_argument("--cities", type=int, default=500)
+  parser.add_argument("--readings", type=int, default=400)
+  parser.add_argument("--big-queries", type=int, default=4)
+  parser.add_argument("--small-requests", type=int, default=200)
+  args = parser.parse_args()
+  run(args.cities, args.readings, args.big_queries, args.small_requests)
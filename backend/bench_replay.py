@@ -0,0 +1,84 @@
+"""
+Benchmark offline do coletor e dos endpoints usando o ReplayTransport.
+
+Não faz chamadas de rede: as respostas vêm das gravações em --fixtures e/ou do
+gerador sintético, com latência configurável. Use para comparar versões.
+
+  python bench_replay.py --cities 2000 --latency-ms 20
+  python bench_replay.py --cities 500 --fixtures fixtures/ --requests 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+# O benchmark não precisa de chaves reais
+os.environ.setdefault("IQAIR_API_KEY", "replay")
+os.environ.setdefault("OPENWEATHER_API_KEY", "replay")
+
+import main
+from city_registry import CityRegistry
+from fastapi.testclient import TestClient
+from upstream_fixtures import FixtureStore, ReplayTransport, synthetic_cities
+
+
+def time_requests(client: TestClient, url: str, count: int) -> dict:
+  latencies = []
+  for _ in range(count):
+    started = time.perf_counter()
+    response = client.get(url)
+    latencies.append((time.perf_counter() - started) * 1000)
+    response.raise_for_status()
+  latencies.sort()
+  return {
+    "p50_ms": statistics.median(latencies),
+    "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+    "max_ms": latencies[-1],
+  }
+
+
+def run(cities: int, latency_ms: float, requests: int, fixtures: Path = None) -> None:
+  transport = ReplayTransport(FixtureStore(fixtures) if fixtures else None, latency_ms / 1000, synthetic=True)
+  registry_cities = synthetic_cities(cities)
+
+  with tempfile.TemporaryDirectory() as tmp:
+    main.UPSTREAM_TRANSPORT = transport
+    main.CSV_FILE = Path(tmp) / "bench.csv"
+    main.COLLECT_DELAY_SECONDS = 0
+    main.city_registry = CityRegistry(registry_cities)
+
+    started = time.perf_counter()
+    asyncio.run(main.collect_data_for_all_cities())
+    collect_seconds = time.perf_counter() - started
+
+    main.app.state.http_client = main.create_http_client()
+    client = TestClient(main.app)
+    sample = registry_cities[0]
+    endpoints = {
+      "/history/all?hours=24": f"/history/all?hours=24",
+      "/cities/{city}/history": f"/cities/{sample['city']}/history?hours=24",
+      "/cities/{city}/pollution/24h": f"/cities/{sample['city']}/pollution/24h?state={sample['state']}&country=Brazil",
+      "/nearby": f"/nearby?lat={sample['lat']}&lon={sample['lon']}&k=10",
+      "/bbox": "/bbox?min_lat=-25&min_lon=-50&max_lat=-20&max_lon=-40",
+    }
+    results = {name: time_requests(client, url, requests) for name, url in endpoints.items()}
+
+  print(f"\n📊 Coleta: {cities} cidades em {collect_seconds:.2f}s "
+        f"({cities / collect_seconds:.0f} cidades/s, {transport.requests} chamadas upstream, latência {latency_ms}ms)")
+  print(f"{'endpoint':<32} {'p50 (ms)':>10} {'p95 (ms)':>10} {'max (ms)':>10}")
+  for name, stats in results.items():
+    print(f"{name:<32} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} {stats['max_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark offline (replay) do coletor e endpoints")
+  parser.add_argument("--cities", type=int, default=1000)
+  parser.add_argument("--latency-ms", type=float, default=0.0)
+  parser.add_argument("--requests", type=int, default=50)
+  parser.add_argument("--fixtures", type=Path, help="Diretório com respostas gravadas")
+  args = parser.parse_args()
+  run(args.cities, args.latency_ms, args.requests, args.fixtures)
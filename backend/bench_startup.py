@@ -0,0 +1,99 @@
+"""
+Benchmark do tempo de inicialização do backend.
+
+Mede, em processos novos (sem cache de import compartilhado):
+- o tempo de `import main`
+- o tempo até a primeira resposta 200 de `/` com o uvicorn subindo do zero
+
+Por padrão o servidor sobe em modo somente leitura (READ_ONLY=1, sem chaves),
+o que não depende das APIs externas. Com --budget-ms o script sai com código 1
+se a mediana do tempo até a primeira resposta passar do orçamento.
+
+  python bench_startup.py
+  python bench_startup.py --runs 5 --budget-ms 1500
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent
+
+
+def free_port() -> int:
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def bench_env() -> dict:
+  return {**os.environ, "READ_ONLY": "1", "IQAIR_API_KEY": "", "OPENWEATHER_API_KEY": "",
+          "PYTHONPATH": str(BACKEND_DIR)}
+
+
+def measure_import(env: dict) -> float:
+  """Tempo de `import main` (ms), medido dentro do processo filho"""
+  code = "import time; t0 = time.perf_counter(); import main; print((time.perf_counter() - t0) * 1000)"
+  result = subprocess.run([sys.executable, "-c", code], env=env, cwd=BACKEND_DIR,
+                          capture_output=True, text=True, check=True)
+  return float(result.stdout.strip().splitlines()[-1])
+
+
+def measure_first_response(env: dict, timeout: float = 30.0) -> float:
+  """Tempo (ms) entre iniciar o uvicorn e a primeira resposta 200 de `/`"""
+  port = free_port()
+  started = time.perf_counter()
+  process = subprocess.Popen(
+    [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+    env=env, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+  )
+  try:
+    with httpx.Client(timeout=1.0) as client:
+      while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+          raise RuntimeError(f"uvicorn terminou com código {process.returncode}")
+        try:
+          if client.get(f"http://127.0.0.1:{port}/").status_code == 200:
+            return (time.perf_counter() - started) * 1000
+        except httpx.TransportError:
+          pass
+        time.sleep(0.01)
+    raise RuntimeError(f"Sem resposta em {timeout:.0f}s")
+  finally:
+    process.terminate()
+    try:
+      process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+      process.kill()
+
+
+def run(runs: int, budget_ms: float = None) -> int:
+  env = bench_env()
+  imports = sorted(measure_import(env) for _ in range(runs))
+  first = sorted(measure_first_response(env) for _ in range(runs))
+
+  import_p50, first_p50 = statistics.median(imports), statistics.median(first)
+  print(f"\n📦 import main: p50 {import_p50:.0f} ms (min {imports[0]:.0f}, max {imports[-1]:.0f})")
+  print(f"🚀 Primeira resposta 200: p50 {first_p50:.0f} ms (min {first[0]:.0f}, max {first[-1]:.0f})")
+
+  if budget_ms is not None:
+    if first_p50 > budget_ms:
+      print(f"❌ Acima do orçamento de {budget_ms:.0f} ms")
+      return 1
+    print(f"✅ Dentro do orçamento de {budget_ms:.0f} ms")
+  return 0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark do tempo de inicialização do backend")
+  parser.add_argument("--runs", type=int, default=3)
+  parser.add_argument("--budget-ms", type=float, default=None)
+  args = parser.parse_args()
+  sys.exit(run(args.runs, args.budget_ms))
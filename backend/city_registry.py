@@ -0,0 +1,199 @@
+"""
+Registro de cidades monitoradas pelo coletor.
+
+As cidades podem vir de um arquivo (JSON ou CSV) indicado em CITIES_FILE e/ou
+do próprio histórico coletado. O registro é indexado pelo nome normalizado da
+cidade (lookup O(1)), pode ser recarregado sem reiniciar o servidor e dividido
+em shards para vários workers de coleta.
+"""
+
+import csv
+import json
+import threading
+import unicodedata
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+def normalize_city_key(name: Optional[str]) -> str:
+  """Normaliza um nome (casefold + remoção de acentos + espaços colapsados)"""
+  if not name:
+    return ""
+  decomposed = unicodedata.normalize("NFKD", name)
+  stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+  return " ".join(stripped.casefold().split())
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    return float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+
+
+def _make_entry(raw: dict) -> Optional[dict]:
+  """Valida e padroniza uma entrada do registro"""
+  city = (raw.get("city") or "").strip()
+  if not city:
+    return None
+  return {
+    "city": city,
+    "state": (raw.get("state") or "").strip(),
+    "country": (raw.get("country") or "").strip(),
+    "lat": _to_float(raw.get("lat")),
+    "lon": _to_float(raw.get("lon")),
+  }
+
+
+def load_entries_from_file(path: Path) -> List[dict]:
+  """Lê cidades de um arquivo .json (lista de objetos) ou .csv (com header)"""
+  with open(path, "r", encoding="utf-8") as f:
+    if path.suffix.lower() == ".json":
+      raw_entries = json.load(f)
+    else:
+      raw_entries = list(csv.DictReader(f))
+
+  entries = []
+  for raw in raw_entries:
+    entry = _make_entry(raw)
+    if entry:
+      entries.append(entry)
+  return entries
+
+
+class CityRegistry:
+  """
+  Registro de cidades com índice pelo nome normalizado.
+
+  O índice mapeia chave normalizada -> lista de entradas (cidades homônimas em
+  estados diferentes compartilham a mesma chave).
+  """
+
+  def __init__(self, default_cities: Iterable[dict], path: Optional[Path] = None):
+    self._default_cities = [e for e in map(_make_entry, default_cities) if e]
+    self.path = path
+    self._lock = threading.Lock()
+    self._entries: List[dict] = []
+    self._index: Dict[str, List[dict]] = {}
+    self._mtime: Optional[float] = None
+    self._geocoded: Dict[tuple, dict] = {}  # entrada -> resposta do geocoder (lat, lon, name, country)
+    self.version = 0  # muda a cada recarga/coordenada nova (invalida índices derivados)
+    self.reload()
+
+  # --- Carga ---
+
+  def _file_mtime(self) -> Optional[float]:
+    if self.path and self.path.exists():
+      return self.path.stat().st_mtime
+    return None
+
+  def reload(self, extra_entries: Iterable[dict] = ()) -> int:
+    """Recarrega o registro do arquivo (ou da lista padrão). Retorna o total de cidades"""
+    mtime = self._file_mtime()
+    if mtime is not None:
+      entries = load_entries_from_file(self.path)
+    else:
+      entries = [dict(e) for e in self._default_cities]
+
+    # Preserva coordenadas já resolvidas para não repetir geocoding
+    with self._lock:
+      previous = {self._entry_key(e): e for e in self._entries}
+
+    index: Dict[str, List[dict]] = {}
+    deduped: List[dict] = []
+    seen = set()
+    for entry in list(entries) + [e for e in map(_make_entry, extra_entries) if e]:
+      key = self._entry_key(entry)
+      if key in seen:
+        continue
+      seen.add(key)
+      old = previous.get(key)
+      if old and entry["lat"] is None and old["lat"] is not None:
+        entry["lat"], entry["lon"] = old["lat"], old["lon"]
+      deduped.append(entry)
+      index.setdefault(normalize_city_key(entry["city"]), []).append(entry)
+
+    with self._lock:
+      self._entries = deduped
+      self._index = index
+      self._mtime = mtime
+      self.version += 1
+    return len(deduped)
+
+  def has_changed(self) -> bool:
+    """Indica se o arquivo foi criado/modificado/removido desde a última carga"""
+    return self._file_mtime() != self._mtime
+
+  def reload_if_changed(self) -> bool:
+    """Recarrega apenas se o arquivo foi modificado desde a última carga"""
+    if not self.has_changed():
+      return False
+    self.reload()
+    return True
+
+  @staticmethod
+  def _entry_key(entry: dict) -> tuple:
+    return (
+      normalize_city_key(entry["city"]),
+      normalize_city_key(entry.get("state")),
+      normalize_city_key(entry.get("country")),
+    )
+
+  # --- Consulta ---
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def all(self) -> List[dict]:
+    return list(self._entries)
+
+  def get(self, city: str, state: Optional[str] = None, country: Optional[str] = None) -> Optional[dict]:
+    """Busca O(1) pelo nome normalizado; estado/país desambiguam homônimos"""
+    candidates = self._index.get(normalize_city_key(city), [])
+    for entry in candidates:
+      if state and normalize_city_key(entry["state"]) != normalize_city_key(state):
+        continue
+      if country and normalize_city_key(entry["country"]) != normalize_city_key(country):
+        continue
+      return entry
+    return None
+
+  def shard(self, index: int, count: int) -> List[dict]:
+    """Retorna as cidades do shard `index` de `count` (hash estável do nome)"""
+    if count <= 1:
+      return self.all()
+    return [
+      e for e in self._entries
+      if zlib.crc32("|".join(self._entry_key(e)).encode("utf-8")) % count == index
+    ]
+
+  # --- Cache de coordenadas ---
+
+  def get_coordinates(self, city: str, state: Optional[str] = None, country: Optional[str] = None) -> Optional[Dict[str, float]]:
+    entry = self.get(city, state, country)
+    if entry and entry["lat"] is not None and entry["lon"] is not None:
+      return {"lat": entry["lat"], "lon": entry["lon"]}
+    return None
+
+  def get_geocoded(self, city: str, state: Optional[str] = None, country: Optional[str] = None) -> Optional[dict]:
+    """Resposta do geocoder guardada para a cidade, com o nome e o país como ele os devolveu"""
+    entry = self.get(city, state, country)
+    cached = self._geocoded.get(self._entry_key(entry)) if entry else None
+    return dict(cached) if cached else None
+
+  def set_geocoded(self, city: str, state: Optional[str], country: Optional[str], result: dict) -> None:
+    """Guarda a resposta do geocoder (e as coordenadas) para as próximas consultas"""
+    entry = self.get(city, state, country)
+    if entry is None:
+      return
+    with self._lock:
+      self._geocoded[self._entry_key(entry)] = {k: result[k] for k in ("lat", "lon", "name", "country")}
+    self.set_coordinates(city, state, country, result["lat"], result["lon"])
+
+  def set_coordinates(self, city: str, state: Optional[str], country: Optional[str], lat: float, lon: float):
+    entry = self.get(city, state, country)
+    if entry and (entry["lat"], entry["lon"]) != (lat, lon):
+      with self._lock:
+        entry["lat"], entry["lon"] = lat, lon
+        self.version += 1
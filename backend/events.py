@@ -0,0 +1,202 @@
+"""
+Canal de push (Server-Sent Events) para novas leituras.
+
+O broker acompanha o final do CSV através do índice do histórico e entrega cada
+linha nova aos assinantes das cidades correspondentes. Como a fonte é o próprio
+arquivo, leituras gravadas por qualquer processo (coletor líder ou `/current`
+em outro worker) chegam a todos os workers. `notify()` acorda o broker logo
+após uma gravação local; gravações de outros processos são vistas no polling.
+
+O id de cada evento é `<arquivo>-<offset>`: o inode do CSV (em hexa) e o
+offset da linha, então o cliente pode retomar com `Last-Event-ID` (ou
+`since=<timestamp>`) sem perder nem repetir leituras. Se o arquivo foi reescrito
+(ex: migração de colunas), os offsets antigos não valem mais: o stream envia um
+evento `reset` e o cliente recarrega o histórico.
+"""
+
+import asyncio
+import bisect
+import json
+from pathlib import Path
+from typing import AsyncIterator, Callable, Optional, Set, Tuple
+
+from city_registry import normalize_city_key
+from history_index import get_history_index, is_primary
+
+
+class Subscription:
+  """Fila de leituras de um cliente, filtrada por cidades"""
+
+  def __init__(self, city_keys: Optional[Set[str]], maxsize: int):
+    self.city_keys = city_keys
+    self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+    self.overflowed = False
+
+  def wants(self, row: dict) -> bool:
+    return self.city_keys is None or normalize_city_key(row.get('city')) in self.city_keys
+
+
+class ReadingBroker:
+  """Distribui linhas novas do CSV para as assinaturas ativas"""
+
+  def __init__(self, get_path: Callable[[], Path], poll_interval: float = 2.0, queue_size: int = 1000):
+    self.get_path = get_path
+    self.poll_interval = poll_interval
+    self.queue_size = queue_size
+    self.subscriptions: Set[Subscription] = set()
+    self.file_id = 0
+    self.last_offset = 0
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._wakeup: Optional[asyncio.Event] = None
+    self._task: Optional[asyncio.Task] = None
+
+  # --- Ciclo de vida ---
+
+  def start(self) -> None:
+    """Inicia o acompanhamento do CSV a partir do fim atual do arquivo"""
+    self._loop = asyncio.get_running_loop()
+    self._wakeup = asyncio.Event()
+    index = get_history_index(self.get_path())
+    self.file_id, self.last_offset = index.file_id, index.indexed_size
+    self._task = asyncio.create_task(self._run())
+
+  async def stop(self) -> None:
+    if self._task:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    self._loop = None
+
+  def notify(self) -> None:
+    """Acorda o broker após uma gravação (seguro para chamar de qualquer thread)"""
+    loop = self._loop
+    if loop is None or loop.is_closed():
+      return
+    try:
+      loop.call_soon_threadsafe(self._wakeup.set)
+    except RuntimeError:
+      pass  # loop encerrado durante o shutdown
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+      except asyncio.TimeoutError:
+        pass
+      self._wakeup.clear()
+      try:
+        self.poll()
+      except Exception as e:
+        print(f"❌ Erro ao publicar leituras: {e}")
+
+  # --- Publicação ---
+
+  def poll(self) -> int:
+    """Publica as linhas gravadas desde a última verificação. Retorna quantas"""
+    index = get_history_index(self.get_path())
+    if index.file_id != self.file_id:
+      # Arquivo reescrito (ex: migração de colunas): as linhas já foram publicadas
+      # com os offsets antigos; segue do fim do arquivo novo
+      self.file_id, self.last_offset = index.file_id, index.indexed_size
+      return 0
+    if index.indexed_size < self.last_offset:
+      self.last_offset = 0  # arquivo truncado
+
+    published = 0
+    for offset, row in index.read_appended(self.last_offset):
+      if not is_primary(row):
+        continue  # séries horárias de outras fontes (ex: OpenWeatherMap) não são leituras novas
+      self.publish(event_id(index.file_id, offset), offset, row)
+      published += 1
+    self.last_offset = max(self.last_offset, index.indexed_size)
+    return published
+
+  def publish(self, event: str, offset: int, row: dict) -> None:
+    for subscription in list(self.subscriptions):
+      if subscription.overflowed or not subscription.wants(row):
+        continue
+      try:
+        subscription.queue.put_nowait((event, offset, row))
+      except asyncio.QueueFull:
+        # Cliente lento: encerra o stream; ele reconecta com Last-Event-ID
+        subscription.overflowed = True
+
+  # --- Assinaturas ---
+
+  def subscribe(self, cities: Optional[list] = None) -> Subscription:
+    city_keys = {normalize_city_key(c) for c in cities} if cities else None
+    subscription = Subscription(city_keys, self.queue_size)
+    self.subscriptions.add(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription: Subscription) -> None:
+    self.subscriptions.discard(subscription)
+
+
+def event_id(file_id: int, offset: int) -> str:
+  return f"{file_id:x}-{offset}"
+
+
+def parse_event_id(value: str) -> Optional[Tuple[int, int]]:
+  """(inode, offset) de um Last-Event-ID; None se o formato não for reconhecido"""
+  try:
+    file_id, offset = value.split("-")
+    return int(file_id, 16), int(offset)
+  except (AttributeError, ValueError):
+    return None
+
+
+def format_sse(event_id: str, row: dict, event: str = "reading") -> str:
+  """Formata uma leitura como evento SSE"""
+  return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(row, ensure_ascii=False)}\n\n"
+
+
+async def stream_readings(
+    broker: ReadingBroker,
+    is_disconnected: Callable,
+    cities: Optional[list] = None,
+    since_epoch: Optional[float] = None,
+    last_event_id: Optional[str] = None,
+    heartbeat: float = 15.0
+) -> AsyncIterator[str]:
+  """
+  Gera o stream SSE: primeiro o replay (a partir de since/Last-Event-ID),
+  depois as leituras novas em tempo real.
+  """
+  subscription = broker.subscribe(cities)
+  try:
+    # Replay do que o cliente ainda não tem (até onde o broker já publicou)
+    file_id, boundary = broker.file_id, broker.last_offset
+    after = None
+    if last_event_id is not None:
+      parsed = parse_event_id(last_event_id)
+      if parsed is not None and parsed[0] == file_id:
+        after = parsed[1]
+      else:
+        # Id de outra versão do arquivo: o offset não aponta mais para a mesma linha
+        yield f"event: reset\ndata: {json.dumps({'reason': 'history_rewritten'})}\n\n"
+    if since_epoch is not None or after is not None:
+      index = get_history_index(broker.get_path())
+      if cities:
+        offsets = sorted({o for c in cities for o in index.offsets_for(c, since_epoch=since_epoch, after_offset=after)})
+      else:
+        offsets = index.offsets_for(None, since_epoch=since_epoch, after_offset=after)
+      for offset, row in index.read_rows_at(offsets[:bisect.bisect_left(offsets, boundary)]):
+        yield format_sse(event_id(file_id, offset), row)
+
+    while not subscription.overflowed:
+      try:
+        event, offset, row = await asyncio.wait_for(subscription.queue.get(), timeout=heartbeat)
+      except asyncio.TimeoutError:
+        if await is_disconnected():
+          break
+        yield ": ping\n\n"
+        continue
+      if after is not None and offset <= after:
+        continue
+      yield format_sse(event, row)
+  finally:
+    broker.unsubscribe(subscription)
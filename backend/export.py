@@ -0,0 +1,120 @@
+"""
+Exportação colunar do histórico (Parquet ou Arrow IPC) para análise.
+
+Os filtros de cidade, fonte e intervalo de tempo são resolvidos no índice em
+memória (só as linhas selecionadas são lidas do CSV) e a escolha de colunas
+limita o que é convertido e gravado. O arquivo é montado no pool de processos,
+direto num arquivo temporário criado pelo próprio worker (que o apaga se a
+gravação falhar), e enviado ao cliente de lá:
+- parquet: comprimido (zstd), com estatísticas por row group; as linhas saem
+  ordenadas por cidade e tempo, então leitores como pandas/polars/duckdb também
+  pulam row groups ao filtrar por cidade ou período
+- arrow: formato de arquivo IPC sem compressão, que pode ser aberto com
+  `pyarrow.memory_map` sem copiar os dados
+
+O pyarrow é opcional: sem ele o endpoint responde 501 e o resto da API segue
+igual. O import só acontece no worker que gera o arquivo.
+"""
+
+import importlib.util
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from history_index import parse_timestamp, read_csv_rows_at, row_source
+
+EXPORT_FORMATS = {
+  "parquet": "application/vnd.apache.parquet",
+  "arrow": "application/vnd.apache.arrow.file",
+}
+
+# Colunas exportadas, na ordem do arquivo
+EXPORT_COLUMNS = ["timestamp", "city", "state", "country", "source", "aqi", "aqi_category", "pm25", "temperature",
+                  "humidity", "pm10", "co", "no2", "o3", "so2", "iqar", "iqar_category"]
+TEXT_COLUMNS = ("city", "state", "country", "source", "aqi_category", "iqar_category")
+NUMERIC_COLUMNS = ("aqi", "pm25", "temperature", "humidity", "pm10", "co", "no2", "o3", "so2", "iqar")
+
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+
+
+def pyarrow_available() -> bool:
+  return importlib.util.find_spec("pyarrow") is not None
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    return float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+
+
+def _to_micros(value) -> Optional[int]:
+  try:
+    return int(parse_timestamp(value) * 1_000_000)
+  except (TypeError, ValueError, AttributeError):
+    return None
+
+
+def _schema(pa, columns: Sequence[str]):
+  types = {"timestamp": pa.timestamp("us", tz="UTC")}
+  types.update({name: pa.dictionary(pa.int32(), pa.string()) for name in TEXT_COLUMNS})
+  types.update({name: pa.float64() for name in NUMERIC_COLUMNS})
+  return pa.schema([(name, types[name]) for name in columns])
+
+
+def build_table(rows, columns: Sequence[str] = EXPORT_COLUMNS):
+  """Tabela Arrow das linhas do CSV, ordenada por cidade e tempo"""
+  import pyarrow as pa
+
+  rows = sorted(rows, key=lambda r: (r.get("city") or "", r.get("timestamp") or ""))
+  arrays = []
+  for name in columns:
+    if name == "timestamp":
+      values = [_to_micros(r.get("timestamp")) for r in rows]
+      arrays.append(pa.array(values, type=pa.timestamp("us", tz="UTC")))
+    elif name in NUMERIC_COLUMNS:
+      arrays.append(pa.array([_to_float(r.get(name)) for r in rows], type=pa.float64()))
+    else:
+      values = [row_source(r) for r in rows] if name == "source" else [r.get(name) or "" for r in rows]
+      arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+  return pa.Table.from_arrays(arrays, schema=_schema(pa, columns))
+
+
+def write_table(table, out_path: str, fmt: str) -> None:
+  if fmt == "parquet":
+    import pyarrow.parquet as pq
+    pq.write_table(table, out_path, compression="zstd", row_group_size=PARQUET_ROW_GROUP_ROWS)
+  else:
+    import pyarrow as pa
+    with pa.OSFile(out_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+      writer.write_table(table)
+
+
+def remove_export(result: Tuple[str, int]) -> None:
+  """Apaga o arquivo de uma exportação (resultado de export_from_csv)"""
+  try:
+    os.unlink(result[0])
+  except FileNotFoundError:
+    pass
+
+
+def export_from_csv(path: str, fieldnames: List[str], offsets: Sequence[int],
+                    fmt: str, columns: Sequence[str] = EXPORT_COLUMNS) -> Tuple[str, int]:
+  """
+  Grava as linhas dos offsets num arquivo temporário. Roda no pool de processos;
+  retorna o caminho do arquivo e o nº de linhas.
+  """
+  fd, out_path = tempfile.mkstemp(prefix="export_qualidade_ar_", suffix=f".{fmt}")
+  os.close(fd)
+  try:
+    rows = [row for _, row in read_csv_rows_at(Path(path), fieldnames, offsets)]
+    if "aqi_category" in columns:
+      from aqi import with_aqi_category  # só as linhas antigas, gravadas sem a categoria
+      rows = with_aqi_category(rows)
+    table = build_table(rows, columns)
+    write_table(table, out_path, fmt)
+  except BaseException:
+    os.unlink(out_path)
+    raise
+  return out_path, table.num_rows
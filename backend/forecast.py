@@ -0,0 +1,286 @@
+"""
+Previsão de curto prazo (próximas horas) a partir do histórico coletado.
+
+As leituras de cada cidade são agregadas em médias horárias e alimentam dois
+modelos leves:
+- sazonal ingênuo: a mesma hora do dia anterior (ou o último valor, se ainda
+  não há 24h de histórico)
+- suavização exponencial (Holt com tendência amortecida), com alpha/beta
+  escolhidos por busca em grade no ajuste inicial
+
+Os dois são atualizados incrementalmente a cada hora nova (O(1) por hora, sem
+reajustar do zero) e o erro absoluto médio de cada um na previsão de um passo
+decide qual é usado como `value`. Os parâmetros são reotimizados a cada
+`REFIT_EVERY_HOURS` horas novas.
+
+O ajuste inicial roda no pool de processos (o mesmo dos relatórios); o modelo
+ajustado fica em cache e só recebe as linhas novas do CSV nas próximas consultas.
+"""
+
+import math
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from history_index import parse_timestamp, read_csv_rows_at
+
+STEP_SECONDS = 3600
+SEASON_HOURS = 24
+HISTORY_HOURS = 7 * 24
+REFIT_EVERY_HOURS = 24
+FORECAST_METRICS = ["aqi", "pm25"]
+
+ALPHAS = (0.2, 0.4, 0.6, 0.8)
+BETAS = (0.05, 0.15, 0.3)
+PHI = 0.9  # amortecimento da tendência
+ERROR_DECAY = 0.1  # peso da hora nova no erro médio (média móvel exponencial)
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    number = float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+  return number if number is not None and math.isfinite(number) else None
+
+
+def _holt_sse(values: List[float], alpha: float, beta: float) -> float:
+  """Erro quadrático da previsão de um passo de Holt amortecido sobre a série"""
+  level, trend = values[0], 0.0
+  sse = 0.0
+  for y in values[1:]:
+    predicted = level + PHI * trend
+    sse += (y - predicted) ** 2
+    new_level = alpha * y + (1 - alpha) * predicted
+    trend = beta * (new_level - level) + (1 - beta) * PHI * trend
+    level = new_level
+  return sse
+
+
+class CityForecastModel:
+  """Estado incremental dos modelos de uma cidade (serializável para o pool)"""
+
+  def __init__(self, metric: str = "aqi"):
+    self.metric = metric
+    self.hours: "OrderedDict[int, float]" = OrderedDict()  # hora (epoch) -> média
+    self.pending_hour: Optional[int] = None
+    self.pending_sum = 0.0
+    self.pending_count = 0
+    self.last_offset = -1
+    self.alpha, self.beta = ALPHAS[1], BETAS[0]
+    self.level: Optional[float] = None
+    self.trend = 0.0
+    self.error = {"seasonal_naive": None, "exp_smoothing": None}
+    self.hours_since_refit = 0
+    self.auto_refit = True
+    self._cache: Dict[int, List[dict]] = {}
+
+  # --- Atualização ---
+
+  def add_rows(self, rows: Iterable[Tuple[int, dict]]) -> int:
+    """Consome linhas (offset, linha) em ordem de arquivo; retorna quantas horas fecharam"""
+    closed = 0
+    for offset, row in rows:
+      if offset <= self.last_offset:
+        continue
+      self.last_offset = offset
+      value = _to_float(row.get(self.metric))
+      try:
+        epoch = parse_timestamp(row["timestamp"])
+      except (KeyError, ValueError, AttributeError):
+        continue
+      if value is None:
+        continue
+      hour = int(epoch // STEP_SECONDS * STEP_SECONDS)
+      if self.hours and hour <= self.last_hour:
+        continue  # hora já fechada: leitura atrasada é ignorada
+      if self.pending_hour is None or hour > self.pending_hour:
+        if self.pending_hour is not None:
+          closed += self._close_hour()
+        self.pending_hour, self.pending_sum, self.pending_count = hour, 0.0, 0
+      elif hour < self.pending_hour:
+        continue
+      self.pending_sum += value
+      self.pending_count += 1
+    if closed:
+      self._cache.clear()
+    return closed
+
+  def close_pending(self, now_epoch: float) -> None:
+    """Fecha a hora pendente se ela já terminou (sem esperar a próxima leitura)"""
+    if self.pending_hour is not None and now_epoch >= self.pending_hour + STEP_SECONDS:
+      if self._close_hour():
+        self._cache.clear()
+      self.pending_hour = None
+
+  def _close_hour(self) -> int:
+    if not self.pending_count:
+      return 0
+    self.observe(self.pending_hour, self.pending_sum / self.pending_count)
+    self.pending_count = 0
+    return 1
+
+  def observe(self, hour: int, y: float) -> None:
+    """Incorpora a média de uma hora fechada: mede o erro de cada modelo e atualiza Holt"""
+    if self.hours:
+      steps = max(1, (hour - next(reversed(self.hours))) // STEP_SECONDS)
+      self._track_error("seasonal_naive", self._seasonal_value(hour), y)
+      self._track_error("exp_smoothing", self._holt_value(steps), y)
+      predicted = self._holt_value(steps)
+      new_level = self.alpha * y + (1 - self.alpha) * predicted
+      self.trend = self.beta * (new_level - self.level) + (1 - self.beta) * PHI * self.trend
+      self.level = new_level
+    else:
+      self.level, self.trend = y, 0.0
+
+    self.hours[hour] = y
+    while len(self.hours) > HISTORY_HOURS:
+      self.hours.popitem(last=False)
+
+    self.hours_since_refit += 1
+    if self.auto_refit and self.hours_since_refit >= REFIT_EVERY_HOURS:
+      self.refit()
+
+  def _track_error(self, model: str, predicted: Optional[float], actual: float) -> None:
+    if predicted is None:
+      return
+    error = abs(actual - predicted)
+    previous = self.error[model]
+    self.error[model] = error if previous is None else (1 - ERROR_DECAY) * previous + ERROR_DECAY * error
+
+  def refit(self) -> None:
+    """Reescolhe alpha/beta pela busca em grade e recalcula o estado de Holt"""
+    self.hours_since_refit = 0
+    values = list(self.hours.values())
+    if len(values) < 3:
+      return
+    self.alpha, self.beta = min(
+      ((a, b) for a in ALPHAS for b in BETAS), key=lambda ab: _holt_sse(values, *ab)
+    )
+    level, trend = values[0], 0.0
+    for y in values[1:]:
+      predicted = level + PHI * trend
+      new_level = self.alpha * y + (1 - self.alpha) * predicted
+      trend = self.beta * (new_level - level) + (1 - self.beta) * PHI * trend
+      level = new_level
+    self.level, self.trend = level, trend
+    self._cache.clear()
+
+  # --- Previsão ---
+
+  def _holt_value(self, steps: int) -> Optional[float]:
+    if self.level is None:
+      return None
+    damping = sum(PHI ** i for i in range(1, steps + 1))
+    return self.level + damping * self.trend
+
+  def _seasonal_value(self, hour: int) -> Optional[float]:
+    value = self.hours.get(hour - SEASON_HOURS * STEP_SECONDS)
+    if value is None and self.hours:
+      # Sem a mesma hora de ontem: usa a mesma hora mais recente disponível, ou o último valor
+      for days in range(2, HISTORY_HOURS // SEASON_HOURS + 1):
+        value = self.hours.get(hour - days * SEASON_HOURS * STEP_SECONDS)
+        if value is not None:
+          break
+      else:
+        value = next(reversed(self.hours.values()))
+    return value
+
+  @property
+  def best_model(self) -> str:
+    sn, es = self.error["seasonal_naive"], self.error["exp_smoothing"]
+    if sn is not None and (es is None or sn < es):
+      return "seasonal_naive"
+    return "exp_smoothing"
+
+  @property
+  def last_hour(self) -> Optional[int]:
+    return next(reversed(self.hours)) if self.hours else None
+
+  def forecast(self, horizon: int) -> List[dict]:
+    """Previsão das próximas `horizon` horas a partir da última hora fechada"""
+    if horizon in self._cache:
+      return self._cache[horizon]
+    if not self.hours:
+      return []
+
+    best = self.best_model
+    points = []
+    for step in range(1, horizon + 1):
+      hour = self.last_hour + step * STEP_SECONDS
+      seasonal = self.hours.get(hour - SEASON_HOURS * STEP_SECONDS)
+      if seasonal is None:
+        # Além de 24h à frente a "mesma hora de ontem" é um valor já previsto
+        seasonal = points[step - 1 - SEASON_HOURS]["seasonal_naive"] if step > SEASON_HOURS else self._seasonal_value(hour)
+      smoothing = max(0.0, self._holt_value(step))
+      points.append({
+        "timestamp": datetime.fromtimestamp(hour, tz=timezone.utc).isoformat(),
+        "seasonal_naive": round(seasonal, 1),
+        "exp_smoothing": round(smoothing, 1),
+        "value": round(seasonal if best == "seasonal_naive" else smoothing, 1),
+      })
+    self._cache[horizon] = points
+    return points
+
+  def summary(self) -> dict:
+    return {
+      "model": self.best_model,
+      "mae": {name: (round(e, 2) if e is not None else None) for name, e in self.error.items()},
+      "params": {"alpha": self.alpha, "beta": self.beta, "phi": PHI},
+      "history_hours": len(self.hours),
+      "last_observed_hour": datetime.fromtimestamp(self.last_hour, tz=timezone.utc).isoformat() if self.hours else None,
+    }
+
+
+def fit_model(rows: Iterable[Tuple[int, dict]], metric: str = "aqi", now_epoch: Optional[float] = None) -> CityForecastModel:
+  """Ajuste completo: agrega por hora, escolhe os parâmetros e percorre a série"""
+  model = CityForecastModel(metric)
+  rows = list(rows)
+
+  # Primeiro escolhe alpha/beta com a série inteira, depois percorre hora a hora
+  # (isso preenche o erro de cada modelo para a escolha do melhor)
+  probe = CityForecastModel(metric)
+  probe.auto_refit = False
+  probe.add_rows(rows)
+  if now_epoch is not None:
+    probe.close_pending(now_epoch)
+  probe.refit()
+  model.alpha, model.beta = probe.alpha, probe.beta
+  model.auto_refit = False  # sem reotimizar no meio do ajuste
+  model.add_rows(rows)
+  if now_epoch is not None:
+    model.close_pending(now_epoch)
+  model.auto_refit, model.hours_since_refit = True, 0
+  return model
+
+
+def fit_models_from_csv(path: str, fieldnames: List[str], offsets_by_city: Dict[str, List[int]],
+                        metric: str = "aqi", now_epoch: Optional[float] = None) -> Dict[str, CityForecastModel]:
+  """Executado no pool: ajusta os modelos de um lote de cidades"""
+  models = {}
+  for key, offsets in offsets_by_city.items():
+    models[key] = fit_model(read_csv_rows_at(path, fieldnames, offsets), metric, now_epoch)
+  return models
+
+
+class ForecastCache:
+  """Modelos ajustados por (cidade, métrica), com limite de entradas (LRU)"""
+
+  def __init__(self, max_entries: int = 5000):
+    self.max_entries = max_entries
+    self._models: "OrderedDict[tuple, CityForecastModel]" = OrderedDict()
+
+  def get(self, key: tuple) -> Optional[CityForecastModel]:
+    model = self._models.get(key)
+    if model is not None:
+      self._models.move_to_end(key)
+    return model
+
+  def put(self, key: tuple, model: CityForecastModel) -> None:
+    self._models[key] = model
+    self._models.move_to_end(key)
+    while len(self._models) > self.max_entries:
+      self._models.popitem(last=False)
+
+  def __len__(self) -> int:
+    return len(self._models)
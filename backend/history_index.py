@@ -0,0 +1,342 @@
+"""
+Índice invertido do histórico em CSV.
+
+Mapeia a chave normalizada da cidade (ver `normalize_city_key`) para as
+posições (offset em bytes) e timestamps das suas linhas no arquivo. O índice é
+construído uma vez e depois atualizado incrementalmente lendo apenas os bytes
+acrescentados ao final do arquivo, então consultas por cidade leem somente as
+linhas daquela cidade.
+
+Cada linha tem uma fonte (coluna `source`). As consultas usam por padrão a
+fonte principal (IQAir, e também linhas antigas sem a coluna); as das outras
+fontes (ex: OpenWeatherMap) ficam num índice separado por fonte e só aparecem
+quando pedidas explicitamente.
+"""
+
+import bisect
+import csv
+import os
+import threading
+from array import array
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from city_registry import normalize_city_key
+
+PRIMARY_SOURCE = "iqair"
+
+
+def parse_timestamp(value: str) -> float:
+  """Converte timestamp ISO 8601 (com 'Z' ou offset) em epoch (segundos)"""
+  return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def row_source(row: dict) -> str:
+  """Fonte da linha (linhas sem a coluna `source` são da fonte principal)"""
+  return row.get('source') or PRIMARY_SOURCE
+
+
+def is_primary(row: dict) -> bool:
+  return row_source(row) == PRIMARY_SOURCE
+
+
+def location_key(city: Optional[str], state: Optional[str] = None, country: Optional[str] = None) -> Tuple[str, str, str]:
+  """Chave da localidade: cidades homônimas em estados/países diferentes não se misturam"""
+  return normalize_city_key(city), normalize_city_key(state), normalize_city_key(country)
+
+
+def upgrade_csv_header(path: Path, headers: List[str], defaults: Dict[str, str]) -> bool:
+  """
+  Acrescenta ao arquivo as colunas de `headers` que faltam no cabeçalho (no fim
+  de cada linha, com o valor de `defaults`). Reescreve num arquivo temporário e
+  troca de uma vez (os.replace). Retorna True se o arquivo foi migrado.
+  Deve rodar com o lock de escrita do histórico (ver IngestLog.recover): uma
+  linha acrescentada durante a cópia se perderia na troca.
+  """
+  path = Path(path)
+  if not path.exists():
+    return False
+  with open(path, 'rb') as f:
+    header_line = f.readline()
+    current = next(csv.reader([header_line.decode('utf-8', errors='replace')]), [])
+    if not current or current == headers:
+      return False
+    if current != headers[:len(current)]:
+      raise ValueError(f"Cabeçalho de {path} incompatível: {current} (esperado {headers})")
+
+    missing = headers[len(current):]
+    suffix = ("," + ",".join(defaults.get(name, "") for name in missing)).encode('utf-8')
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.migrando")
+    with open(tmp, 'wb') as out:
+      newline = b"\r\n" if header_line.endswith(b"\r\n") else b"\n"
+      out.write(",".join(headers).encode('utf-8') + newline)
+      for line in f:
+        if line.endswith(b"\r\n"):
+          out.write(line[:-2] + suffix + b"\r\n")
+        elif line.endswith(b"\n"):
+          out.write(line[:-1] + suffix + b"\n")
+        else:
+          out.write(line)  # linha parcial (escrita interrompida): mantida como está
+      out.flush()
+      os.fsync(out.fileno())
+  os.replace(tmp, path)
+  return True
+
+
+def parse_csv_line(line: bytes, fieldnames: List[str]) -> dict:
+  values = next(csv.reader([line.decode('utf-8', errors='replace')]), [])
+  return dict(zip(fieldnames, values))
+
+
+def read_csv_rows_at(path: Path, fieldnames: List[str], offsets: List[int]) -> Iterator[Tuple[int, dict]]:
+  """
+  Lê as linhas nos offsets informados, retornando (offset, linha). Não depende
+  do índice em memória, então pode rodar em outro processo (ex: pool de relatórios).
+  """
+  if not offsets:
+    return
+  with open(path, 'rb') as f:
+    position = -1
+    for offset in offsets:
+      if offset != position:
+        f.seek(offset)
+      line = f.readline()
+      position = offset + len(line)
+      yield offset, parse_csv_line(line, fieldnames)
+
+
+class _CityPostings:
+  """Offsets e timestamps das linhas de uma cidade (arrays compactos)"""
+  __slots__ = ("offsets", "epochs")
+
+  def __init__(self):
+    self.offsets = array("q")
+    self.epochs = array("d")
+
+
+class CsvHistoryIndex:
+  """
+  Índice incremental (localidade -> linhas) de um arquivo CSV.
+
+  As linhas ficam por (cidade, estado, país) normalizados; a busca pelo nome
+  junta as homônimas, a não ser que o estado/país também seja informado.
+  """
+
+  def __init__(self, path: Path):
+    self.path = Path(path)
+    self._lock = threading.Lock()
+    self.generation = 0
+    self.file_id = 0  # inode do arquivo: muda quando ele é reescrito (ex: migração de colunas)
+    self._reset()
+
+  def _reset(self):
+    self.generation += 1  # muda quando o arquivo é reindexado do zero
+    self.fieldnames: List[str] = []
+    self.postings: Dict[Tuple[str, str, str], _CityPostings] = {}  # fonte principal
+    self.sources: Dict[str, Dict[Tuple[str, str, str], _CityPostings]] = {PRIMARY_SOURCE: self.postings}
+    self.names: Dict[str, List[Tuple[str, str, str]]] = {}  # nome normalizado -> localidades
+    self.indexed_size = 0
+    self.header_size = 0
+    self.total_rows = 0
+    self.skipped_rows = 0
+    self.latest_epoch: Optional[float] = None
+    self._last_line_offset = 0
+    self._last_line = b""
+
+  # --- Manutenção ---
+
+  def _is_stale(self, f, size: int) -> bool:
+    """Detecta arquivo truncado ou substituído desde a última indexação"""
+    if size < self.indexed_size:
+      return True
+    if not self._last_line:
+      return False
+    f.seek(self._last_line_offset)
+    return f.read(len(self._last_line)) != self._last_line
+
+  def refresh(self) -> None:
+    """Indexa as linhas completas acrescentadas desde a última chamada"""
+    with self._lock:
+      if not self.path.exists():
+        self._reset()
+        return
+
+      with open(self.path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != self.file_id or self._is_stale(f, stat.st_size):
+          self._reset()
+        size, self.file_id = stat.st_size, stat.st_ino
+        if size == self.indexed_size:
+          return
+
+        f.seek(self.indexed_size)
+        offset = self.indexed_size
+        for line in f:
+          if not line.endswith(b"\n"):
+            break  # linha parcial (escrita em andamento): indexa na próxima vez
+          self._index_line(line, offset)
+          self._last_line_offset, self._last_line = offset, line
+          offset += len(line)
+        self.indexed_size = offset
+
+  def _index_line(self, line: bytes, offset: int) -> None:
+    text = line.decode('utf-8', errors='replace')
+    if not self.fieldnames:
+      self.fieldnames = next(csv.reader([text]))
+      self.header_size = len(line)
+      return
+
+    values = next(csv.reader([text]), [])
+    row = dict(zip(self.fieldnames, values))
+    try:
+      epoch = parse_timestamp(row['timestamp'])
+    except (KeyError, ValueError, AttributeError):
+      self.skipped_rows += 1
+      return
+
+    self.total_rows += 1
+    source = row_source(row)
+    by_city = self.sources.get(source)
+    if by_city is None:
+      by_city = self.sources[source] = {}
+    key = location_key(row.get('city'), row.get('state'), row.get('country'))
+    postings = by_city.get(key)
+    if postings is None:
+      postings = by_city[key] = _CityPostings()
+      locations = self.names.setdefault(key[0], [])
+      if key not in locations:
+        locations.append(key)
+    postings.offsets.append(offset)
+    postings.epochs.append(epoch)
+    if source == PRIMARY_SOURCE and (self.latest_epoch is None or epoch > self.latest_epoch):
+      self.latest_epoch = epoch
+
+  # --- Consulta ---
+
+  def city_keys(self) -> List[str]:
+    """Nomes normalizados das cidades com leituras da fonte principal"""
+    return sorted({key[0] for key in self.postings})
+
+  def locations(self) -> List[Tuple[str, str, str]]:
+    """Localidades (cidade, estado, país normalizados) com leituras da fonte principal"""
+    with self._lock:
+      return list(self.postings.keys())
+
+  def _select(self, by_city: dict, city: Optional[str], state: Optional[str],
+              country: Optional[str]) -> List[_CityPostings]:
+    """Postings da cidade pelo nome (homônimas juntas, salvo se estado/país forem informados)"""
+    if city is None:
+      return list(by_city.values())
+    key = location_key(city, state, country)
+    selected = []
+    for location in self.names.get(key[0], ()):
+      if (state is not None and location[1] != key[1]) or (country is not None and location[2] != key[2]):
+        continue
+      postings = by_city.get(location)
+      if postings is not None:
+        selected.append(postings)
+    return selected
+
+  def offsets_for(self, city: Optional[str] = None, since_epoch: Optional[float] = None,
+                  source: str = PRIMARY_SOURCE, until_epoch: Optional[float] = None,
+                  state: Optional[str] = None, country: Optional[str] = None,
+                  after_offset: Optional[int] = None) -> List[int]:
+    """
+    Offsets (em ordem de arquivo) das linhas da cidade em [since_epoch, until_epoch)
+    e depois de `after_offset` (busca binária: os offsets de cada cidade são crescentes)
+    """
+    with self._lock:
+      selected = self._select(self.sources.get(source, {}), city, state, country)
+
+      offsets = []
+      for postings in selected:
+        start = bisect.bisect_right(postings.offsets, after_offset) if after_offset is not None else 0
+        if since_epoch is None and until_epoch is None:
+          offsets.extend(postings.offsets[start:])
+        else:
+          low = since_epoch if since_epoch is not None else float("-inf")
+          high = until_epoch if until_epoch is not None else float("inf")
+          offsets.extend(o for o, e in zip(postings.offsets[start:], postings.epochs[start:]) if low <= e < high)
+
+    if len(selected) > 1:
+      offsets.sort()
+    return offsets
+
+  def epochs_for(self, city: str, source: str = PRIMARY_SOURCE, since_epoch: Optional[float] = None,
+                 state: Optional[str] = None, country: Optional[str] = None) -> List[float]:
+    """Timestamps (epoch) das linhas da cidade nesta fonte"""
+    with self._lock:
+      selected = self._select(self.sources.get(source, {}), city, state, country)
+      return [e for postings in selected for e in postings.epochs if since_epoch is None or e >= since_epoch]
+
+  def latest_offsets(self) -> List[int]:
+    """Offset da leitura mais recente de cada cidade"""
+    with self._lock:
+      return [
+        postings.offsets[max(range(len(postings.epochs)), key=postings.epochs.__getitem__)]
+        for postings in self.postings.values() if postings.epochs
+      ]
+
+  def _parse_line(self, line: bytes) -> dict:
+    return parse_csv_line(line, self.fieldnames)
+
+  def window_stats(self, city: Optional[str] = None, since_epoch: Optional[float] = None) -> Tuple[int, Optional[float]]:
+    """(total de linhas, timestamp mais recente) da janela, calculados só em memória"""
+    with self._lock:
+      selected = self._select(self.postings, city, None, None)
+
+      count, latest = 0, None
+      for postings in selected:
+        for epoch in postings.epochs:
+          if since_epoch is None or epoch >= since_epoch:
+            count += 1
+            if latest is None or epoch > latest:
+              latest = epoch
+    return count, latest
+
+  def read_rows_at(self, offsets: List[int]) -> Iterator[Tuple[int, dict]]:
+    """Lê as linhas nos offsets informados, retornando (offset, linha)"""
+    return read_csv_rows_at(self.path, self.fieldnames, offsets)
+
+  def read_rows(self, offsets: List[int]) -> Iterator[dict]:
+    """Lê as linhas nos offsets informados como dicionários (mesmo formato do DictReader)"""
+    for _, row in self.read_rows_at(offsets):
+      yield row
+
+  def read_appended(self, start: int) -> Iterator[Tuple[int, dict]]:
+    """Linhas completas entre o offset `start` e o fim já indexado, em ordem de arquivo"""
+    start = max(start, self.header_size)
+    end = self.indexed_size
+    if start >= end:
+      return
+    with open(self.path, 'rb') as f:
+      f.seek(start)
+      offset = start
+      while offset < end:
+        line = f.readline()
+        if not line:
+          break
+        row = self._parse_line(line)
+        try:
+          parse_timestamp(row['timestamp'])
+        except (KeyError, ValueError, AttributeError):
+          row = None
+        if row is not None:
+          yield offset, row
+        offset += len(line)
+
+
+_indexes: Dict[str, CsvHistoryIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_history_index(path: Path) -> CsvHistoryIndex:
+  """Retorna o índice (atualizado) do arquivo, criando-o na primeira chamada"""
+  key = str(Path(path).resolve())
+  with _indexes_lock:
+    index = _indexes.get(key)
+    if index is None:
+      index = _indexes[key] = CsvHistoryIndex(path)
+  index.refresh()
+  return index
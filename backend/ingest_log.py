@@ -0,0 +1,250 @@
+"""
+Gravação à prova de queda no histórico (CSV) com write-ahead log.
+
+Cada gravação (uma leitura ou um lote) vira um registro no WAL ao lado do CSV
+(ex: dados_qualidade_ar.wal) antes de tocar no CSV:
+
+  W <offset> <tamanho> <crc32>\\n<bytes das linhas CSV>
+
+1. o registro é gravado no WAL e sincronizado em disco (fsync)
+2. as linhas são acrescentadas ao CSV a partir de `offset` e sincronizadas
+3. o WAL é esvaziado (o registro já está no CSV)
+
+Se o processo cair no meio, a recuperação (na primeira gravação ou na subida
+do servidor) só olha o fim do CSV e o WAL, sem reler o histórico:
+- linha parcial no fim do CSV (escrita interrompida): cortada até o último \\n
+- registro íntegro no WAL (CRC confere): reaplicado se as linhas ainda não
+  estão no CSV (num lote interrompido, só as linhas que faltam)
+- registro incompleto ou com CRC errado: descartado e contado como corrompido
+  (a queda foi antes da gravação no CSV, que nunca foi confirmada)
+
+Um lock de arquivo (fcntl, quando disponível) serializa as gravações entre
+processos (ex: servidor e backfill gravando no mesmo histórico).
+"""
+
+import csv
+import io
+import os
+import threading
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+  import fcntl
+except ImportError:  # Windows: só o lock entre threads
+  fcntl = None
+
+RECORD_MARK = b"W"
+TAIL_BLOCK = 64 * 1024
+
+
+def wal_path_for(csv_path: Path) -> Path:
+  """WAL ao lado do CSV (ex: dados_qualidade_ar.wal)"""
+  csv_path = Path(csv_path)
+  return csv_path.with_name(f"{csv_path.stem}.wal")
+
+
+def _checksum(offset: int, data: bytes) -> int:
+  return zlib.crc32(data, zlib.crc32(str(offset).encode("ascii")))
+
+
+def encode_record(offset: int, data: bytes) -> bytes:
+  header = b"%s %d %d %08x\n" % (RECORD_MARK, offset, len(data), _checksum(offset, data))
+  return header + data
+
+
+def decode_records(raw: bytes) -> Tuple[List[Tuple[int, bytes]], int]:
+  """Registros íntegros do WAL em ordem e o nº de registros corrompidos/incompletos"""
+  records, corrupt, position = [], 0, 0
+  while position < len(raw):
+    end = raw.find(b"\n", position)
+    parts = raw[position:end].split(b" ") if end >= 0 else []
+    try:
+      mark, offset, length, crc = parts
+      offset, length, crc = int(offset), int(length), int(crc, 16)
+    except ValueError:
+      return records, corrupt + 1  # cabeçalho ilegível: o resto do WAL não é confiável
+    data = raw[end + 1:end + 1 + length]
+    if mark != RECORD_MARK or len(data) != length or _checksum(offset, data) != crc:
+      return records, corrupt + 1
+    records.append((offset, data))
+    position = end + 1 + length
+  return records, corrupt
+
+
+def encode_rows(rows: Iterable[dict], fieldnames: List[str], header: bool = False) -> bytes:
+  """Linhas no formato do csv.DictWriter (mesmas aspas e \\r\\n do arquivo)"""
+  buffer = io.StringIO()
+  writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+  if header:
+    writer.writeheader()
+  writer.writerows(rows)
+  return buffer.getvalue().encode("utf-8")
+
+
+def _complete_size(f, size: int) -> int:
+  """Tamanho do arquivo até a última linha completa (lê só blocos do fim)"""
+  if size == 0:
+    return 0
+  f.seek(size - 1)
+  if f.read(1) == b"\n":
+    return size  # caso comum: um byte lido
+  end = size
+  while end > 0:
+    start = max(0, end - TAIL_BLOCK)
+    f.seek(start)
+    block = f.read(end - start)
+    cut = block.rfind(b"\n")
+    if cut >= 0:
+      return start + cut + 1
+    end = start
+  return 0
+
+
+class IngestLog:
+  """Gravações no CSV protegidas pelo WAL, com contadores de recuperação"""
+
+  def __init__(self, csv_path: Path, fsync: bool = True):
+    self.csv_path = Path(csv_path)
+    self.wal_path = wal_path_for(self.csv_path)
+    self.fsync = fsync
+    self._lock = threading.Lock()
+    self.records_written = 0
+    self.rows_written = 0
+    self.recovered_records = 0
+    self.discarded_records = 0
+    self.corrupt_records = 0
+    self.truncated_bytes = 0
+    self.recoveries = 0
+
+  def _sync(self, f) -> None:
+    f.flush()
+    if self.fsync:
+      os.fsync(f.fileno())
+
+  def _lock_file(self, f) -> None:
+    if fcntl is not None:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+  def _truncate_partial_tail(self, f) -> int:
+    """Corta uma linha parcial no fim do CSV; retorna o tamanho final"""
+    size = os.fstat(f.fileno()).st_size
+    complete = _complete_size(f, size)
+    if complete != size:
+      f.truncate(complete)
+      self._sync(f)
+      self.truncated_bytes += size - complete
+      print(f"🩹 {self.csv_path}: {size - complete} bytes de uma linha parcial removidos")
+    return complete
+
+  def _apply(self, f, offset: int, data: bytes, size: int) -> bool:
+    """Reaplica um registro do WAL; False se ele já estava no CSV"""
+    written = b""
+    if size > offset:
+      f.seek(offset)
+      written = f.read(min(size - offset, len(data)))
+    if written == data:
+      return False
+    if written and data.startswith(written) and size == offset + len(written):
+      # Lote interrompido: parte das linhas chegou ao CSV, grava só o restante
+      data = data[len(written):]
+    # Se o CSV mudou depois do registro (outro escritor sem WAL), acrescenta no fim
+    f.seek(0, os.SEEK_END)
+    f.write(data)
+    self._sync(f)
+    return True
+
+  def _recover_locked(self, wal, f) -> None:
+    size = self._truncate_partial_tail(f)
+    wal.seek(0)
+    raw = wal.read()
+    if not raw:
+      return
+    records, corrupt = decode_records(raw)
+    self.corrupt_records += corrupt
+    for offset, data in records:
+      if self._apply(f, offset, data, size):
+        self.recovered_records += 1
+        size = os.fstat(f.fileno()).st_size
+      else:
+        self.discarded_records += 1
+    self.recoveries += 1
+    print(f"🩹 {self.csv_path}: WAL recuperado ({len(records)} registro(s), {corrupt} corrompido(s))")
+    wal.truncate(0)
+    self._sync(wal)
+
+  def _open_csv(self):
+    fd = os.open(self.csv_path, os.O_RDWR | os.O_CREAT, 0o644)
+    return os.fdopen(fd, "r+b")
+
+  def recover(self, migrate: Optional[Callable[[], bool]] = None) -> bool:
+    """
+    Corta a linha parcial do CSV e reaplica o WAL (só lê o fim do arquivo).
+    `migrate` (ex: troca de cabeçalho) roda em seguida, ainda com o lock de
+    escrita, para que nenhuma gravação de outro processo se perca na troca do
+    arquivo. Retorna o resultado de `migrate` (False se não houve).
+    """
+    with self._lock:
+      if not self.csv_path.exists() and not (self.wal_path.exists() and self.wal_path.stat().st_size):
+        return False
+      with open(self.wal_path, "a+b") as wal:
+        self._lock_file(wal)
+        with self._open_csv() as f:
+          self._recover_locked(wal, f)
+        return bool(migrate()) if migrate is not None else False
+
+  def append_rows(self, rows: List[dict], fieldnames: List[str]) -> int:
+    """Acrescenta as linhas ao CSV (com cabeçalho se o arquivo está vazio); retorna quantas"""
+    if not rows:
+      return 0
+    with self._lock, open(self.wal_path, "a+b") as wal:
+      self._lock_file(wal)
+      with self._open_csv() as f:
+        # Outro processo pode ter caído no meio de uma gravação
+        self._recover_locked(wal, f)
+        offset = os.fstat(f.fileno()).st_size
+        data = encode_rows(rows, fieldnames, header=offset == 0)
+
+        wal.write(encode_record(offset, data))
+        self._sync(wal)
+        f.seek(offset)
+        f.write(data)
+        self._sync(f)
+        # Sem fsync: se o WAL vazio não chegar ao disco, a recuperação vê que as
+        # linhas já estão no CSV e descarta o registro
+        wal.truncate(0)
+        wal.flush()
+
+    self.records_written += 1
+    self.rows_written += len(rows)
+    return len(rows)
+
+  def stats(self) -> dict:
+    return {
+      "wal_file": str(self.wal_path),
+      "fsync": self.fsync,
+      "records_written": self.records_written,
+      "rows_written": self.rows_written,
+      "recoveries": self.recoveries,
+      "recovered_records": self.recovered_records,
+      "discarded_records": self.discarded_records,
+      "corrupt_records": self.corrupt_records,
+      "truncated_bytes": self.truncated_bytes,
+    }
+
+
+_logs: Dict[str, IngestLog] = {}
+_logs_lock = threading.Lock()
+
+
+def get_ingest_log(csv_path: Path, fsync: bool = True) -> IngestLog:
+  """WAL do CSV (um por arquivo); recupera escritas interrompidas no primeiro acesso"""
+  key = str(Path(csv_path).resolve())
+  with _logs_lock:
+    log = _logs.get(key)
+    if log is not None:
+      return log
+    log = _logs[key] = IngestLog(csv_path, fsync=fsync)
+  log.recover()
+  return log
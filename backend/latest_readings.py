@@ -0,0 +1,183 @@
+"""
+Última leitura de cada cidade, mantida na gravação.
+
+O mapa (localidade -> linha mais recente, com a mesma chave (cidade, estado,
+país) do índice do histórico) é atualizado em `save_to_csv` e persistido de
+forma atômica (arquivo temporário + os.replace) ao lado do CSV, então "qual o
+AQI atual em cada cidade" é um lookup O(1), sem varrer o histórico. Numa coleta
+com muitas cidades o arquivo é regravado no máximo a cada `persist_interval`
+segundos; `flush()` grava o que faltar ao fim da coleta.
+
+Linhas gravadas por outros processos (outro worker, backfill) são incorporadas
+na memória lendo só o trecho do CSV depois do último offset conhecido. Só o
+caminho de gravação regrava o arquivo: as consultas não escrevem em disco.
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from history_index import CsvHistoryIndex, is_primary, location_key, parse_timestamp
+
+Location = Tuple[str, str, str]
+
+
+def latest_path_for(csv_path: Path) -> Path:
+  """Arquivo do mapa ao lado do CSV (ex: dados_qualidade_ar.ultimas.json)"""
+  csv_path = Path(csv_path)
+  return csv_path.with_name(f"{csv_path.stem}.ultimas.json")
+
+
+class LatestReadings:
+  """Mapa cidade -> leitura mais recente, persistido em JSON"""
+
+  def __init__(self, path: Path, persist_interval: float = 1.0):
+    self.path = Path(path)
+    self.persist_interval = persist_interval
+    self._lock = threading.Lock()
+    self._dirty = False
+    self._persisted_at = 0.0
+    self.readings: Dict[Location, dict] = {}
+    self._epochs: Dict[Location, float] = {}
+    self._names: Dict[str, List[Location]] = {}  # nome normalizado -> localidades
+    self.offset = 0
+    self._mtime_ns: Optional[int] = None
+    self.load()
+
+  # --- Persistência ---
+
+  def load(self) -> None:
+    with self._lock:
+      self._clear()
+      self._dirty = False
+      try:
+        self._mtime_ns = self.path.stat().st_mtime_ns
+        data = json.loads(self.path.read_text(encoding='utf-8'))
+      except FileNotFoundError:
+        self._mtime_ns = None
+        return
+      except (OSError, ValueError) as e:
+        print(f"⚠️  Mapa de últimas leituras ilegível ({self.path}): {e}; será reconstruído")
+        return
+      self.offset = int(data.get("offset", 0))
+      readings = data.get("readings", [])
+      for row in readings.values() if isinstance(readings, dict) else readings:  # dict: formato antigo
+        self._apply(row)
+
+  def _clear(self) -> None:
+    self.readings, self._epochs, self._names, self.offset = {}, {}, {}, 0
+
+  def _persist(self) -> None:
+    payload = {"offset": self.offset, "readings": list(self.readings.values())}
+    tmp = self.path.with_suffix(f"{self.path.suffix}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, self.path)
+    self._mtime_ns = self.path.stat().st_mtime_ns
+    self._dirty = False
+    self._persisted_at = time.monotonic()
+
+  def flush(self) -> None:
+    """Grava o mapa se houver atualização pendente"""
+    with self._lock:
+      if self._dirty:
+        self._persist()
+
+  def reload_if_changed(self) -> None:
+    """
+    Recarrega se outro processo regravou o arquivo, mantendo as atualizações
+    locais ainda não gravadas. Se o arquivo foi apagado, recomeça do zero.
+    """
+    try:
+      mtime_ns = self.path.stat().st_mtime_ns
+    except FileNotFoundError:
+      mtime_ns = None
+    if mtime_ns == self._mtime_ns:
+      return
+    pending = list(self.readings.values()) if self._dirty and mtime_ns is not None else []
+    self.load()
+    with self._lock:
+      for row in pending:
+        self._dirty = self._apply(row) or self._dirty
+
+  # --- Atualização ---
+
+  def _apply(self, row: dict) -> bool:
+    """Guarda a linha se for mais recente que a atual da localidade"""
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      return False
+    key = location_key(row.get("city"), row.get("state"), row.get("country"))
+    if epoch < self._epochs.get(key, float("-inf")):
+      return False
+    if key not in self.readings:
+      self._names.setdefault(key[0], []).append(key)
+    self.readings[key] = row
+    self._epochs[key] = epoch
+    return True
+
+  def update(self, row: dict) -> None:
+    """Chamado na gravação de cada leitura"""
+    with self._lock:
+      if self._apply(dict(row)):
+        self._dirty = True
+        if self._mtime_ns is None or time.monotonic() - self._persisted_at >= self.persist_interval:
+          self._persist()
+
+  def sync(self, index: CsvHistoryIndex) -> None:
+    """
+    Incorpora linhas do CSV gravadas depois do último offset (ou reconstrói).
+    Só em memória: roda nas consultas de qualquer worker, e o arquivo é
+    regravado pela próxima gravação (update/flush).
+    """
+    with self._lock:
+      if self.offset > index.indexed_size:
+        # CSV truncado/substituído: recomeça
+        self._clear()
+      if self.offset == 0 and index.indexed_size > 0:
+        rows = (row for _, row in index.read_rows_at(sorted(index.latest_offsets())))
+      else:
+        rows = (row for _, row in index.read_appended(self.offset))
+      for row in rows:
+        if is_primary(row):
+          self._apply(row)
+      self.offset = index.indexed_size
+
+  # --- Consulta ---
+
+  def find(self, city: str, state: Optional[str] = None, country: Optional[str] = None) -> List[dict]:
+    """Leituras das localidades com esse nome (homônimas juntas, salvo se estado/país forem informados)"""
+    key = location_key(city, state, country)
+    return [
+      self.readings[location] for location in self._names.get(key[0], ())
+      if (state is None or location[1] == key[1]) and (country is None or location[2] == key[2])
+    ]
+
+  def get(self, city: str, state: Optional[str] = None, country: Optional[str] = None) -> Optional[dict]:
+    """Leitura da localidade; None se não houver ou se o nome for ambíguo (homônimas)"""
+    found = self.find(city, state, country)
+    return found[0] if len(found) == 1 else None
+
+  def all(self) -> List[dict]:
+    return list(self.readings.values())
+
+  def __len__(self) -> int:
+    return len(self.readings)
+
+
+_maps: Dict[str, LatestReadings] = {}
+_maps_lock = threading.Lock()
+
+
+def get_latest_readings(csv_path: Path) -> LatestReadings:
+  """Mapa de últimas leituras do CSV (um por arquivo, recarregado se mudou)"""
+  key = str(Path(csv_path).resolve())
+  with _maps_lock:
+    latest = _maps.get(key)
+    if latest is None:
+      latest = _maps[key] = LatestReadings(latest_path_for(csv_path))
+  latest.reload_if_changed()
+  return latest
@@ -0,0 +1,66 @@
+"""
+Eleição do coletor líder entre vários processos (workers do uvicorn/gunicorn).
+
+Todos os workers servem leituras do mesmo CSV, mas apenas o processo que obtém
+o lock exclusivo do arquivo COLLECTOR_LOCK_FILE faz a coleta. O lock é liberado
+pelo sistema operacional quando o processo morre, então outro worker assume na
+próxima tentativa.
+"""
+
+import os
+import threading
+from pathlib import Path
+
+try:
+  import fcntl
+except ImportError:  # Windows
+  fcntl = None
+  import msvcrt
+
+
+class LeaderLock:
+  """Lock exclusivo e não bloqueante baseado em arquivo"""
+
+  def __init__(self, path: Path):
+    self.path = Path(path)
+    self._fd = None
+    self._lock = threading.Lock()
+
+  @property
+  def is_leader(self) -> bool:
+    return self._fd is not None
+
+  def try_acquire(self) -> bool:
+    """Tenta virar líder; retorna True se este processo detém o lock"""
+    with self._lock:
+      if self._fd is not None:
+        return True
+
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        if fcntl:
+          fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+          msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+      except OSError:
+        os.close(fd)
+        return False
+
+      os.ftruncate(fd, 0)
+      os.write(fd, str(os.getpid()).encode())
+      self._fd = fd
+      return True
+
+  def release(self) -> None:
+    with self._lock:
+      if self._fd is None:
+        return
+      try:
+        if fcntl:
+          fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+          os.lseek(self._fd, 0, os.SEEK_SET)
+          msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+      finally:
+        os.close(self._fd)
+        self._fd = None
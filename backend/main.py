@@ -1,37 +1,66 @@
 import os
+import math
+import hashlib
 import httpx
 import asyncio
-import csv
+from contextlib import contextmanager
 from pathlib import Path
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi import FastAPI, Request, Response, HTTPException, Query, Header, Depends
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta, timezone
-from dotenv import load_dotenv
 from typing import List, Optional, Any, Dict
-from apscheduler.schedulers.background import BackgroundScheduler
 from fastapi.middleware.cors import CORSMiddleware
+from city_registry import CityRegistry, normalize_city_key
+from ingest_log import get_ingest_log
+from history_index import PRIMARY_SOURCE, get_history_index, location_key, parse_timestamp, read_csv_rows_at, upgrade_csv_header
+from latest_readings import get_latest_readings
+from spatial import GridIndex
+from timeline import OPENWEATHER_SOURCE, TIMELINE_SOURCES, hour_start, openweather_rows, timeline_from_csv
+from anomalies import AnomalyDetector, anomalies_path_for, read_anomalies, record_anomalies, tail_jsonl
+from alerts import AlertEngine, alerts_path_for
+from forecast import FORECAST_METRICS, HISTORY_HOURS, ForecastCache, fit_models_from_csv
+from leader import LeaderLock
+from settings import Settings, load_env_once
+from profiling import ProfilingMiddleware, TracedRoute, TraceStore, span, traced
+from events import ReadingBroker, stream_readings
+from reports import REPORT_FORMATS, DEFAULT_EXCEEDANCE_AQI, ReportCache, build_report, compare_from_csv, get_report_pool, shutdown_report_pool
+from export import EXPORT_COLUMNS, EXPORT_FORMATS, export_from_csv, pyarrow_available, remove_export
+from offload import QueryCancelled, QueryOffloader, QueryRejected, json_with_rows, render_rows_json
 
-# Carrega as variáveis de ambiente
-load_dotenv()
+# Carrega o .env (barato) para as opções lidas abaixo; as chaves das APIs só
+# são verificadas quando um endpoint precisa delas (ver settings.py)
+load_env_once()
 
 # --- Configuração das APIs ---
-IQAIR_API_KEY = os.getenv("IQAIR_API_KEY")
-OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")  # Nova API!
+settings = Settings()
 
-if not IQAIR_API_KEY or not OPENWEATHER_API_KEY:
-  raise EnvironmentError("IQAIR_API_KEY e/ou OPENWEATHER_API_KEY não foram encontradas no arquivo .env")
+# As URLs podem apontar para o servidor de replay (upstream_fixtures.py) em testes de carga
+IQAIR_API_URL = os.getenv("IQAIR_API_URL", "http://api.airvisual.com/v2/")
+OPENWEATHER_API_URL = os.getenv("OPENWEATHER_API_URL", "https://api.openweathermap.org/data/2.5/")
+OPENWEATHER_GEO_URL = os.getenv("OPENWEATHER_GEO_URL", "https://api.openweathermap.org/geo/1.0/")
 
-IQAIR_API_URL = "http://api.airvisual.com/v2/"
-OPENWEATHER_API_URL = "https://api.openweathermap.org/data/2.5/"
+# Transport alternativo para os clientes HTTP (ex: ReplayTransport em benchmarks)
+UPSTREAM_TRANSPORT: Optional[httpx.AsyncBaseTransport] = None
 
-IQAIR_PARAMS = {"key": IQAIR_API_KEY}
+def create_http_client(timeout: httpx.Timeout = httpx.Timeout(30.0, connect=5.0)) -> httpx.AsyncClient:
+  """Cria o cliente HTTP usado para falar com IQAir/OpenWeatherMap"""
+  return httpx.AsyncClient(timeout=timeout, transport=UPSTREAM_TRANSPORT)
+
+def require_upstream():
+  """Dependência dos endpoints que consultam IQAir/OpenWeatherMap (503 no modo somente leitura)"""
+  reason = settings.upstream_unavailable_reason()
+  if reason:
+    raise HTTPException(status_code=503, detail=reason)
 
 # --- Modelos de Resposta (Pydantic) ---
 
 class CurrentDataResponse(BaseModel):
   source_api: str = "iqair"
   pm25: Optional[float] = None
+  category: Optional[str] = None  # Categoria do AQI US
   temperature: Optional[float] = None
   humidity: Optional[float] = None
   timestamp: Optional[str] = None
@@ -43,7 +72,19 @@ class TimeSeriesDataPoint(BaseModel):
 
 class PM25Response(TimeSeriesDataPoint):
   pm25: Optional[float] = None
-  aqi: Optional[int] = None  # Air Quality Index
+  aqi: Optional[int] = None  # Air Quality Index (escala 1-5 do OpenWeatherMap)
+  aqi_us: Optional[int] = None  # AQI US (EPA) calculado a partir das concentrações
+  category: Optional[str] = None  # Categoria do AQI US
+
+class AlertRuleRequest(BaseModel):
+  id: Optional[str] = None
+  name: Optional[str] = None
+  field: str = Field("aqi", description="aqi, pm25, temperature ou humidity")
+  op: str = Field(">", description=">, >=, < ou <=")
+  threshold: float
+  clear_threshold: Optional[float] = Field(None, description="Valor de volta ao normal (histerese)")
+  duration_minutes: float = Field(0, description="Tempo que a condição precisa durar")
+  cities: Optional[List[str]] = Field(None, description="Cidades (padrão: todas)")
 
 class CountryResponse(BaseModel):
   country: str
@@ -56,56 +97,263 @@ class CityResponse(BaseModel):
 
 # --- Configuração do CSV ---
 CSV_FILE = Path("dados_qualidade_ar.csv")
-CSV_HEADERS = ["timestamp", "city", "state", "country", "pm25", "temperature", "humidity", "aqi"]
+# pm10/co/no2/o3/so2: concentrações da série do OpenWeatherMap (vazias nas linhas da IQAir)
+# aqi_category: categoria EPA do aqi, gravada na ingestão; iqar/iqar_category: IQAr
+# (CONAMA) calculado das concentrações, só nas linhas do OpenWeatherMap
+CSV_HEADERS = ["timestamp", "city", "state", "country", "pm25", "temperature", "humidity", "aqi", "source",
+               "pm10", "co", "no2", "o3", "so2", "aqi_category", "iqar", "iqar_category"]
 
-def save_to_csv(data: dict):
-  """Salva dados no CSV"""
-  file_exists = CSV_FILE.exists()
-  
-  with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
-    writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-    if not file_exists:
-      writer.writeheader()
-    writer.writerow(data)
-
-def read_from_csv(city: str = None, hours: int = 24):
-  """Lê dados do CSV"""
+# INGEST_FSYNC: "1" (padrão) sincroniza WAL e CSV em disco a cada gravação; "0"
+# troca durabilidade em queda de energia por velocidade (queda do processo segue coberta)
+INGEST_FSYNC = os.getenv("INGEST_FSYNC", "1") == "1"
+
+_schema_checked = set()
+
+def ensure_csv_schema(path: Optional[Path] = None) -> None:
+  """
+  Recupera escritas interrompidas (WAL) e migra históricos antigos sem as
+  colunas novas (`source` = iqair nas linhas antigas; poluentes e categorias
+  vazios, a categoria é calculada na leitura). Roda uma vez por arquivo.
+  """
+  path = Path(path or CSV_FILE)
+  if str(path) in _schema_checked:
+    return
+  # Recuperação e migração no mesmo trecho com o lock de escrita do WAL
+  migrate = lambda: upgrade_csv_header(path, CSV_HEADERS, {"source": PRIMARY_SOURCE})
+  if get_ingest_log(path, fsync=INGEST_FSYNC).recover(migrate):
+    print(f"🔧 {path}: colunas novas adicionadas ao histórico")
+  _schema_checked.add(str(path))
+
+# --- Detecção de anomalias na ingestão ---
+# ANOMALY_MODE: "flag" (padrão) grava e registra, "quarantine" não grava
+# spikes/valores impossíveis, "off" desliga a verificação
+ANOMALY_MODE = os.getenv("ANOMALY_MODE", "flag")
+ANOMALY_WINDOW = int(os.getenv("ANOMALY_WINDOW", "24"))
+
+def recent_city_rows(city_key: str) -> List[dict]:
+  """Últimas leituras da cidade no histórico (aquece o detector após reiniciar)"""
   if not CSV_FILE.exists():
     return []
-  
-  cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours)
-  results = []
-  
-  with open(CSV_FILE, 'r', encoding='utf-8') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-      try:
-        row_time = datetime.fromisoformat(row['timestamp'].replace('Z', '+00:00'))
-        if row_time >= cutoff_time:
-          if city is None or row['city'].lower() == city.lower():
-            results.append(row)
-      except:
-        continue
-  
-  return results
+  index = get_history_index(CSV_FILE)
+  return list(index.read_rows(index.offsets_for(city_key)[-ANOMALY_WINDOW:]))
+
+anomaly_detector = AnomalyDetector(window=ANOMALY_WINDOW, mode=ANOMALY_MODE, seed_rows=recent_city_rows)
+
+@traced("csv.write")
+def save_to_csv(data: dict) -> bool:
+  """Salva dados no CSV (retorna False se a leitura foi para a quarentena)"""
+  anomalies = anomaly_detector.check(data)
+  quarantined = anomaly_detector.should_quarantine(anomalies)
+  if anomalies:
+    record_anomalies(anomalies_path_for(CSV_FILE), data, anomalies, quarantined)
+  if quarantined:
+    kinds = ", ".join(f"{a['kind']}:{a['field']}" for a in anomalies)
+    print(f"🚫 {data.get('city')}: leitura em quarentena ({kinds})")
+    return False
+
+  ensure_csv_schema(CSV_FILE)
+  from aqi import with_aqi_category  # categoria gravada uma vez, servida pronta nas leituras
+  data = with_aqi_category([{**data, "source": data.get("source") or PRIMARY_SOURCE}])[0]
+  get_ingest_log(CSV_FILE, fsync=INGEST_FSYNC).append_rows([data], CSV_HEADERS)
+
+  # Mantém o mapa de últimas leituras (consultas O(1) em /latest)
+  get_latest_readings(CSV_FILE).update(data)
+
+  # Avalia as regras de alerta só com esta leitura (incremental)
+  alert_engine.ingest(data)
+
+  # Avisa o canal de push (/stream) que há leitura nova
+  reading_broker.notify()
+  return True
+
+def save_source_rows(rows: List[dict], path: Optional[Path] = None) -> int:
+  """
+  Grava leituras horárias de outras fontes (ex: OpenWeatherMap) no mesmo
+  histórico, pulando horas que a cidade já tem nessa fonte. Essas linhas não
+  passam pela detecção de anomalias, alertas nem /stream (que usam a IQAir).
+  Retorna quantas linhas foram gravadas.
+  """
+  path = Path(path or CSV_FILE)
+  if not rows:
+    return 0
+  ensure_csv_schema(path)
+  index = get_history_index(path) if path.exists() else None
+
+  known: Dict[tuple, set] = {}
+  new_rows = []
+  for row in rows:
+    state, country = row.get("state", ""), row.get("country", "")
+    key = (location_key(row["city"], state, country), row["source"])
+    if key not in known:
+      known[key] = set(index.epochs_for(row["city"], row["source"], state=state, country=country)) if index else set()
+    epoch = parse_timestamp(row["timestamp"])
+    if epoch in known[key]:
+      continue
+    known[key].add(epoch)
+    new_rows.append(row)
+
+  # Um único registro no WAL: o lote entra inteiro no histórico ou não entra
+  return get_ingest_log(path, fsync=INGEST_FSYNC).append_rows(new_rows, CSV_HEADERS)
+
+# --- Alertas ---
+# ALERT_RULES_FILE: regras em JSON (padrão: AQI > 150 por 2h e AQI > 100 por 1h)
+# ALERT_WEBHOOK_URL: se definido, os eventos são enviados em lote ao fim da coleta
+ALERT_RULES_FILE = Path(os.getenv("ALERT_RULES_FILE", "alertas_regras.json"))
+ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL")
+
+# As regras são relidas do arquivo quando outro worker as altera
+alert_engine = AlertEngine(get_log_path=lambda: alerts_path_for(CSV_FILE), webhook_url=ALERT_WEBHOOK_URL,
+                           rules_path=ALERT_RULES_FILE)
+
+# Publica as novas linhas do CSV para os clientes de /stream
+reading_broker = ReadingBroker(lambda: CSV_FILE)
+
+def history_window_start(hours: int, since: Optional[float] = None) -> float:
+  """Início (epoch) da janela: últimas `hours` horas e, se houver cursor, depois de `since`"""
+  start = (datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp()
+  if since is not None:
+    start = max(start, math.nextafter(since, math.inf))
+  return start
+
+def history_offsets(city: Optional[str], hours: int, since: Optional[float] = None) -> tuple:
+  """
+  (colunas, offsets) das linhas da janela, pelo índice por cidade normalizada.
+  "São Paulo", "sao paulo" e "SAO PAULO" retornam as mesmas linhas.
+  """
+  if not CSV_FILE.exists():
+    return CSV_HEADERS, []
+  index = get_history_index(CSV_FILE)
+  return index.fieldnames, index.offsets_for(city, since_epoch=history_window_start(hours, since))
+
+@traced("csv.read")
+def read_from_csv(city: str = None, hours: int = 24, since: Optional[float] = None):
+  """
+  Lê dados do CSV usando o índice por cidade normalizada.
+  `since` (epoch) retorna apenas linhas posteriores ao cursor.
+  """
+  fieldnames, offsets = history_offsets(city, hours, since)
+  return [row for _, row in read_csv_rows_at(CSV_FILE, fieldnames, offsets)]
+
+# --- Consultas pesadas fora do event loop ---
+# Leituras grandes e agregações vão para o pool de processos (o mesmo dos relatórios).
+# QUERY_MAX_PENDING: consultas no pool ao mesmo tempo; acima disso responde 503
+# QUERY_INLINE_ROWS: até quantas linhas a consulta roda direto no handler
+# QUERY_CHUNK_ROWS: linhas por lote enviado ao pool
+query_offloader = QueryOffloader(
+  get_report_pool,
+  max_pending=int(os.getenv("QUERY_MAX_PENDING", "8")),
+  inline_rows=int(os.getenv("QUERY_INLINE_ROWS", "2000")),
+  chunk_rows=int(os.getenv("QUERY_CHUNK_ROWS", "50000")),
+)
 
-# Lista de cidades para coletar
+@contextmanager
+def offload_errors():
+  """Converte recusa (pool cheio) e desconexão do cliente em respostas HTTP"""
+  try:
+    yield
+  except QueryRejected as e:
+    raise HTTPException(status_code=503, detail=f"Servidor ocupado: {e}", headers={"Retry-After": "1"})
+  except QueryCancelled:
+    raise HTTPException(status_code=499, detail="Cliente desconectou antes do fim da consulta")
+
+@traced("csv.etag")
+def history_window_state(city: Optional[str], hours: int, since: Optional[float]) -> tuple:
+  """
+  (ETag, timestamp ISO mais recente) da janela, calculados pelo índice em memória
+  sem ler linhas. O ETag muda quando chega leitura nova ou quando linhas saem da janela.
+  """
+  count, latest = 0, None
+  if CSV_FILE.exists():
+    index = get_history_index(CSV_FILE)
+    count, latest = index.window_stats(city, since_epoch=history_window_start(hours, since))
+  key = f"{normalize_city_key(city) if city else '*'}|{hours}|{since}|{count}|{latest}"
+  etag = f'W/"{hashlib.sha1(key.encode()).hexdigest()[:16]}"'
+  latest_iso = datetime.fromtimestamp(latest, tz=timezone.utc).isoformat() if latest is not None else None
+  return etag, latest_iso
+
+def etag_matches(request: Request, etag: str) -> bool:
+  if_none_match = request.headers.get("if-none-match")
+  if not if_none_match:
+    return False
+  candidates = [tag.strip() for tag in if_none_match.split(",")]
+  return "*" in candidates or etag in candidates
+
+def parse_timestamp_param(value: Optional[str]) -> Optional[float]:
+  """Converte parâmetro ISO 8601 em epoch (422 se inválido)"""
+  if not value:
+    return None
+  try:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+  except ValueError:
+    raise HTTPException(status_code=422, detail=f"Timestamp inválido: '{value}'")
+  if parsed.tzinfo is None:
+    parsed = parsed.replace(tzinfo=timezone.utc)
+  return parsed.timestamp()
+
+def latest_readings_map():
+  """Mapa de últimas leituras, já com as linhas gravadas por outros processos"""
+  latest = get_latest_readings(CSV_FILE)
+  if CSV_FILE.exists():
+    latest.sync(get_history_index(CSV_FILE))
+  return latest
+
+def read_cities_from_csv() -> List[dict]:
+  """Lista as localidades distintas presentes no histórico (city, state, country)"""
+  if not CSV_FILE.exists():
+    return []
+
+  index = get_history_index(CSV_FILE)
+  cities = []
+  for city, state, country in index.locations():
+    offsets = index.offsets_for(city, state=state, country=country)
+    for row in index.read_rows(offsets[-1:]):
+      cities.append({"city": row.get('city'), "state": row.get('state'), "country": row.get('country')})
+  return cities
+
+# Lista padrão de cidades para coletar (usada quando CITIES_FILE não existe)
 CITIES_TO_COLLECT = [
   {"city": "São Paulo", "state": "São Paulo", "country": "Brazil"},
   {"city": "Rio de Janeiro", "state": "Rio de Janeiro", "country": "Brazil"},
   {"city": "Fortaleza", "state": "Ceará", "country": "Brazil"},
 ]
 
+# --- Registro de cidades ---
+# CITIES_FILE: arquivo .json/.csv com city, state, country e (opcional) lat/lon
+# CITIES_FROM_HISTORY=1: inclui também as cidades já presentes no histórico
+# COLLECTOR_SHARD_INDEX/COLLECTOR_SHARD_COUNT: divide as cidades entre coletores
+CITIES_FILE = Path(os.getenv("CITIES_FILE", "cidades.json"))
+CITIES_FROM_HISTORY = os.getenv("CITIES_FROM_HISTORY", "0") == "1"
+COLLECTOR_SHARD_INDEX = int(os.getenv("COLLECTOR_SHARD_INDEX", "0"))
+COLLECTOR_SHARD_COUNT = int(os.getenv("COLLECTOR_SHARD_COUNT", "1"))
+COLLECT_DELAY_SECONDS = float(os.getenv("COLLECT_DELAY_SECONDS", "1"))
+# OPENWEATHER_COLLECT=1 (padrão): a coleta também grava as horas novas do
+# OpenWeatherMap (no máximo uma chamada por cidade por hora)
+OPENWEATHER_COLLECT = os.getenv("OPENWEATHER_COLLECT", "1") == "1"
+_openweather_next_sync: Dict[tuple, float] = {}
+
+city_registry = CityRegistry(CITIES_TO_COLLECT, path=CITIES_FILE)
+
+def reload_city_registry() -> int:
+  """Recarrega o registro (arquivo + histórico, se habilitado)"""
+  extra = read_cities_from_csv() if CITIES_FROM_HISTORY else []
+  return city_registry.reload(extra_entries=extra)
+
+def get_cities_to_collect() -> List[dict]:
+  """Cidades do shard deste coletor, recarregando o registro se o arquivo mudou"""
+  if city_registry.has_changed():
+    reload_city_registry()
+  return city_registry.shard(COLLECTOR_SHARD_INDEX, COLLECTOR_SHARD_COUNT)
+
 async def collect_data_for_all_cities():
   """Coleta dados de todas as cidades e salva no CSV"""
   print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] Iniciando coleta automática...")
   
-  async with httpx.AsyncClient(timeout=30.0) as client:
-    for city_info in CITIES_TO_COLLECT:
+  async with create_http_client(httpx.Timeout(30.0)) as client:
+    for city_info in get_cities_to_collect():
       try:
         # Coleta dados do IQAir (mesma lógica do endpoint /current)
         params = {
-          **IQAIR_PARAMS, 
+          **settings.iqair_params, 
           "city": city_info["city"], 
           "state": city_info["state"], 
           "country": city_info["country"]
@@ -136,19 +384,109 @@ async def collect_data_for_all_cities():
           }
           
           save_to_csv(csv_data)
+
+          # A IQAir informa a posição da estação ([lon, lat]): evita geocoding depois
+          coordinates = data["data"].get("location", {}).get("coordinates")
+          if coordinates and city_registry.get_coordinates(city_info["city"], city_info["state"], city_info["country"]) is None:
+            city_registry.set_coordinates(city_info["city"], city_info["state"], city_info["country"], coordinates[1], coordinates[0])
           print(f"✅ {city_info['city']}: AQI={csv_data['aqi']}, Temp={csv_data['temperature']}°C")
         else:
           print(f"⚠️  {city_info['city']}: Dados não disponíveis")
           
       except Exception as e:
         print(f"❌ Erro ao coletar {city_info['city']}: {e}")
+
+      if OPENWEATHER_COLLECT:
+        try:
+          saved = await sync_openweather_history(client, city_info)
+          if saved:
+            print(f"🌤️  {city_info['city']}: {saved} horas do OpenWeatherMap gravadas")
+        except Exception as e:
+          print(f"❌ Erro ao coletar OpenWeatherMap de {city_info['city']}: {e}")
       
-      await asyncio.sleep(1)  # Evita rate limit
+      await asyncio.sleep(COLLECT_DELAY_SECONDS)  # Evita rate limit
   
+    await alert_engine.flush_webhook(client)
+
+  get_latest_readings(CSV_FILE).flush()
   print(f"✅ Coleta concluída!\n")
 
+async def sync_openweather_history(client: httpx.AsyncClient, city_info: dict, now: Optional[float] = None) -> int:
+  """
+  Grava as horas do OpenWeatherMap que a cidade ainda não tem (até 24h para
+  trás). Só tenta de novo na hora seguinte. Retorna quantas linhas gravou.
+  """
+  now = now if now is not None else datetime.now(timezone.utc).timestamp()
+  current_hour = hour_start(now)
+  key = location_key(city_info["city"], city_info.get("state", ""), city_info.get("country", ""))
+  if _openweather_next_sync.get(key, 0) > now:
+    return 0
+
+  stored = []
+  if CSV_FILE.exists():
+    stored = get_history_index(CSV_FILE).epochs_for(
+      city_info["city"], OPENWEATHER_SOURCE, current_hour - 24 * 3600,
+      state=city_info.get("state", ""), country=city_info.get("country", "")
+    )
+  last_hour = max(stored, default=None)
+  _openweather_next_sync[key] = current_hour + 3600
+  if last_hour is not None and last_hour >= current_hour:
+    return 0
+
+  # Só lat/lon: servem também as coordenadas do arquivo de cidades ou da estação da IQAir
+  coords = (city_registry.get_coordinates(city_info["city"], city_info.get("state"), city_info.get("country"))
+            or await get_coordinates_from_city(client, city_info["city"], city_info.get("state"), city_info.get("country")))
+  if not coords:
+    return 0
+  start = int(last_hour) + 3600 if last_hour is not None else current_hour - 24 * 3600
+  points = await fetch_pollution_history(client, coords["lat"], coords["lon"], start, int(now))
+  return save_source_rows(openweather_rows(city_info, points))
+
+# --- Índice espacial ---
+# Reconstruído quando o registro muda (recarga ou coordenada nova)
+_spatial_cache: Dict[str, Any] = {"key": None, "index": None}
+
+def get_spatial_index() -> GridIndex:
+  key = (id(city_registry), city_registry.version)
+  if _spatial_cache["key"] != key:
+    points = [(e["lat"], e["lon"], e) for e in city_registry.all() if e["lat"] is not None and e["lon"] is not None]
+    _spatial_cache["index"] = GridIndex(points)
+    _spatial_cache["key"] = key
+  return _spatial_cache["index"]
+
+def spatial_result(entry: dict, latest, distance_km: Optional[float] = None) -> dict:
+  result = {
+    "city": entry["city"],
+    "state": entry["state"],
+    "country": entry["country"],
+    "lat": entry["lat"],
+    "lon": entry["lon"],
+    "latest": latest.get(entry["city"], entry["state"], entry["country"])
+  }
+  if distance_km is not None:
+    result["distance_km"] = round(distance_km, 2)
+  return result
+
+# --- Coletor líder (vários workers) ---
+# COLLECTOR_MODE: "auto" (padrão) elege um único coletor via lock de arquivo,
+# "always" coleta sempre (sem eleição), "off" apenas serve leituras.
+COLLECTOR_MODE = os.getenv("COLLECTOR_MODE", "auto")
+COLLECTOR_LOCK_FILE = Path(os.getenv("COLLECTOR_LOCK_FILE", f"coletor-{COLLECTOR_SHARD_INDEX}.lock"))
+
+collector_lock = LeaderLock(COLLECTOR_LOCK_FILE)
+
+def is_collector() -> bool:
+  """Indica se este processo deve coletar (tenta assumir a liderança se estiver livre)"""
+  if COLLECTOR_MODE == "off" or settings.read_only:
+    return False
+  if COLLECTOR_MODE == "always":
+    return True
+  return collector_lock.try_acquire()
+
 def scheduled_collection():
-  """Função para o scheduler (síncrona)"""
+  """Função para o scheduler (síncrona). Workers que não são líderes não coletam."""
+  if not is_collector():
+    return
   asyncio.run(collect_data_for_all_cities())
 
 # --- Lifespan: Gerencia startup e shutdown ---
@@ -156,26 +494,45 @@ def scheduled_collection():
 async def lifespan(app: FastAPI):
   """Gerencia o ciclo de vida da aplicação (startup e shutdown)"""
   # --- STARTUP ---
-  timeout = httpx.Timeout(30.0, connect=5.0)
-  app.state.http_client = httpx.AsyncClient(timeout=timeout)
-  
-  # Inicia o scheduler para coletar a cada 5 minutos
-  scheduler = BackgroundScheduler()
-  scheduler.add_job(scheduled_collection, 'interval', minutes=5, id='collect_data')
-  scheduler.start()
-  app.state.scheduler = scheduler
+  if CITIES_FROM_HISTORY:
+    reload_city_registry()
+  print(f"🏙️  {len(city_registry)} cidades no registro ({len(get_cities_to_collect())} neste coletor)")
+
+  ensure_csv_schema(CSV_FILE)
+  app.state.http_client = create_http_client()
+  reading_broker.start()
   
-  # Coleta inicial
-  await collect_data_for_all_cities()
+  # Inicia o scheduler para coletar a cada 5 minutos. Todos os workers agendam,
+  # mas só o líder coleta; se ele cair, outro assume no próximo ciclo.
+  if settings.read_only:
+    print(f"📖 Modo somente leitura: {settings.upstream_unavailable_reason()}")
+  elif COLLECTOR_MODE != "off":
+    from apscheduler.schedulers.background import BackgroundScheduler  # só quando há coleta
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(scheduled_collection, 'interval', minutes=5, id='collect_data')
+    scheduler.start()
+    app.state.scheduler = scheduler
   
-  print("✅ Scheduler iniciado! Coletando a cada 5 minutos...")
+  # Coleta inicial em segundo plano: o servidor já responde enquanto ela roda
+  if is_collector():
+    app.state.initial_collection = asyncio.create_task(collect_data_for_all_cities())
+    print("✅ Scheduler iniciado! Coletando a cada 5 minutos...")
+  elif not settings.read_only:
+    print(f"📖 Worker {os.getpid()} servindo apenas leituras (coletor: {COLLECTOR_LOCK_FILE})")
   
   yield  # Aplicação roda aqui
   
   # --- SHUTDOWN ---
+  initial_collection = getattr(app.state, 'initial_collection', None)
+  if initial_collection and not initial_collection.done():
+    initial_collection.cancel()
+  await reading_broker.stop()
   await app.state.http_client.aclose()
   if hasattr(app.state, 'scheduler'):
     app.state.scheduler.shutdown()
+  collector_lock.release()
+  get_latest_readings(CSV_FILE).flush()
+  shutdown_report_pool()
   print("🛑 Servidor encerrado")
 
 # --- Inicialização do FastAPI ---
@@ -185,6 +542,8 @@ app = FastAPI(
   version="2.0",
   lifespan=lifespan
 )
+# Mede cada handler como a etapa "endpoint" dos traces (ver profiling.py)
+app.router.route_class = TracedRoute
 
 # Adiciona CORS para liberar acesso ao frontend
 app.add_middleware(
@@ -193,14 +552,42 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Trace-Id", "X-Export-Rows"],
+)
+
+# --- Perfilamento por requisição ---
+# Header X-Profile: 1 (etapas) ou cpu (etapas + cProfile) força o trace da requisição.
+# PROFILE_SAMPLE_RATE: fração das requisições rastreadas sem o header (padrão: 0)
+# PROFILE_CPU_SAMPLE_RATE: fração das amostradas que também roda o cProfile
+# PROFILE_SLOW_MS: a partir de quanto tempo o trace amostrado é guardado em /debug/traces
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_CPU_SAMPLE_RATE = float(os.getenv("PROFILE_CPU_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_MAX_TRACES = int(os.getenv("PROFILE_MAX_TRACES", "100"))
+
+trace_store = TraceStore(PROFILE_MAX_TRACES)
+app.add_middleware(
+    ProfilingMiddleware,
+    store=trace_store,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    cpu_sample_rate=PROFILE_CPU_SAMPLE_RATE,
+    slow_ms=PROFILE_SLOW_MS,
+    exclude_paths=("/stream", "/debug/traces"),
 )
 
 # --- Funções Auxiliares ---
 
+@traced("geocode")
 async def get_coordinates_from_city(client: httpx.AsyncClient, city: str, state: Optional[str] = None, country: Optional[str] = None) -> Optional[Dict[str, float]]:
   """
   Converte nome de cidade em coordenadas usando a API de Geocoding do OpenWeatherMap.
+  A resposta (lat, lon e o nome/país como o geocoder os devolve, ex: "BR") fica
+  em cache no registro de cidades, então o formato é o mesmo com ou sem cache.
   """
+  cached = city_registry.get_geocoded(city, state, country)
+  if cached:
+    return cached
+
   try:
     # Monta a query de busca
     query = city
@@ -210,23 +597,25 @@ async def get_coordinates_from_city(client: httpx.AsyncClient, city: str, state:
       query += f",{country}"
 
     response = await client.get(
-      "https://api.openweathermap.org/geo/1.0/direct",
+      f"{OPENWEATHER_GEO_URL}direct",
       params={
         "q": query,
         "limit": 1,
-        "appid": OPENWEATHER_API_KEY
+        "appid": settings.openweather_api_key
       }
     )
     response.raise_for_status()
     data = response.json()
 
     if data and len(data) > 0:
-      return {
+      result = {
         "lat": data[0]["lat"],
         "lon": data[0]["lon"],
         "name": data[0].get("name", city),
         "country": data[0].get("country", "")
       }
+      city_registry.set_geocoded(city, state, country, result)
+      return result
     return None
   except Exception as e:
     print(f"Erro ao buscar coordenadas: {e}")
@@ -238,13 +627,38 @@ def get_24h_time_range() -> tuple[int, int]:
   past_24h = now_utc - timedelta(hours=24)
   return int(past_24h.timestamp()), int(now_utc.timestamp())
 
-async def get_24h_pollution_data(client: httpx.AsyncClient, lat: float, lon: float) -> List[Dict[str, Any]]:
+@traced("pollution.format")
+def format_pollution_history(data: Dict[str, Any]) -> List[Dict[str, Any]]:
   """
-  Busca dados históricos de poluição das últimas 24h usando OpenWeatherMap.
+  Converte a resposta de air_pollution/history em lista de pontos, já com os
+  índices AQI US e IQAr (CONAMA) calculados para a série inteira.
   """
-  start, end = get_24h_time_range()
+  formatted_results = []
+  for item in data.get("list", []):
+    dt = item.get("dt")
+    timestamp = datetime.fromtimestamp(dt, tz=timezone.utc).isoformat()
+    components = item.get("components", {})
+    aqi = item.get("main", {}).get("aqi")
 
-  try:
+    formatted_results.append({
+      "timestamp": timestamp,
+      "pm25": components.get("pm2_5"),
+      "pm10": components.get("pm10"),
+      "aqi": aqi,
+      "co": components.get("co"),
+      "no2": components.get("no2"),
+      "o3": components.get("o3"),
+      "so2": components.get("so2")
+    })
+
+  from aqi import enrich_pollution_series  # numpy só é carregado quando necessário
+  return enrich_pollution_series(formatted_results)
+
+async def fetch_pollution_history(client: httpx.AsyncClient, lat: float, lon: float, start: int, end: int) -> List[Dict[str, Any]]:
+  """
+  Busca dados históricos de poluição no intervalo [start, end] (Unix timestamp) no OpenWeatherMap.
+  """
+  with span("upstream.openweather"):
     response = await client.get(
       f"{OPENWEATHER_API_URL}air_pollution/history",
       params={
@@ -252,31 +666,21 @@ async def get_24h_pollution_data(client: httpx.AsyncClient, lat: float, lon: flo
         "lon": lon,
         "start": start,
         "end": end,
-        "appid": OPENWEATHER_API_KEY
+        "appid": settings.openweather_api_key
       }
     )
     response.raise_for_status()
     data = response.json()
+  return format_pollution_history(data)
 
-    formatted_results = []
-    for item in data.get("list", []):
-      dt = item.get("dt")
-      timestamp = datetime.fromtimestamp(dt, tz=timezone.utc).isoformat()
-      components = item.get("components", {})
-      aqi = item.get("main", {}).get("aqi")
-
-      formatted_results.append({
-        "timestamp": timestamp,
-        "pm25": components.get("pm2_5"),
-        "pm10": components.get("pm10"),
-        "aqi": aqi,
-        "co": components.get("co"),
-        "no2": components.get("no2"),
-        "o3": components.get("o3"),
-        "so2": components.get("so2")
-      })
-
-    return formatted_results
+async def get_24h_pollution_data(client: httpx.AsyncClient, lat: float, lon: float) -> List[Dict[str, Any]]:
+  """
+  Busca dados históricos de poluição das últimas 24h usando OpenWeatherMap.
+  """
+  start, end = get_24h_time_range()
+
+  try:
+    return await fetch_pollution_history(client, lat, lon, start, end)
   except httpx.HTTPStatusError as e:
     raise HTTPException(
       status_code=e.response.status_code,
@@ -297,6 +701,7 @@ async def root():
       "openweathermap": "Dados históricos 24h (PM2.5, PM10, AQI, poluentes)"
     },
     "docs": "/docs",
+    "read_only": settings.read_only,
     "endpoints": {
       "current": "/cities/{city}/current",
       "history": "/cities/{city}/pm25/24h"
@@ -305,12 +710,12 @@ async def root():
 
 # --- Parte 1: Endpoints Auxiliares (IQAir) ---
 
-@app.get("/countries", response_model=List[CountryResponse], summary="Lista países disponíveis (IQAir)")
+@app.get("/countries", response_model=List[CountryResponse], summary="Lista países disponíveis (IQAir)", dependencies=[Depends(require_upstream)])
 async def get_countries(request: Request):
   """Lista todos os países disponíveis na API da IQAir."""
   client = request.app.state.http_client
   try:
-    response = await client.get(f"{IQAIR_API_URL}countries", params=IQAIR_PARAMS)
+    response = await client.get(f"{IQAIR_API_URL}countries", params=settings.iqair_params)
     response.raise_for_status()
     data = response.json()
     if data.get("status") != "success":
@@ -319,14 +724,14 @@ async def get_countries(request: Request):
   except httpx.HTTPStatusError as e:
     raise HTTPException(status_code=e.response.status_code, detail=f"Erro da API IQAir: {e.response.text}")
 
-@app.get("/states", response_model=List[StateResponse], summary="Lista estados de um país (IQAir)")
+@app.get("/states", response_model=List[StateResponse], summary="Lista estados de um país (IQAir)", dependencies=[Depends(require_upstream)])
 async def get_states(
     country: str = Query(..., description="Nome do país (ex: 'Brazil')"),
     request: Request = None
 ):
   """Lista todos os estados de um país específico."""
   client = request.app.state.http_client
-  params = {**IQAIR_PARAMS, "country": country}
+  params = {**settings.iqair_params, "country": country}
   try:
     response = await client.get(f"{IQAIR_API_URL}states", params=params)
     response.raise_for_status()
@@ -337,7 +742,7 @@ async def get_states(
   except httpx.HTTPStatusError as e:
     raise HTTPException(status_code=e.response.status_code, detail=f"Erro da API IQAir: {e.response.text}")
 
-@app.get("/cities", response_model=List[CityResponse], summary="Lista cidades de um estado (IQAir)")
+@app.get("/cities", response_model=List[CityResponse], summary="Lista cidades de um estado (IQAir)", dependencies=[Depends(require_upstream)])
 async def get_cities(
     state: str = Query(..., description="Nome do estado (ex: 'Sao Paulo')"),
     country: str = Query(..., description="Nome do país (ex: 'Brazil')"),
@@ -345,7 +750,7 @@ async def get_cities(
 ):
   """Lista todas as cidades de um estado e país específicos."""
   client = request.app.state.http_client
-  params = {**IQAIR_PARAMS, "state": state, "country": country}
+  params = {**settings.iqair_params, "state": state, "country": country}
   try:
     response = await client.get(f"{IQAIR_API_URL}cities", params=params)
     response.raise_for_status()
@@ -358,7 +763,7 @@ async def get_cities(
 
 # --- Parte 2: Endpoints de Dados ---
 
-@app.get("/cities/{city}/current", response_model=CurrentDataResponse, summary="Dados atuais de uma cidade (IQAir)")
+@app.get("/cities/{city}/current", response_model=CurrentDataResponse, summary="Dados atuais de uma cidade (IQAir)", dependencies=[Depends(require_upstream)])
 async def get_current_data(
     city: str,
     state: str = Query(..., description="Nome do estado (ex: 'Sao Paulo')"),
@@ -370,12 +775,13 @@ async def get_current_data(
   Também salva os dados no CSV para histórico.
   """
   client = request.app.state.http_client
-  params = {**IQAIR_PARAMS, "city": city, "state": state, "country": country}
+  params = {**settings.iqair_params, "city": city, "state": state, "country": country}
 
   try:
-    response = await client.get(f"{IQAIR_API_URL}city", params=params)
-    response.raise_for_status()
-    data = response.json()
+    with span("upstream.iqair"):
+      response = await client.get(f"{IQAIR_API_URL}city", params=params)
+      response.raise_for_status()
+      data = response.json()
 
     if data.get("status") != "success":
       raise HTTPException(
@@ -410,8 +816,10 @@ async def get_current_data(
     }
     save_to_csv(csv_data)
 
+    from aqi import epa_category
     return CurrentDataResponse(
       pm25=pm25_value,
+      category=epa_category(pm25_value),
       temperature=weather.get("tp"),
       humidity=weather.get("hu"),
       timestamp=weather.get("ts"),
@@ -422,7 +830,7 @@ async def get_current_data(
   except Exception as e:
     raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
 
-@app.get("/cities/{city}/pm25/24h", response_model=List[PM25Response], summary="Histórico de PM2.5 das últimas 24h (OpenWeatherMap)")
+@app.get("/cities/{city}/pm25/24h", response_model=List[PM25Response], summary="Histórico de PM2.5 das últimas 24h (OpenWeatherMap)", dependencies=[Depends(require_upstream)])
 async def get_pm25_24h(
     city: str,
     request: Request,
@@ -451,12 +859,14 @@ async def get_pm25_24h(
       timestamp=item["timestamp"],
       value=item["pm25"],
       pm25=item["pm25"],
-      aqi=item["aqi"]
+      aqi=item["aqi"],
+      aqi_us=item["aqi_us"],
+      category=item["aqi_us_category"]
     )
     for item in pollution_data
   ]
 
-@app.get("/cities/{city}/pollution/24h", summary="Histórico completo de poluição 24h (OpenWeatherMap)")
+@app.get("/cities/{city}/pollution/24h", summary="Histórico completo de poluição 24h (OpenWeatherMap)", dependencies=[Depends(require_upstream)])
 async def get_pollution_24h(
     city: str,
     request: Request,
@@ -487,7 +897,7 @@ async def get_pollution_24h(
     "data": pollution_data
   }
 
-@app.get("/geocode", summary="Converte cidade em coordenadas")
+@app.get("/geocode", summary="Converte cidade em coordenadas", dependencies=[Depends(require_upstream)])
 async def geocode_city(
     city: str = Query(..., description="Nome da cidade"),
     state: Optional[str] = Query(None, description="Nome do estado"),
@@ -509,7 +919,7 @@ async def geocode_city(
 
   return coords
 
-@app.get("/debug/raw/{city}", summary="[DEBUG] Ver resposta completa da API IQAir")
+@app.get("/debug/raw/{city}", summary="[DEBUG] Ver resposta completa da API IQAir", dependencies=[Depends(require_upstream)])
 async def debug_iqair_response(
     city: str,
     state: str = Query(..., description="Nome do estado"),
@@ -521,7 +931,7 @@ async def debug_iqair_response(
   Use para entender como os dados são retornados.
   """
   client = request.app.state.http_client
-  params = {**IQAIR_PARAMS, "city": city, "state": state, "country": country}
+  params = {**settings.iqair_params, "city": city, "state": state, "country": country}
   
   try:
     response = await client.get(f"{IQAIR_API_URL}city", params=params)
@@ -531,46 +941,557 @@ async def debug_iqair_response(
   except Exception as e:
     return {"error": str(e)}
 
+@app.get("/debug/traces", summary="[DEBUG] Traces das requisições lentas (perfilamento)")
+async def get_debug_traces(
+    limit: int = Query(20, ge=1, le=500, description="Máximo de traces"),
+    min_ms: Optional[float] = Query(None, description="Só traces com duração total >= min_ms"),
+    path: Optional[str] = Query(None, description="Filtra pelo início do caminho (ex: /cities)")
+):
+  """
+  Traces mais recentes primeiro, com a duração de cada etapa (geocode,
+  upstream.*, csv.*, serialize...). Use `/debug/traces/{id}` para o perfil de CPU.
+  """
+  traces = trace_store.list(limit, min_ms, path)
+  return {
+    "sample_rate": PROFILE_SAMPLE_RATE,
+    "cpu_sample_rate": PROFILE_CPU_SAMPLE_RATE,
+    "slow_ms": PROFILE_SLOW_MS,
+    "recorded": trace_store.recorded,
+    "total": len(traces),
+    "traces": [t.to_dict() for t in traces]
+  }
+
+@app.get("/debug/traces/{trace_id}", summary="[DEBUG] Trace completo (com perfil de CPU, se houver)")
+async def get_debug_trace(trace_id: str):
+  trace = trace_store.get(trace_id)
+  if trace is None:
+    raise HTTPException(status_code=404, detail=f"Trace '{trace_id}' não encontrado")
+  return trace.to_dict(include_profile=True)
+
+@app.get("/registry/cities", summary="Cidades do registro de coleta")
+async def get_registry_cities(
+    state: Optional[str] = Query(None, description="Filtra por estado"),
+    country: Optional[str] = Query(None, description="Filtra por país")
+):
+  """
+  Lista as cidades monitoradas pelo coletor (com coordenadas em cache, se houver).
+  """
+  if city_registry.has_changed():
+    reload_city_registry()
+
+  entries = city_registry.all()
+  if state:
+    entries = [e for e in entries if normalize_city_key(e["state"]) == normalize_city_key(state)]
+  if country:
+    entries = [e for e in entries if normalize_city_key(e["country"]) == normalize_city_key(country)]
+
+  return {
+    "total": len(entries),
+    "shard": {"index": COLLECTOR_SHARD_INDEX, "count": COLLECTOR_SHARD_COUNT},
+    "cities": entries
+  }
+
+@app.post("/registry/reload", summary="Recarrega o registro de cidades sem reiniciar")
+async def post_registry_reload():
+  """Relê CITIES_FILE (e o histórico, se habilitado) e reconstrói o índice."""
+  total = reload_city_registry()
+  return {"total": total, "collecting": len(get_cities_to_collect())}
+
+@app.get("/collector/status", summary="Estado do coletor neste worker")
+async def get_collector_status():
+  """Mostra se este processo é o coletor líder (útil com vários workers)."""
+  return {
+    "pid": os.getpid(),
+    "mode": COLLECTOR_MODE,
+    "leader": COLLECTOR_MODE == "always" or collector_lock.is_leader,
+    "lock_file": str(COLLECTOR_LOCK_FILE),
+    "shard": {"index": COLLECTOR_SHARD_INDEX, "count": COLLECTOR_SHARD_COUNT}
+  }
+
+@app.get("/storage/status", summary="Integridade do histórico (WAL, linhas ignoradas, consultas pesadas)")
+async def get_storage_status():
+  """
+  Contadores da gravação com WAL (registros recuperados/corrompidos, bytes de
+  linha parcial cortados), linhas do CSV ignoradas pelo índice e o estado do
+  pool de consultas pesadas.
+  """
+  index = get_history_index(CSV_FILE)
+  return {
+    "csv_file": str(CSV_FILE),
+    "size_bytes": index.indexed_size,
+    "rows": index.total_rows,
+    "skipped_rows": index.skipped_rows,
+    "ingest": get_ingest_log(CSV_FILE, fsync=INGEST_FSYNC).stats(),
+    "queries": query_offloader.stats()
+  }
+
 @app.get("/cities/{city}/history", summary="Histórico coletado automaticamente (CSV)")
 async def get_history_from_csv(
     city: str,
-    hours: int = Query(24, description="Últimas X horas de dados (padrão: 24h)")
+    request: Request,
+    hours: int = Query(24, description="Últimas X horas de dados (padrão: 24h)"),
+    since: Optional[str] = Query(None, description="Cursor: retorna apenas leituras após este timestamp ISO")
 ):
   """
   Retorna dados históricos coletados automaticamente pelo scheduler.
   Os dados são salvos a cada 5 minutos no arquivo CSV.
+  Suporta `since` (apenas linhas novas) e ETag/If-None-Match (304 se nada mudou).
   """
-  data = read_from_csv(city=city, hours=hours)
+  since_epoch = parse_timestamp_param(since)
+  etag, latest_timestamp = history_window_state(city, hours, since_epoch)
+  if etag_matches(request, etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+  fieldnames, offsets = history_offsets(city, hours, since_epoch)
   
-  if not data:
+  if not offsets and since_epoch is None:
     raise HTTPException(
       status_code=404,
       detail=f"Nenhum dado encontrado para '{city}' nas últimas {hours} horas"
     )
-  
+
+  # Leitura e serialização no pool, em lotes (o event loop segue livre)
+  with offload_errors(), span("csv.read", rows=len(offsets)):
+    chunks = await query_offloader.run_chunked(request.receive, render_rows_json, str(CSV_FILE), fieldnames, offsets)
+
+  body = json_with_rows({
+    "city": city,
+    "hours": hours,
+    "since": since,
+    "latest_timestamp": latest_timestamp or since,
+    "total_records": len(offsets)
+  }, [fragment for fragment, _ in chunks])
+  return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@app.get("/cities/{city}/timeline", summary="Série horária combinada (IQAir + OpenWeatherMap) do histórico")
+async def get_city_timeline(
+    city: str,
+    request: Request,
+    hours: int = Query(24, ge=1, le=24 * 31, description="Últimas X horas (padrão: 24h)")
+):
+  """
+  Uma entrada por hora com as leituras gravadas das duas fontes alinhadas:
+  AQI (IQAir, ou o calculado do OpenWeatherMap quando não há leitura da IQAir
+  na hora), concentração de PM2.5 (OpenWeatherMap), temperatura e umidade
+  (IQAir), além dos valores de cada fonte. Consulta só o histórico local.
+  """
+  if not CSV_FILE.exists():
+    raise HTTPException(status_code=404, detail="Nenhum dado coletado ainda")
+
+  now = datetime.now(timezone.utc).timestamp()
+  start = hour_start(now) - (hours - 1) * 3600
+  index = get_history_index(CSV_FILE)
+  by_source = {source: index.offsets_for(city, since_epoch=start, source=source) for source in TIMELINE_SOURCES}
+  offsets = sorted(o for source_offsets in by_source.values() for o in source_offsets)
+  if not offsets:
+    raise HTTPException(status_code=404, detail=f"Nenhum dado encontrado para '{city}' nas últimas {hours} horas")
+
+  with offload_errors(), span("timeline.fuse", rows=len(offsets)):
+    points = await query_offloader.run(
+      request.receive, timeline_from_csv, str(CSV_FILE), index.fieldnames, offsets, start, now, rows=len(offsets)
+    )
+
+  location = next(index.read_rows(offsets[-1:]), {})
   return {
     "city": city,
+    "state": location.get("state"),
+    "country": location.get("country"),
     "hours": hours,
-    "total_records": len(data),
-    "data": data
+    "sources": {source: len(source_offsets) for source, source_offsets in by_source.items()},
+    "total_hours": len(points),
+    "data": points
   }
 
+@app.get("/stream", summary="Push de novas leituras (Server-Sent Events)")
+async def stream_new_readings(
+    request: Request,
+    cities: Optional[str] = Query(None, description="Cidades separadas por vírgula (padrão: todas)"),
+    since: Optional[str] = Query(None, description="Reenvia leituras a partir deste timestamp ISO antes do tempo real"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+  """
+  Mantém a conexão aberta e envia cada nova leitura salva no histórico
+  (evento `reading`, id = arquivo e posição da linha). Ao reconectar, o
+  navegador envia `Last-Event-ID` e recebe apenas o que perdeu; se o histórico
+  foi reescrito nesse meio tempo, recebe um evento `reset`.
+  """
+  city_list = [c.strip() for c in cities.split(",") if c.strip()] if cities else None
+  since_epoch = parse_timestamp_param(since)
+
+  return StreamingResponse(
+    stream_readings(reading_broker, request.is_disconnected, city_list, since_epoch, last_event_id),
+    media_type="text/event-stream",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+  )
+
 @app.get("/history/all", summary="Todo histórico coletado (todas as cidades)")
 async def get_all_history(
-    hours: int = Query(24, description="Últimas X horas de dados (padrão: 24h)")
+    request: Request,
+    hours: int = Query(24, description="Últimas X horas de dados (padrão: 24h)"),
+    since: Optional[str] = Query(None, description="Cursor: retorna apenas leituras após este timestamp ISO")
 ):
   """
   Retorna todos os dados coletados de todas as cidades.
+  Suporta `since` (apenas linhas novas) e ETag/If-None-Match (304 se nada mudou).
   """
-  data = read_from_csv(city=None, hours=hours)
-  
+  since_epoch = parse_timestamp_param(since)
+  etag, latest_timestamp = history_window_state(None, hours, since_epoch)
+  if etag_matches(request, etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+  fieldnames, offsets = history_offsets(None, hours, since_epoch)
+  with offload_errors(), span("csv.read", rows=len(offsets)):
+    chunks = await query_offloader.run_chunked(request.receive, render_rows_json, str(CSV_FILE), fieldnames, offsets)
+
+  body = json_with_rows({
+    "hours": hours,
+    "since": since,
+    "latest_timestamp": latest_timestamp or since,
+    "total_records": len(offsets),
+    "cities": sorted({city for _, cities in chunks for city in cities})
+  }, [fragment for fragment, _ in chunks])
+  return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@app.get("/anomalies", summary="Leituras suspeitas detectadas na ingestão")
+async def get_anomalies(
+    city: Optional[str] = Query(None, description="Filtra por cidade"),
+    kind: Optional[str] = Query(None, description="spike, stuck, missing ou out_of_range"),
+    limit: int = Query(100, ge=1, le=1000, description="Máximo de registros (mais recentes primeiro)")
+):
+  """
+  Anomalias registradas na gravação (valores vazios, impossíveis, picos e
+  sensores travados), lidas do final do registro, sem reler o histórico.
+  Com ANOMALY_MODE=quarantine, `quarantined` indica leituras que não foram gravadas.
+  """
+  entries = read_anomalies(anomalies_path_for(CSV_FILE), city, kind, limit)
+  return {
+    "mode": anomaly_detector.mode,
+    "counts": anomaly_detector.counts,
+    "total": len(entries),
+    "data": entries
+  }
+
+@app.get("/alerts", summary="Alertas ativos")
+async def get_alerts(
+    city: Optional[str] = Query(None, description="Filtra por cidade"),
+    include_pending: bool = Query(False, description="Inclui condições ainda dentro da duração mínima")
+):
+  """Alertas disparados e ainda não resolvidos (avaliados a cada leitura gravada)."""
+  alerts = alert_engine.active_alerts(city, include_pending)
+  return {"total": len(alerts), "data": alerts}
+
+@app.get("/alerts/events", summary="Histórico de disparos e resoluções de alertas")
+async def get_alert_events(
+    city: Optional[str] = Query(None, description="Filtra por cidade"),
+    limit: int = Query(100, ge=1, le=1000, description="Máximo de eventos (mais recentes primeiro)")
+):
+  city_key = normalize_city_key(city) if city else None
+  events = [e for e in tail_jsonl(alerts_path_for(CSV_FILE)) if not city_key or normalize_city_key(e.get("city")) == city_key]
+  return {
+    "total": len(events[:limit]),
+    "webhook": {"url": ALERT_WEBHOOK_URL, "pending": len(alert_engine.outbox), "delivered": alert_engine.delivered},
+    "data": events[:limit]
+  }
+
+@app.get("/alerts/rules", summary="Regras de alerta registradas")
+async def get_alert_rules():
+  alert_engine.reload_rules_if_changed()
+  return {"total": len(alert_engine.rules), "rules": list(alert_engine.rules.values())}
+
+@app.post("/alerts/rules", summary="Registra (ou substitui) uma regra de alerta")
+async def post_alert_rule(rule: AlertRuleRequest):
+  """
+  Ex: {"field": "aqi", "op": ">", "threshold": 150, "clear_threshold": 130,
+  "duration_minutes": 120} dispara quando o AQI passa de 150 por 2 horas e só
+  resolve quando cai abaixo de 130.
+  """
+  alert_engine.reload_rules_if_changed()
+  try:
+    created = alert_engine.add_rule(rule.model_dump())
+  except ValueError as e:
+    raise HTTPException(status_code=422, detail=str(e))
+  alert_engine.save_rules()
+  return created
+
+@app.delete("/alerts/rules/{rule_id}", summary="Remove uma regra de alerta")
+async def delete_alert_rule(rule_id: str):
+  alert_engine.reload_rules_if_changed()
+  if not alert_engine.remove_rule(rule_id):
+    raise HTTPException(status_code=404, detail=f"Regra '{rule_id}' não encontrada")
+  alert_engine.save_rules()
+  return {"deleted": rule_id}
+
+@app.get("/latest", summary="Última leitura de cada cidade")
+async def get_latest(
+    cities: Optional[str] = Query(None, description="Cidades separadas por vírgula (padrão: todas)")
+):
+  """
+  Retorna a leitura mais recente de cada cidade a partir do mapa mantido na
+  gravação, sem varrer o histórico.
+  """
+  from aqi import with_aqi_category
+  latest = latest_readings_map()
+  if cities:
+    readings = [r for c in cities.split(",") if c.strip() for r in latest.find(c.strip())]
+  else:
+    readings = latest.all()
+  return {"total_cities": len(readings), "data": with_aqi_category(readings)}
+
+@app.get("/latest/{city}", summary="Última leitura de uma cidade")
+async def get_latest_city(
+    city: str,
+    state: Optional[str] = Query(None, description="Estado (distingue cidades homônimas)"),
+    country: Optional[str] = Query(None, description="País (distingue cidades homônimas)")
+):
+  """Leitura mais recente da cidade (lookup O(1) no mapa de últimas leituras)."""
+  readings = latest_readings_map().find(city, state, country)
+  if not readings:
+    raise HTTPException(status_code=404, detail=f"Nenhuma leitura encontrada para '{city}'")
+  if len(readings) > 1:
+    places = ", ".join(f"{r.get('state')}/{r.get('country')}" for r in readings)
+    raise HTTPException(status_code=409, detail=f"Há mais de uma cidade '{city}' ({places}): informe state/country")
+  from aqi import with_aqi_category
+  return with_aqi_category(readings)[0]
+
+@app.get("/nearby", summary="Cidades monitoradas mais próximas de um ponto")
+async def get_nearby(
+    lat: float = Query(..., ge=-90, le=90, description="Latitude do ponto"),
+    lon: float = Query(..., ge=-180, le=180, description="Longitude do ponto"),
+    k: int = Query(5, ge=1, le=100, description="Quantidade de cidades"),
+    max_km: Optional[float] = Query(None, gt=0, description="Distância máxima em km")
+):
+  """
+  As k cidades do registro (com coordenadas conhecidas) mais próximas do ponto,
+  com a distância em km e a última leitura de cada uma.
+  """
+  latest = latest_readings_map()
+  nearest = get_spatial_index().nearest(lat, lon, k, max_km)
+  return {
+    "lat": lat,
+    "lon": lon,
+    "total": len(nearest),
+    "data": [spatial_result(entry, latest, distance) for distance, entry in nearest]
+  }
+
+@app.get("/bbox", summary="Cidades monitoradas dentro de uma área (mapa)")
+async def get_bbox(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lon: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lon: float = Query(..., ge=-180, le=180),
+    limit: int = Query(1000, ge=1, le=50000, description="Máximo de cidades retornadas")
+):
+  """
+  Cidades com coordenadas dentro da caixa, com a última leitura de cada uma.
+  `min_lon` maior que `max_lon` indica uma área que cruza o antimeridiano.
+  """
+  if min_lat > max_lat:
+    raise HTTPException(status_code=422, detail="min_lat deve ser menor ou igual a max_lat")
+
+  latest = latest_readings_map()
+  entries = get_spatial_index().within_bbox(min_lat, min_lon, max_lat, max_lon, limit)
+  return {
+    "total": len(entries),
+    "data": [spatial_result(entry, latest) for entry in entries]
+  }
+
+COMPARISON_METRICS = ["aqi", "pm25", "temperature", "humidity"]
+
+@app.get("/comparison", summary="Comparação entre cidades (última leitura + estatísticas da janela)")
+async def get_comparison(
+    request: Request,
+    hours: int = Query(1, description="Janela das estatísticas em horas (padrão: 1h)"),
+    metric: str = Query("aqi", description="Métrica comparada: aqi, pm25, temperature ou humidity")
+):
+  """
+  Para cada cidade: leitura mais recente, média, máximo e tendência da métrica
+  na janela, calculados numa única passada agrupada. O tamanho da resposta
+  depende do número de cidades, não do número de linhas.
+  """
+  if metric not in COMPARISON_METRICS:
+    raise HTTPException(status_code=422, detail=f"Métrica inválida: '{metric}' (use {', '.join(COMPARISON_METRICS)})")
+
+  fieldnames, offsets = history_offsets(None, hours)
+  with offload_errors(), span("comparison.aggregate", rows=len(offsets)):
+    cities = await query_offloader.run(request.receive, compare_from_csv, str(CSV_FILE), fieldnames, offsets, metric,
+                                       rows=len(offsets))
   return {
     "hours": hours,
-    "total_records": len(data),
-    "cities": list(set([row['city'] for row in data])),
-    "data": data
+    "metric": metric,
+    "total_cities": len(cities),
+    "cities": cities
   }
 
+# Relatórios gerados ficam em cache até chegar leitura nova no CSV
+report_cache = ReportCache()
+
+@app.get("/reports", summary="Relatório consolidado das cidades (JSON, CSV ou PDF)")
+async def get_report(
+    request: Request,
+    cities: Optional[str] = Query(None, description="Cidades separadas por vírgula (padrão: todas)"),
+    hours: int = Query(24, description="Últimas X horas de dados (padrão: 24h)"),
+    fmt: str = Query("json", alias="format", description="json, csv ou pdf"),
+    threshold: float = Query(DEFAULT_EXCEEDANCE_AQI, description="AQI acima do qual a hora conta como excedida")
+):
+  """
+  Resume o histórico por cidade (médias diárias, horas acima do limite, piores
+  horários) com ranking entre cidades. A janela começa numa hora cheia; o
+  relatório é gerado num pool de processos e reaproveitado do cache enquanto não
+  houver leitura nova nem a janela avançar para a hora seguinte.
+  """
+  fmt = fmt.lower()
+  if fmt not in REPORT_FORMATS:
+    raise HTTPException(status_code=422, detail=f"Formato inválido: '{fmt}' (use {', '.join(REPORT_FORMATS)})")
+  if not CSV_FILE.exists():
+    raise HTTPException(status_code=404, detail="Nenhum dado coletado ainda")
+
+  city_list = [c.strip() for c in cities.split(",") if c.strip()] if cities else None
+  index = get_history_index(CSV_FILE)
+  version = (str(CSV_FILE), index.indexed_size)
+  # Com o início da janela na chave, leituras que saem da janela invalidam o cache
+  since = hour_start(history_window_start(hours))
+  city_keys = tuple(sorted({normalize_city_key(c) for c in city_list})) if city_list else ("*",)
+  cache_key = (city_keys, hours, since, fmt, threshold)
+
+  artifact = report_cache.get(cache_key, version)
+  cache_status = "hit"
+  if artifact is None:
+    cache_status = "miss"
+    if city_list:
+      offsets = sorted({o for c in city_list for o in index.offsets_for(c, since_epoch=since)})
+    else:
+      offsets = index.offsets_for(None, since_epoch=since)
+    if not offsets:
+      raise HTTPException(status_code=404, detail=f"Nenhum dado encontrado nas últimas {hours} horas")
+
+    with offload_errors(), span("report.build", rows=len(offsets)):
+      artifact = await query_offloader.run(
+        request.receive, build_report, str(CSV_FILE), index.fieldnames, offsets, hours, fmt, threshold
+      )
+    report_cache.put(cache_key, version, artifact)
+
+  headers = {"X-Report-Cache": cache_status}
+  if fmt != "json":
+    headers["Content-Disposition"] = f'attachment; filename="relatorio_qualidade_ar_{hours}h.{fmt}"'
+  return Response(content=artifact, media_type=REPORT_FORMATS[fmt], headers=headers)
+
+@app.get("/export", summary="Exporta o histórico em Parquet ou Arrow IPC (análise)")
+async def export_history(
+    request: Request,
+    fmt: str = Query("parquet", alias="format", description="parquet ou arrow"),
+    cities: Optional[str] = Query(None, description="Cidades separadas por vírgula (padrão: todas)"),
+    start: Optional[str] = Query(None, description="Início do intervalo (ISO 8601, inclusivo; padrão: todo o histórico)"),
+    end: Optional[str] = Query(None, description="Fim do intervalo (ISO 8601, exclusivo; padrão: agora)"),
+    source: str = Query("all", description="iqair, openweather ou all"),
+    columns: Optional[str] = Query(None, description="Colunas separadas por vírgula (padrão: todas)")
+):
+  """
+  Arquivo colunar com as leituras do histórico, para pandas/polars/duckdb.
+  Cidade, fonte e intervalo são filtrados pelo índice antes de ler o CSV; o
+  arquivo é gerado no pool de processos e sai ordenado por cidade e tempo.
+  """
+  fmt = fmt.lower()
+  if fmt not in EXPORT_FORMATS:
+    raise HTTPException(status_code=422, detail=f"Formato inválido: '{fmt}' (use {', '.join(EXPORT_FORMATS)})")
+  sources = TIMELINE_SOURCES if source == "all" else [source]
+  if source != "all" and source not in TIMELINE_SOURCES:
+    raise HTTPException(status_code=422, detail=f"Fonte inválida: '{source}' (use {', '.join(TIMELINE_SOURCES)} ou all)")
+  column_list = [c.strip() for c in columns.split(",") if c.strip()] if columns else EXPORT_COLUMNS
+  unknown = [c for c in column_list if c not in EXPORT_COLUMNS]
+  if unknown:
+    raise HTTPException(status_code=422, detail=f"Colunas inválidas: {', '.join(unknown)} (use {', '.join(EXPORT_COLUMNS)})")
+  start_epoch, end_epoch = parse_timestamp_param(start), parse_timestamp_param(end)
+  if start_epoch is not None and end_epoch is not None and start_epoch >= end_epoch:
+    raise HTTPException(status_code=422, detail="O início do intervalo deve ser anterior ao fim")
+  if not pyarrow_available():
+    raise HTTPException(status_code=501, detail="Exportação colunar indisponível: instale o pyarrow no backend")
+  if not CSV_FILE.exists():
+    raise HTTPException(status_code=404, detail="Nenhum dado coletado ainda")
+
+  city_list = [c.strip() for c in cities.split(",") if c.strip()] if cities else [None]
+  index = get_history_index(CSV_FILE)
+  offsets = sorted({
+    o for c in city_list for s in sources
+    for o in index.offsets_for(c, since_epoch=start_epoch, source=s, until_epoch=end_epoch)
+  })
+  if not offsets:
+    raise HTTPException(status_code=404, detail="Nenhum dado encontrado com esses filtros")
+
+  # Sempre no pool (até exportações pequenas convertem e comprimem o arquivo).
+  # O worker cria o arquivo temporário; se o cliente desistir com ele ainda
+  # rodando, o arquivo é apagado quando a tarefa termina
+  with offload_errors(), span("export.write", rows=len(offsets), format=fmt):
+    out_path, rows = await query_offloader.run(
+      request.receive, export_from_csv, str(CSV_FILE), index.fieldnames, offsets, fmt, column_list,
+      discard=remove_export
+    )
+
+  return FileResponse(
+    out_path,
+    media_type=EXPORT_FORMATS[fmt],
+    filename=f"historico_qualidade_ar.{fmt}",
+    headers={"X-Export-Rows": str(rows)},
+    background=BackgroundTask(os.unlink, out_path)
+  )
+
+# Modelos de previsão ajustados, por (arquivo, geração do índice, cidade, métrica)
+forecast_cache = ForecastCache()
+
+@app.get("/cities/{city}/forecast", summary="Previsão das próximas horas (AQI)")
+async def get_city_forecast(
+    city: str,
+    request: Request,
+    horizon: int = Query(6, ge=1, le=48, description="Horas à frente (padrão: 6h)"),
+    metric: str = Query("aqi", description="Métrica prevista: aqi ou pm25")
+):
+  """
+  Previsão horária a partir do histórico coletado (últimos 7 dias), com os
+  modelos sazonal ingênuo e suavização exponencial; `value` usa o que errou
+  menos nas horas já observadas. O ajuste inicial roda no pool de processos e
+  as consultas seguintes só incorporam as leituras novas.
+  """
+  if metric not in FORECAST_METRICS:
+    raise HTTPException(status_code=422, detail=f"Métrica inválida: '{metric}' (use {', '.join(FORECAST_METRICS)})")
+  if not CSV_FILE.exists():
+    raise HTTPException(status_code=404, detail="Nenhum dado coletado ainda")
+
+  index = get_history_index(CSV_FILE)
+  city_key = normalize_city_key(city)
+  cache_key = (str(CSV_FILE), index.generation, city_key, metric)
+  now = datetime.now(timezone.utc).timestamp()
+
+  model = forecast_cache.get(cache_key)
+  if model is None:
+    cache_status = "fit"
+    offsets = index.offsets_for(city, since_epoch=now - HISTORY_HOURS * 3600)
+    if not offsets:
+      raise HTTPException(status_code=404, detail=f"Nenhum dado encontrado para '{city}'")
+    with offload_errors(), span("forecast.fit", rows=len(offsets)):
+      models = await query_offloader.run(
+        request.receive, fit_models_from_csv, str(CSV_FILE), index.fieldnames, {city_key: offsets}, metric, now
+      )
+    model = models[city_key]
+    forecast_cache.put(cache_key, model)
+  else:
+    since_hour = model.pending_hour or model.last_hour or 0
+    new_offsets = [o for o in index.offsets_for(city, since_epoch=since_hour) if o > model.last_offset]
+    cache_status = "incremental" if new_offsets else "hit"
+    model.add_rows(index.read_rows_at(new_offsets))
+    model.close_pending(now)
+
+  if not model.hours:
+    raise HTTPException(status_code=404, detail=f"Histórico insuficiente para prever '{city}' (nenhuma hora completa)")
+
+  return JSONResponse(
+    content={"city": city, "metric": metric, "horizon_hours": horizon, **model.summary(), "forecast": model.forecast(horizon)},
+    headers={"X-Forecast-Cache": cache_status}
+  )
+
 if __name__ == "__main__":
   import uvicorn
-  uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+  # WEB_WORKERS > 1 sobe vários processos; apenas um deles coleta (ver COLLECTOR_MODE)
+  workers = int(os.getenv("WEB_WORKERS", "1"))
+  if workers > 1:
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers)
+  else:
+    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -6,19 +6,44 @@ IMPORTANTE: Todos os serviços externos são mockados (não fazem chamadas reais
 """
 
 import pytest
+import asyncio
 import csv
 import os
+import shutil
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from unittest.mock import Mock, patch, AsyncMock
 from fastapi.testclient import TestClient
 import httpx
-from main import app, save_to_csv, read_from_csv, CSV_FILE, CSV_HEADERS
+import json
+import numpy as np
+from city_registry import CityRegistry, normalize_city_key
+from history_index import get_history_index
+from latest_readings import get_latest_readings, latest_path_for
+from spatial import GridIndex, haversine_km
+from forecast import fit_model
+from anomalies import AnomalyDetector, anomalies_path_for
+from ingest_log import wal_path_for
+from alerts import AlertEngine, alerts_path_for
+from leader import LeaderLock
+from events import ReadingBroker, event_id, stream_readings
+from backfill import Backfill, Checkpoint, split_range, main_cli as backfill_cli
+from aqi import EPA_CATEGORIES, categorize, conama_index, enrich_pollution_series, epa_aqi, epa_category
+from reports import ReportCache, compare_cities, summarize_rows
+from upstream_fixtures import FixtureStore, RecordingTransport, ReplayTransport, synthetic_cities
+from settings import Settings
+from main import app, save_to_csv, read_from_csv, scheduled_collection, CSV_FILE, CSV_HEADERS
 
 # Cliente de testes do FastAPI
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def upstream_settings(monkeypatch):
+    """Chaves fictícias: as APIs externas são sempre mockadas, o .env não é necessário"""
+    monkeypatch.setattr("main.settings", Settings(iqair_api_key="teste", openweather_api_key="teste", read_only="0"))
+
+
 # --- Testes de Endpoints ---
 
 def test_root_endpoint():
@@ -154,6 +179,23 @@ def test_geocode_endpoint():
     assert data["lon"] == -46.6333
 
 
+def test_geocode_response_is_the_same_with_warm_cache(monkeypatch):
+    """Testa se a resposta em cache traz o nome e o país do geocoder, como a primeira"""
+    monkeypatch.setattr("main.city_registry", CityRegistry([
+        {"city": "São Paulo", "state": "São Paulo", "country": "Brazil", "lat": -23.55, "lon": -46.63}]))
+    mock_response = Mock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = [{"name": "São Paulo", "lat": -23.5505, "lon": -46.6333, "country": "BR"}]
+    mock_client = AsyncMock()
+    mock_client.get.return_value = mock_response
+    app.state.http_client = mock_client
+
+    first = client.get("/geocode?city=São Paulo&state=São Paulo&country=Brazil").json()
+    second = client.get("/geocode?city=sao paulo&state=sao paulo&country=brazil").json()
+    assert first == second == {"lat": -23.5505, "lon": -46.6333, "name": "São Paulo", "country": "BR"}
+    assert mock_client.get.call_count == 1
+
+
 def test_debug_endpoint():
     """Testa se o endpoint de debug funciona (com mock)"""
     # Mock da resposta completa da IQAir
@@ -201,9 +243,11 @@ def temp_csv_file(monkeypatch):
     
     yield test_csv
     
-    # Cleanup: remove o arquivo após o teste
-    if test_csv.exists():
-        test_csv.unlink()
+    # Cleanup: remove o arquivo (e os arquivos derivados) após o teste
+    for path in (test_csv, latest_path_for(test_csv), anomalies_path_for(test_csv), alerts_path_for(test_csv),
+                 wal_path_for(test_csv)):
+        if path.exists():
+            path.unlink()
 
 
 def test_save_to_csv_creates_file(temp_csv_file, monkeypatch):
@@ -354,11 +398,73 @@ def test_read_from_csv_filters_by_hours(temp_csv_file, monkeypatch):
     assert result[0]["pm25"] == "30.0"
 
 
+def test_read_from_csv_matches_accent_variants(temp_csv_file, monkeypatch):
+    """Testa se variações com/sem acento e maiúsculas encontram as mesmas linhas"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+
+    now = datetime.now(timezone.utc).isoformat()
+    for city, aqi in [("São Paulo", "45"), ("Rio de Janeiro", "38"), ("Sao Paulo", "50")]:
+        save_to_csv({"timestamp": now, "city": city, "state": "SP", "country": "Brazil",
+                     "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    assert [r["aqi"] for r in read_from_csv(city="Sao Paulo")] == ["45", "50"]
+    assert [r["aqi"] for r in read_from_csv(city="SÃO PAULO")] == ["45", "50"]
+    assert len(read_from_csv(city=None)) == 3
+
+
+def test_history_index_is_incremental_and_skips_partial_lines(temp_csv_file):
+    """Testa se o índice só lê o que foi acrescentado e ignora linha incompleta"""
+    now = datetime.now(timezone.utc).isoformat()
+    temp_csv_file.write_text(
+        ",".join(CSV_HEADERS) + "\n" +
+        f"{now},Fortaleza,CE,Brazil,20,24,55,40\n" +
+        f"invalido,Fortaleza,CE,Brazil,20,24,55,40\n" +
+        f"{now},Fortaleza,CE,Bra",
+        encoding="utf-8"
+    )
+
+    index = get_history_index(temp_csv_file)
+    assert index.total_rows == 1
+    assert index.skipped_rows == 1
+
+    with open(temp_csv_file, "a", encoding="utf-8") as f:
+        f.write("zil,21,24,55,41\n")
+
+    index = get_history_index(temp_csv_file)
+    assert index.total_rows == 2
+    rows = list(index.read_rows(index.offsets_for("fortaleza")))
+    assert [r["aqi"] for r in rows] == ["40", "41"]
+
+
+def test_history_index_keeps_homonym_cities_apart(temp_csv_file, monkeypatch):
+    """Testa se cidades homônimas em estados diferentes ficam separadas no índice e na deduplicação"""
+    import main
+    from timeline import openweather_rows
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    pb = {"city": "Santa Rita", "state": "Paraíba", "country": "Brazil"}
+    mg = {"city": "Santa Rita", "state": "Minas Gerais", "country": "Brazil"}
+    for city, aqi in [(pb, "30"), (mg, "60")]:
+        save_to_csv({**city, "timestamp": hour.isoformat(), "pm25": aqi, "temperature": "25", "humidity": "60", "aqi": aqi})
+
+    index = get_history_index(temp_csv_file)
+    assert len(index.offsets_for("santa rita")) == 2
+    assert [r["aqi"] for r in index.read_rows(index.offsets_for("Santa Rita", state="minas gerais"))] == ["60"]
+    assert sorted(c["state"] for c in main.read_cities_from_csv()) == ["Minas Gerais", "Paraíba"]
+
+    # A mesma hora do OpenWeatherMap é gravada para as duas, não só para a primeira
+    point = [{"timestamp": hour.isoformat(), "pm25": 10.0, "aqi_us": 40}]
+    assert main.save_source_rows(openweather_rows(pb, point)) == 1
+    assert main.save_source_rows(openweather_rows(mg, point)) == 1
+    assert main.save_source_rows(openweather_rows(mg, point)) == 0
+
+
 # --- Testes de Validação de Dados ---
 
 def test_csv_headers_completeness():
     """Testa se todos os headers necessários estão definidos"""
-    expected_headers = ["timestamp", "city", "state", "country", "pm25", "temperature", "humidity", "aqi"]
+    expected_headers = ["timestamp", "city", "state", "country", "pm25", "temperature", "humidity", "aqi", "source",
+                        "pm10", "co", "no2", "o3", "so2", "aqi_category", "iqar", "iqar_category"]
     assert CSV_HEADERS == expected_headers
 
 
@@ -403,7 +509,7 @@ def test_integration_save_and_read_csv(temp_csv_file, monkeypatch):
     assert result[0]["aqi"] == "40"
 
 
-def test_current_endpoint_with_valid_data():
+def test_current_endpoint_with_valid_data(temp_csv_file):
     """Testa endpoint /current com dados válidos (mockado)"""
     # Mock da resposta da IQAir
     mock_response = Mock()
@@ -484,5 +590,1150 @@ def test_current_endpoint_saves_to_csv(temp_csv_file, monkeypatch):
         assert reader[-1]["pm25"] == "50"
 
 
+# --- Testes do Registro de Cidades ---
+
+def test_registry_lookup_ignores_case_and_accents():
+    """Testa se o registro encontra a cidade independente de acentos/maiúsculas"""
+    registry = CityRegistry([
+        {"city": "São Paulo", "state": "São Paulo", "country": "Brazil"},
+        {"city": "Fortaleza", "state": "Ceará", "country": "Brazil"},
+    ])
+
+    assert normalize_city_key("  SÃO   Paulo ") == "sao paulo"
+    assert registry.get("sao paulo")["city"] == "São Paulo"
+    assert registry.get("FORTALEZA", state="ceara")["state"] == "Ceará"
+    assert registry.get("Fortaleza", state="Piauí") is None
+
+
+def test_registry_reloads_from_file_and_shards(tmp_path):
+    """Testa carga a partir de arquivo, recarga após mudança e divisão em shards"""
+    cities_file = tmp_path / "cidades.json"
+    registry = CityRegistry([{"city": "Padrão", "state": "X", "country": "Brazil"}], path=cities_file)
+    assert len(registry) == 1
+    assert registry.has_changed() is False
+
+    entries = [{"city": f"Cidade {i}", "state": "MG", "country": "Brazil", "lat": -19.9, "lon": -43.9} for i in range(50)]
+    cities_file.write_text(json.dumps(entries), encoding="utf-8")
+
+    assert registry.reload_if_changed() is True
+    assert len(registry) == 50
+    assert registry.get_coordinates("cidade 7") == {"lat": -19.9, "lon": -43.9}
+
+    shards = [registry.shard(i, 4) for i in range(4)]
+    assert sum(len(s) for s in shards) == 50
+    assert len({e["city"] for s in shards for e in s}) == 50
+
+
+def test_registry_endpoint_lists_cities():
+    """Testa se o endpoint do registro lista as cidades configuradas"""
+    response = client.get("/registry/cities?country=brazil")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == len(data["cities"])
+    assert any(c["city"] == "Fortaleza" for c in data["cities"])
+
+
+# --- Testes do Coletor Líder ---
+
+def test_leader_lock_allows_single_collector(tmp_path):
+    """Testa se apenas um detentor do lock é eleito e se outro assume após liberar"""
+    lock_file = tmp_path / "coletor.lock"
+    first = LeaderLock(lock_file)
+    second = LeaderLock(lock_file)
+
+    assert first.try_acquire() is True
+    assert second.try_acquire() is False
+    assert first.try_acquire() is True  # continua líder
+
+    first.release()
+    assert second.try_acquire() is True
+    assert second.is_leader
+    second.release()
+
+
+def test_scheduled_collection_skips_when_not_leader(monkeypatch):
+    """Testa se workers que não são líderes não disparam a coleta"""
+    collect = AsyncMock()
+    monkeypatch.setattr("main.collect_data_for_all_cities", collect)
+    monkeypatch.setattr("main.is_collector", lambda: False)
+
+    scheduled_collection()
+    collect.assert_not_called()
+
+
+# --- Testes de Cursor e Requisição Condicional ---
+
+def test_history_since_cursor_returns_only_newer_rows(temp_csv_file, monkeypatch):
+    """Testa se `since` retorna só as linhas posteriores ao cursor"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for minutes, aqi in [(20, "40"), (10, "41"), (0, "42")]:
+        save_to_csv({"timestamp": (now - timedelta(minutes=minutes)).isoformat(), "city": "Fortaleza",
+                     "state": "Ceará", "country": "Brazil", "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    cursor = (now - timedelta(minutes=10)).isoformat()
+    response = client.get("/cities/Fortaleza/history", params={"hours": 1, "since": cursor})
+    assert response.status_code == 200
+    data = response.json()
+    assert [r["aqi"] for r in data["data"]] == ["42"]
+
+    response = client.get("/cities/Fortaleza/history", params={"hours": 1, "since": data["latest_timestamp"]})
+    assert response.status_code == 200
+    assert response.json()["total_records"] == 0
+
+    response = client.get("/history/all", params={"hours": 1, "since": "ontem"})
+    assert response.status_code == 422
+
+
+def test_history_returns_304_until_new_data_arrives(temp_csv_file, monkeypatch):
+    """Testa ETag/If-None-Match: 304 enquanto a janela não muda, 200 após nova leitura"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    row = {"timestamp": datetime.now(timezone.utc).isoformat(), "city": "Fortaleza", "state": "Ceará",
+           "country": "Brazil", "pm25": "20", "temperature": "", "humidity": "", "aqi": "40"}
+    save_to_csv(row)
+
+    first = client.get("/history/all?hours=1")
+    etag = first.headers["ETag"]
+
+    second = client.get("/history/all?hours=1", headers={"If-None-Match": etag})
+    assert second.status_code == 304
+
+    save_to_csv({**row, "aqi": "41"})
+    third = client.get("/history/all?hours=1", headers={"If-None-Match": etag})
+    assert third.status_code == 200
+    assert third.json()["total_records"] == 2
+    assert third.headers["ETag"] != etag
+
+
+# --- Testes do Backfill ---
+
+def test_backfill_from_recorded_files_resumes_without_duplicates(tmp_path):
+    """Testa backfill a partir de respostas gravadas, em blocos, com retomada via checkpoint"""
+    start = int(datetime(2025, 10, 1, tzinfo=timezone.utc).timestamp())
+    recorded = {"list": [
+        {"dt": start + hour * 3600, "main": {"aqi": 2},
+         "components": {"pm2_5": 10.0 + hour, "pm10": 20.0, "co": 200.0, "no2": 5.0, "o3": 30.0, "so2": 1.0}}
+        for hour in range(72)
+    ]}
+    city_dir = tmp_path / "gravacoes" / "sao_paulo"
+    city_dir.mkdir(parents=True)
+    (city_dir / "outubro.json").write_text(json.dumps(recorded), encoding="utf-8")
+
+    output = tmp_path / "openweather.csv"
+    checkpoint_file = tmp_path / "checkpoint.json"
+    cities = [{"city": "São Paulo", "state": "São Paulo", "country": "Brazil", "lat": None, "lon": None}]
+
+    def run():
+        backfill = Backfill(output, Checkpoint(checkpoint_file), concurrency=2,
+                            batch_size=10, from_files=tmp_path / "gravacoes")
+        asyncio.run(backfill.run(cities, start, start + 72 * 3600, chunk_seconds=24 * 3600))
+        return backfill
+
+    first = run()
+    assert first.rows_written == 72
+    assert len(split_range(start, start + 72 * 3600, 24 * 3600)) == 3
+
+    with open(output, encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 72
+    assert rows[0]["city"] == "São Paulo"
+
+    second = run()
+    assert second.rows_written == 0
+
+
+def test_backfill_cli_fails_fast_without_api_keys(tmp_path, monkeypatch):
+    """Testa que o backfill sem chaves termina com o motivo e código de saída diferente de zero"""
+    monkeypatch.setattr("main.settings", Settings(iqair_api_key="", openweather_api_key="", read_only="0"))
+    fetch = AsyncMock()
+    monkeypatch.setattr("main.fetch_pollution_history", fetch)
+
+    with pytest.raises(SystemExit) as exc_info:
+        backfill_cli(["--start", "2025-10-01", "--end", "2025-10-02", "--output", str(tmp_path / "saida.csv"),
+                      "--checkpoint", str(tmp_path / "checkpoint.json")])
+    assert exc_info.value.code != 0 and "não configuradas" in str(exc_info.value.code)
+    fetch.assert_not_called()
+    assert not (tmp_path / "saida.csv").exists()
+
+
+def test_backfill_requests_do_not_overlap_at_chunk_edges(tmp_path, monkeypatch):
+    """Testa se os blocos pedidos à API (end inclusivo) não repetem a hora da borda"""
+    import main
+    start = int(datetime(2025, 10, 1, tzinfo=timezone.utc).timestamp())
+    requested = []
+
+    async def fake_history(client, lat, lon, chunk_start, chunk_end):
+        requested.append((chunk_start, chunk_end))
+        return []
+
+    monkeypatch.setattr(main, "fetch_pollution_history", fake_history)
+    cities = [{"city": "Recife", "state": "Pernambuco", "country": "Brazil", "lat": -8.05, "lon": -34.9}]
+    backfill = Backfill(tmp_path / "openweather.csv", Checkpoint(tmp_path / "checkpoint.json"), concurrency=1)
+    asyncio.run(backfill.run(cities, start, start + 48 * 3600, chunk_seconds=24 * 3600))
+
+    assert sorted(requested) == [(start, start + 24 * 3600 - 1), (start + 24 * 3600, start + 48 * 3600 - 1)]
+
+
+# --- Testes de Gravação/Replay das APIs ---
+
+def test_recorded_responses_are_replayed_without_secrets(tmp_path):
+    """Testa se a resposta gravada é reproduzida e se a chave de API não vai para o disco"""
+    upstream = httpx.MockTransport(lambda request: httpx.Response(
+        200, json={"status": "success", "data": [{"country": "Brazil"}]}))
+    store = FixtureStore(tmp_path / "fixtures")
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=RecordingTransport(store, upstream)) as recorder:
+            await recorder.get("http://api.airvisual.com/v2/countries", params={"key": "segredo"})
+        async with httpx.AsyncClient(transport=ReplayTransport(FixtureStore(tmp_path / "fixtures"))) as replay:
+            hit = await replay.get("http://localhost:9000/v2/countries", params={"key": "outra"})
+            miss = await replay.get("http://localhost:9000/v2/states", params={"country": "Brazil"})
+        return hit, miss
+
+    hit, miss = asyncio.run(scenario())
+    assert hit.status_code == 200
+    assert hit.json()["data"][0]["country"] == "Brazil"
+    assert miss.status_code == 404
+    assert all("segredo" not in f.read_text() for f in (tmp_path / "fixtures").glob("*.json"))
+
+
+def test_current_endpoint_with_synthetic_replay(temp_csv_file):
+    """Testa o endpoint /current contra o upstream sintético (sem mocks manuais)"""
+    app.state.http_client = httpx.AsyncClient(transport=ReplayTransport(synthetic=True))
+    city = synthetic_cities(3)[2]
+
+    response = client.get(f"/cities/{city['city']}/current", params={"state": city["state"], "country": "Brazil"})
+    assert response.status_code == 200
+    data = response.json()
+    assert 5 <= data["pm25"] <= 180
+    assert data["raw_data"]["data"]["city"] == city["city"]
+
+
+# --- Testes dos Índices de Qualidade do Ar ---
+
+def test_epa_and_conama_breakpoints():
+    """Testa valores conhecidos das tabelas EPA e CONAMA (incluindo faltantes e saturação)"""
+    assert list(epa_aqi("pm25", [0, 9.0, 12.0, 35.4, 55.4, 1000])) == [0, 50, 56, 100, 150, 500]
+    assert list(epa_aqi("pm10", [54, 155])) == [50, 101]
+    assert np.isnan(epa_aqi("pm25", [None])[0])
+
+    assert list(conama_index("pm25", [25, 50, 300])) == [40, 80, 400]
+    assert list(conama_index("o3", [100, 130])) == [40, 80]
+
+    assert categorize([10, 51, 160, None], EPA_CATEGORIES) == ["Boa", "Moderada", "Insalubre", None]
+    assert epa_category(120) == "Insalubre para grupos sensíveis"
+
+
+def test_enrich_pollution_series_picks_dominant_pollutant():
+    """Testa se o índice geral é o maior sub-índice e identifica o poluente dominante"""
+    points = [
+        {"pm25": 40.0, "pm10": 20.0, "o3": 10.0, "no2": 5.0, "so2": 1.0, "co": 200.0},
+        {"pm25": 5.0, "pm10": 20.0, "o3": 250.0, "no2": 5.0, "so2": 1.0, "co": 200.0},
+        {"pm25": None, "pm10": None, "o3": None, "no2": None, "so2": None, "co": None},
+    ]
+    enriched = enrich_pollution_series(points)
+
+    assert enriched[0]["aqi_us_dominant"] == "pm25"
+    assert enriched[0]["aqi_us"] == 112
+    assert enriched[0]["iqar_category"] == "Moderada"
+    assert enriched[1]["iqar_dominant"] == "o3"
+    assert enriched[1]["iqar_category"] == "Péssima"
+    assert enriched[2]["aqi_us"] is None and enriched[2]["aqi_us_category"] is None
+
+
+def test_pm25_24h_endpoint_returns_precomputed_aqi():
+    """Testa se a série 24h já vem com AQI US e categoria calculados no backend"""
+    app.state.http_client = httpx.AsyncClient(transport=ReplayTransport(synthetic=True))
+
+    response = client.get("/cities/Cidade Qualquer/pm25/24h?state=MG&country=Brazil")
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) >= 23
+    assert all(isinstance(point["aqi_us"], int) and point["category"] for point in data)
+
+
+
+def test_stored_readings_are_returned_with_aqi_category(temp_csv_file, monkeypatch):
+    """Testa se histórico e últimas leituras da IQAir saem com a categoria do AQI calculada no backend"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for minutes, aqi in [(10, "42"), (5, "160")]:
+        save_to_csv({"timestamp": (now - timedelta(minutes=minutes)).isoformat(), "city": "Recife", "state": "PE",
+                     "country": "Brazil", "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    # A categoria é gravada na ingestão, junto com a leitura
+    with open(temp_csv_file, encoding="utf-8") as f:
+        assert [row["aqi_category"] for row in csv.DictReader(f)] == ["Boa", "Insalubre"]
+
+    history = client.get("/cities/Recife/history?hours=1").json()["data"]
+    assert [row["aqi_category"] for row in history] == ["Boa", "Insalubre"]
+    assert client.get("/latest/Recife").json()["aqi_category"] == "Insalubre"
+    assert client.get("/latest").json()["data"][0]["aqi_category"] == "Insalubre"
+
+    # Linhas antigas (sem a coluna preenchida) ganham a categoria na leitura
+    from aqi import with_aqi_category
+    assert with_aqi_category([{"aqi": "120", "aqi_category": ""}])[0]["aqi_category"] == "Insalubre para grupos sensíveis"
+
+# --- Testes de Relatórios ---
+
+def test_summarize_rows_daily_means_exceedance_and_ranking():
+    """Testa médias diárias, horas acima do limite, piores horários e ranking"""
+    base = datetime(2025, 11, 4, 10, tzinfo=timezone.utc)
+    rows = []
+    for hour, (sp, fz) in enumerate([(90, 30), (130, 35), (160, 40)]):
+        for minute in (0, 30):
+            ts = (base + timedelta(hours=hour, minutes=minute)).isoformat()
+            rows.append({"timestamp": ts, "city": "São Paulo", "state": "SP", "country": "Brazil",
+                         "aqi": str(sp), "temperature": "22", "humidity": "60"})
+            rows.append({"timestamp": ts, "city": "Fortaleza", "state": "CE", "country": "Brazil",
+                         "aqi": str(fz), "temperature": "", "humidity": ""})
+
+    report = summarize_rows(rows, threshold=100)
+    assert report["ranking"] == ["São Paulo", "Fortaleza"]
+    sp = report["cities"][0]
+    assert sp["records"] == 6
+    assert sp["exceedance_hours"] == 2
+    assert sp["daily"] == [{"date": "2025-11-04", "mean_aqi": 126.7, "max_aqi": 160.0, "hours": 3}]
+    assert sp["worst_periods"][0] == {"hour": "2025-11-04T12:00Z", "mean_aqi": 160.0}
+    assert report["cities"][1]["mean_temperature"] is None
+
+
+def test_report_endpoint_formats_and_cache(temp_csv_file, monkeypatch):
+    """Testa o endpoint de relatório (pool de processos), os formatos e o cache por versão"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    monkeypatch.setattr("main.report_cache", ReportCache())
+    row = {"timestamp": datetime.now(timezone.utc).isoformat(), "city": "Fortaleza", "state": "Ceará",
+           "country": "Brazil", "pm25": "40", "temperature": "28", "humidity": "70", "aqi": "40"}
+    save_to_csv(row)
+
+    first = client.get("/reports?hours=1")
+    assert first.status_code == 200
+    assert first.headers["X-Report-Cache"] == "miss"
+    assert first.json()["ranking"] == ["Fortaleza"]
+    assert client.get("/reports?hours=1").headers["X-Report-Cache"] == "hit"
+
+    save_to_csv({**row, "aqi": "60"})
+    third = client.get("/reports?hours=1")
+    assert third.headers["X-Report-Cache"] == "miss"
+    assert third.json()["cities"][0]["mean_aqi"] == 50.0
+
+    # Sem leitura nova, mas a janela avançou: as leituras saíram dela e o cache não vale mais
+    import main
+    window_start = main.history_window_start
+    monkeypatch.setattr("main.history_window_start", lambda hours: window_start(hours) + 2 * 3600)
+    assert client.get("/reports?hours=1").status_code == 404
+    monkeypatch.setattr("main.history_window_start", window_start)
+
+    csv_report = client.get("/reports?hours=1&format=csv&cities=fortaleza")
+    assert csv_report.text.splitlines()[1].startswith("1,Fortaleza")
+    pdf_report = client.get("/reports?hours=1&format=pdf")
+    assert pdf_report.content.startswith(b"%PDF-1.4") and pdf_report.content.rstrip().endswith(b"%%EOF")
+    assert client.get("/reports?format=xls").status_code == 422
+
+
+# --- Testes da Comparação entre Cidades ---
+
+def test_comparison_endpoint_returns_one_entry_per_city(temp_csv_file, monkeypatch):
+    """Testa se /comparison retorna última leitura, média, máximo e tendência por cidade"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for minutes_ago, sp, fz in [(50, 60, 30), (30, 80, 30), (10, 100, 30)]:
+        ts = (now - timedelta(minutes=minutes_ago)).isoformat()
+        for city, aqi in [("São Paulo", sp), ("Fortaleza", fz)]:
+            save_to_csv({"timestamp": ts, "city": city, "state": "", "country": "Brazil",
+                         "pm25": str(aqi), "temperature": "", "humidity": "", "aqi": str(aqi)})
+
+    response = client.get("/comparison?hours=1")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total_cities"] == 2
+
+    sp, fz = data["cities"]
+    assert sp["city"] == "São Paulo" and sp["latest"]["aqi"] == "100"
+    assert sp["mean"] == 80.0 and sp["max"] == 100.0
+    assert sp["trend"] == "up" and sp["trend_per_hour"] == 60.0
+    assert fz["trend"] == "stable"
+    assert client.get("/comparison?metric=ozonio").status_code == 422
+
+
+def test_reports_and_comparison_keep_homonym_cities_apart():
+    """Testa se cidades homônimas em estados diferentes não se misturam no relatório nem na comparação"""
+    base = datetime(2025, 11, 4, 10, tzinfo=timezone.utc)
+    rows = []
+    for hour in range(3):
+        ts = (base + timedelta(hours=hour)).isoformat()
+        rows.append({"timestamp": ts, "city": "Bom Jesus", "state": "Bahia", "country": "Brazil", "aqi": "20"})
+        rows.append({"timestamp": ts, "city": "Bom Jesus", "state": "Minas Gerais", "country": "Brazil",
+                     "aqi": str(100 + 20 * hour)})
+
+    report = summarize_rows(rows)
+    assert [(s["state"], s["mean_aqi"], s["max_aqi"]) for s in report["cities"]] == [
+        ("Minas Gerais", 120.0, 140.0), ("Bahia", 20.0, 20.0)]
+
+    comparison = compare_cities(rows)
+    assert [(c["state"], c["mean"], c["trend"]) for c in comparison] == [
+        ("Minas Gerais", 120.0, "up"), ("Bahia", 20.0, "stable")]
+
+
+# --- Testes das Últimas Leituras ---
+
+def test_latest_readings_maintained_on_write(temp_csv_file, monkeypatch):
+    """Testa se save_to_csv mantém e persiste a última leitura de cada cidade"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for minutes_ago, aqi in [(10, "40"), (30, "90"), (5, "55")]:
+        save_to_csv({"timestamp": (now - timedelta(minutes=minutes_ago)).isoformat(), "city": "São Paulo",
+                     "state": "São Paulo", "country": "Brazil", "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    get_latest_readings(temp_csv_file).flush()
+    persisted = json.loads(latest_path_for(temp_csv_file).read_text(encoding="utf-8"))
+    assert [r["aqi"] for r in persisted["readings"]] == ["55"]
+
+    response = client.get("/latest/SAO PAULO")
+    assert response.status_code == 200
+    assert response.json()["aqi"] == "55"
+    assert client.get("/latest/Atlantida").status_code == 404
+
+
+def test_latest_readings_catch_up_rows_from_other_writers(temp_csv_file, monkeypatch):
+    """Testa se /latest incorpora linhas gravadas sem passar por save_to_csv (ex: outro worker)"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    save_to_csv({"timestamp": (now - timedelta(hours=1)).isoformat(), "city": "Fortaleza", "state": "Ceará",
+                 "country": "Brazil", "pm25": "20", "temperature": "", "humidity": "", "aqi": "20"})
+    with open(temp_csv_file, "a", newline="", encoding="utf-8") as f:
+        csv.DictWriter(f, fieldnames=CSV_HEADERS).writerow(
+            {"timestamp": now.isoformat(), "city": "Curitiba", "state": "Paraná", "country": "Brazil",
+             "pm25": "12", "temperature": "", "humidity": "", "aqi": "12"})
+
+    data = client.get("/latest").json()
+    assert data["total_cities"] == 2
+    assert {r["city"] for r in data["data"]} == {"Fortaleza", "Curitiba"}
+    assert client.get("/latest?cities=curitiba").json()["data"][0]["aqi"] == "12"
+
+
+def test_latest_readings_keep_homonym_cities_apart(temp_csv_file, monkeypatch):
+    """Testa se cidades homônimas em estados diferentes têm cada uma a sua última leitura"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for state, aqi in [("Bahia", "30"), ("Minas Gerais", "70")]:
+        save_to_csv({"timestamp": now.isoformat(), "city": "Bom Jesus", "state": state, "country": "Brazil",
+                     "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    assert sorted(r["aqi"] for r in client.get("/latest?cities=bom jesus").json()["data"]) == ["30", "70"]
+    assert client.get("/latest/Bom Jesus").status_code == 409
+    assert client.get("/latest/Bom Jesus", params={"state": "minas gerais"}).json()["aqi"] == "70"
+
+    # Consultas não regravam o arquivo; só a gravação
+    path = latest_path_for(temp_csv_file)
+    path.unlink(missing_ok=True)
+    client.get("/latest")
+    assert not path.exists()
+
+
+# --- Testes do Índice Espacial ---
+
+def test_grid_index_nearest_matches_brute_force():
+    """Testa se os k mais próximos da grade coincidem com a busca exaustiva"""
+    points = [(c["lat"], c["lon"], c) for c in synthetic_cities(2000)]
+    index = GridIndex(points)
+    for lat, lon in [(-23.55, -46.63), (-3.73, -38.52), (4.9, -72.9), (-40.0, -20.0)]:
+        expected = sorted(points, key=lambda p: haversine_km(lat, lon, p[0], p[1]))[:5]
+        found = index.nearest(lat, lon, k=5)
+        assert [item["city"] for _, item in found] == [p[2]["city"] for p in expected]
+
+    inside = index.within_bbox(-25.0, -50.0, -20.0, -40.0)
+    assert {c["city"] for c in inside} == {
+        p[2]["city"] for p in points if -25.0 <= p[0] <= -20.0 and -50.0 <= p[1] <= -40.0
+    }
+    assert len(index.within_bbox(-90, -180, 90, 180)) == len(points)
+    edge = GridIndex([(0.0, 179.9, {"city": "Leste"}), (0.0, -179.9, {"city": "Oeste"})])
+    assert [c["city"] for c in edge.within_bbox(-1, 179.8, 1, 180)] == ["Leste"]
+
+
+def test_nearby_and_bbox_endpoints(temp_csv_file, monkeypatch):
+    """Testa /nearby e /bbox com as coordenadas do registro e a última leitura"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    monkeypatch.setattr("main.city_registry", CityRegistry([
+        {"city": "São Paulo", "state": "São Paulo", "country": "Brazil", "lat": -23.55, "lon": -46.63},
+        {"city": "Campinas", "state": "São Paulo", "country": "Brazil", "lat": -22.91, "lon": -47.06},
+        {"city": "Fortaleza", "state": "Ceará", "country": "Brazil", "lat": -3.73, "lon": -38.52},
+        {"city": "Sem Coordenadas", "state": "Ceará", "country": "Brazil"},
+    ]))
+    save_to_csv({"timestamp": datetime.now(timezone.utc).isoformat(), "city": "Campinas", "state": "São Paulo",
+                 "country": "Brazil", "pm25": "33", "temperature": "", "humidity": "", "aqi": "33"})
+
+    data = client.get("/nearby?lat=-23.0&lon=-47.0&k=2").json()
+    assert [c["city"] for c in data["data"]] == ["Campinas", "São Paulo"]
+    assert data["data"][0]["latest"]["aqi"] == "33"
+    assert data["data"][0]["distance_km"] < data["data"][1]["distance_km"]
+
+    assert client.get("/nearby?lat=-23.0&lon=-47.0&k=5&max_km=200").json()["total"] == 2
+
+    data = client.get("/bbox?min_lat=-10&min_lon=-45&max_lat=0&max_lon=-35").json()
+    assert [c["city"] for c in data["data"]] == ["Fortaleza"]
+    assert client.get("/bbox?min_lat=0&min_lon=-45&max_lat=-10&max_lon=-35").status_code == 422
+
+    data = client.get("/bbox?min_lat=-90&min_lon=-180&max_lat=90&max_lon=180").json()
+    assert {c["city"] for c in data["data"]} == {"São Paulo", "Campinas", "Fortaleza"}
+
+
+# --- Testes da Previsão ---
+
+def _daily_cycle_rows(hours, start_epoch):
+    """Linhas (offset, linha) horárias com ciclo diário: pico de AQI às 18h"""
+    rows = []
+    for i in range(hours):
+        epoch = start_epoch + i * 3600
+        hour_of_day = datetime.fromtimestamp(epoch, tz=timezone.utc).hour
+        aqi = 50 + 30 * np.cos((hour_of_day - 18) / 24 * 2 * np.pi)
+        rows.append((i, {"timestamp": datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat(), "aqi": f"{aqi:.1f}"}))
+    return rows
+
+
+def test_forecast_model_learns_daily_cycle_and_updates_incrementally():
+    """Testa se o sazonal ingênuo vence num ciclo diário e se a atualização incremental avança a previsão"""
+    start = datetime(2025, 11, 1, tzinfo=timezone.utc).timestamp()
+    rows = _daily_cycle_rows(24 * 4, start)
+
+    model = fit_model(rows[:-6], now_epoch=start + 24 * 4 * 3600)
+    assert model.best_model == "seasonal_naive"
+    predicted = [p["value"] for p in model.forecast(6)]
+    actual = [float(r["aqi"]) for _, r in rows[-6:]]
+    assert max(abs(p - a) for p, a in zip(predicted, actual)) < 1.0
+
+    model.add_rows(rows[-6:])
+    model.close_pending(start + 24 * 4 * 3600)
+    assert model.last_hour == start + (24 * 4 - 1) * 3600
+    assert model.forecast(1)[0]["timestamp"] == datetime.fromtimestamp(start + 24 * 4 * 3600, tz=timezone.utc).isoformat()
+
+
+def test_forecast_endpoint_caches_and_refits_incrementally(temp_csv_file, monkeypatch):
+    """Testa /forecast: ajuste inicial no pool, cache e incorporação de leituras novas"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    start = (now - timedelta(hours=48)).timestamp()
+    for _, row in _daily_cycle_rows(47, start):
+        save_to_csv({**row, "city": "Fortaleza", "state": "Ceará", "country": "Brazil",
+                     "pm25": row["aqi"], "temperature": "", "humidity": ""})
+
+    response = client.get("/cities/fortaleza/forecast?horizon=3")
+    assert response.status_code == 200
+    assert response.headers["X-Forecast-Cache"] == "fit"
+    data = response.json()
+    assert len(data["forecast"]) == 3 and data["history_hours"] == 47
+    assert data["model"] in ("seasonal_naive", "exp_smoothing")
+
+    assert client.get("/cities/Fortaleza/forecast?horizon=3").headers["X-Forecast-Cache"] == "hit"
+
+    save_to_csv({"timestamp": (now - timedelta(minutes=59)).isoformat(), "city": "Fortaleza", "state": "Ceará",
+                 "country": "Brazil", "pm25": "70", "temperature": "", "humidity": "", "aqi": "70"})
+    response = client.get("/cities/Fortaleza/forecast?horizon=3")
+    assert response.headers["X-Forecast-Cache"] == "incremental"
+    assert client.get("/cities/Atlantida/forecast").status_code == 404
+
+
+# --- Testes de Anomalias ---
+
+def _reading(minutes, **values):
+    base = datetime(2025, 11, 1, tzinfo=timezone.utc) + timedelta(minutes=minutes)
+    row = {"timestamp": base.isoformat(), "city": "Fortaleza", "state": "Ceará", "country": "Brazil",
+           "pm25": "30", "temperature": "28", "humidity": "70", "aqi": "30"}
+    row.update({k: str(v) for k, v in values.items()})
+    return row
+
+
+def test_anomaly_detector_flags_spike_stuck_missing_and_range():
+    """Testa os tipos de anomalia e que leituras repetidas não contam"""
+    detector = AnomalyDetector(window=24, stuck_hours=3)
+    for i, aqi in enumerate([28, 31, 30, 33, 29, 32, 30, 27, 31, 30]):
+        assert detector.check(_reading(i * 60, aqi=aqi, pm25=aqi)) == []
+    # Mesmo timestamp da anterior (coleta a cada 5 min, IQAir atualiza por hora): ignorada
+    assert detector.check(_reading(9 * 60, aqi=500)) == []
+
+    kinds = {(a["kind"], a["field"]) for a in detector.check(_reading(10 * 60, aqi=250, humidity=140, temperature=""))}
+    assert kinds == {("spike", "aqi"), ("out_of_range", "humidity"), ("missing", "temperature")}
+
+    # pm25 = 30 em 4 horas seguidas (>= 3h) -> travado
+    flagged = [detector.check(_reading(m, pm25=30, aqi=30)) for m in (11 * 60, 12 * 60, 13 * 60, 14 * 60)]
+    assert ("stuck", "pm25") in {(a["kind"], a["field"]) for a in flagged[-1]}
+    assert detector.counts["spike"] == 1
+
+
+def test_quarantined_readings_are_not_written(temp_csv_file, monkeypatch):
+    """Testa ANOMALY_MODE=quarantine: spike vai para o registro e não para o CSV"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    monkeypatch.setattr("main.anomaly_detector", AnomalyDetector(mode="quarantine"))
+    for i, aqi in enumerate([28, 31, 30, 33, 29, 32, 30, 27, 31, 30]):
+        assert save_to_csv(_reading(i * 60, aqi=aqi, pm25=aqi)) is True
+    assert save_to_csv(_reading(10 * 60, aqi=400, pm25=400)) is False
+
+    with open(temp_csv_file, "r", encoding="utf-8") as f:
+        assert len(list(csv.DictReader(f))) == 10
+
+    data = client.get("/anomalies?city=fortaleza&kind=spike").json()
+    assert data["mode"] == "quarantine" and data["total"] == 1
+    assert data["data"][0]["quarantined"] is True
+    assert data["data"][0]["row"]["aqi"] == "400"
+
+
+# --- Testes de Alertas ---
+
+def test_alert_engine_duration_hysteresis_and_dedup():
+    """Testa duração mínima, deduplicação e histerese de uma regra"""
+    engine = AlertEngine([{"id": "aqi150", "field": "aqi", "op": ">", "threshold": 150,
+                           "clear_threshold": 130, "duration_minutes": 120}])
+    events = []
+    for minutes, aqi in [(0, 160), (60, 170), (90, 120), (120, 160), (180, 165), (240, 180),
+                         (245, 180), (300, 140), (360, 125)]:
+        events += [(minutes, e["event"]) for e in engine.ingest(_reading(minutes, aqi=aqi))]
+
+    # Caiu a 120 aos 90 min: a contagem recomeça aos 120 e dispara aos 240.
+    # Em 245 continua ativo (sem repetir); 140 está na faixa de histerese; resolve em 125.
+    assert events == [(240, "firing"), (360, "resolved")]
+    assert engine.active_alerts() == []
+
+
+def test_alert_engine_only_visits_relevant_rules():
+    """Testa regras globais ordenadas por limite e regras restritas a cidades"""
+    rules = [{"id": f"r{t}", "field": "aqi", "op": ">=", "threshold": t} for t in range(0, 500, 10)]
+    rules.append({"id": "curitiba", "field": "aqi", "op": "<", "threshold": 50, "cities": ["Curitiba"]})
+    engine = AlertEngine(rules)
+
+    fired = {e["rule_id"] for e in engine.ingest(_reading(0, aqi=35))}
+    assert fired == {"r0", "r10", "r20", "r30"}
+    assert {a["rule_id"] for a in engine.active_alerts(city="Fortaleza")} == fired
+
+    assert {e["rule_id"] for e in engine.ingest(_reading(60, aqi=5, city="Curitiba"))} == {"r0", "curitiba"}
+    assert {e["rule_id"] for e in engine.ingest(_reading(60, aqi=15))} == {"r20", "r30"}
+
+
+def test_alert_endpoints_and_webhook(temp_csv_file, monkeypatch, tmp_path):
+    """Testa o registro de regras pela API, a avaliação na gravação e a entrega ao webhook"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    (tmp_path / "regras.json").write_text("[]", encoding="utf-8")
+    engine = AlertEngine([], lambda: alerts_path_for(temp_csv_file), "http://webhook.local/alertas",
+                         rules_path=tmp_path / "regras.json")
+    monkeypatch.setattr("main.alert_engine", engine)
+
+    response = client.post("/alerts/rules", json={"id": "pm25-alto", "field": "pm25", "op": ">", "threshold": 55,
+                                                  "duration_minutes": 60})
+    assert response.status_code == 200
+    assert json.loads((tmp_path / "regras.json").read_text(encoding="utf-8"))[0]["id"] == "pm25-alto"
+    assert client.post("/alerts/rules", json={"field": "ozonio", "threshold": 1}).status_code == 422
+
+    for minutes in (0, 30, 60, 90):
+        save_to_csv(_reading(minutes, pm25=80))
+    active = client.get("/alerts?city=fortaleza").json()
+    assert active["total"] == 1 and active["data"][0]["rule_id"] == "pm25-alto"
+    events = client.get("/alerts/events").json()
+    assert [e["event"] for e in events["data"]] == ["firing"]
+    assert events["webhook"]["pending"] == 1
+
+    received = []
+    def webhook(request):
+        received.extend(json.loads(request.content)["events"])
+        return httpx.Response(200)
+    async def deliver():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(webhook)) as http:
+            return await engine.flush_webhook(http)
+    assert asyncio.run(deliver()) == 1
+    assert received[0]["rule_id"] == "pm25-alto" and not engine.outbox
+
+    assert client.delete("/alerts/rules/pm25-alto").status_code == 200
+    assert client.delete("/alerts/rules/pm25-alto").status_code == 404
+
+
+def test_alert_rules_changed_by_another_worker_are_reloaded(tmp_path):
+    """Testa se um motor criado do mesmo arquivo passa a avaliar a regra gravada por outro"""
+    rules_file = tmp_path / "regras.json"
+    api_worker = AlertEngine(rules_path=rules_file)
+    collector = AlertEngine(rules_path=rules_file)
+    assert set(collector.rules) == {"aqi-insalubre-2h", "aqi-sensiveis-1h"}
+
+    api_worker.add_rule({"id": "pm25-alto", "field": "pm25", "op": ">", "threshold": 55})
+    api_worker.remove_rule("aqi-sensiveis-1h")
+    api_worker.save_rules()
+
+    events = collector.ingest(_reading(0, pm25=80))
+    assert [e["rule_id"] for e in events] == ["pm25-alto"]
+    assert set(collector.rules) == {"aqi-insalubre-2h", "pm25-alto"}
+
+
+# --- Testes de Configuração e Modo Somente Leitura ---
+
+def test_main_imports_without_api_keys(tmp_path):
+    """Testa se importar main sem chaves (e sem .env) não falha e cai no modo somente leitura"""
+    import subprocess
+    import sys
+    # Vazias no ambiente (o .env não sobrescreve variáveis já definidas)
+    env = {**os.environ, "IQAIR_API_KEY": "", "OPENWEATHER_API_KEY": "", "PYTHONPATH": str(Path(__file__).parent)}
+    result = subprocess.run([sys.executable, "-c", "import main; print(main.settings.read_only)"],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == "True"
+
+
+def test_read_only_mode_serves_store_and_blocks_upstream(temp_csv_file, monkeypatch):
+    """Testa READ_ONLY: histórico continua disponível, endpoints das APIs externas retornam 503"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    monkeypatch.setattr("main.settings", Settings(read_only="1", iqair_api_key="teste", openweather_api_key="teste"))
+    save_to_csv({"timestamp": datetime.now(timezone.utc).isoformat(), "city": "Fortaleza", "state": "Ceará",
+                 "country": "Brazil", "pm25": "20", "temperature": "", "humidity": "", "aqi": "20"})
+
+    assert client.get("/history/all?hours=1").status_code == 200
+    assert client.get("/latest/Fortaleza").status_code == 200
+    for url in ["/countries", "/cities/Fortaleza/current?state=Ceará&country=Brazil", "/geocode?city=Fortaleza"]:
+        response = client.get(url)
+        assert response.status_code == 503
+        assert "READ_ONLY" in response.json()["detail"]
+
+    # Sem chaves: somente leitura automático, sem coletor
+    keyless = Settings(iqair_api_key="", openweather_api_key="", read_only="0")
+    assert keyless.read_only and "não configuradas" in keyless.upstream_unavailable_reason()
+    monkeypatch.setattr("main.settings", keyless)
+    from main import is_collector
+    assert is_collector() is False
+
+
+# --- Testes de Perfilamento ---
+
+def test_profile_header_records_stage_spans():
+    """Testa se X-Profile gera um trace com as etapas do handler e de fora dele"""
+    from main import trace_store
+    trace_store.clear()
+    app.state.http_client = httpx.AsyncClient(transport=ReplayTransport(synthetic=True))
+
+    plain = client.get("/cities/Cidade Qualquer/pm25/24h?state=MG&country=Brazil")
+    assert plain.status_code == 200 and "x-trace-id" not in plain.headers
+
+    response = client.get("/cities/Cidade Qualquer/pm25/24h?state=MG&country=Brazil", headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    assert "upstream.openweather;dur=" in response.headers["server-timing"]
+
+    traces = client.get("/debug/traces").json()["traces"]
+    assert [t["id"] for t in traces] == [response.headers["x-trace-id"]]
+    spans = {s["name"]: s for s in traces[0]["spans"]}
+    assert {"validation", "endpoint", "geocode", "upstream.openweather", "pollution.format", "serialize", "send"} <= set(spans)
+    assert spans["upstream.openweather"]["depth"] == 1 and spans["endpoint"]["depth"] == 0
+    assert traces[0]["status"] == 200 and traces[0]["total_ms"] >= spans["endpoint"]["duration_ms"]
+
+
+def test_cpu_profile_is_captured_on_request():
+    """Testa se X-Profile: cpu guarda o perfil de CPU, disponível só no trace completo"""
+    from main import trace_store
+    trace_store.clear()
+
+    response = client.get("/", headers={"X-Profile": "cpu"})
+    trace_id = response.headers["x-trace-id"]
+    summary = client.get("/debug/traces").json()["traces"][0]
+    assert summary["has_cpu_profile"] and "cpu_profile" not in summary
+
+    full = client.get(f"/debug/traces/{trace_id}").json()
+    assert "function calls" in full["cpu_profile"]
+    assert client.get("/debug/traces/inexistente").status_code == 404
+
+
+# --- Testes das Consultas Fora do Event Loop ---
+
+def test_large_history_queries_run_chunked_in_pool(temp_csv_file, monkeypatch):
+    """Testa se a consulta em lotes no pool devolve o mesmo que a leitura direta e se o pool cheio responde 503"""
+    import main
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for i, city in enumerate(["Fortaleza", "Recife", "Fortaleza", "São Paulo", "Recife"]):
+        save_to_csv({"timestamp": (now - timedelta(minutes=10 - i)).isoformat(), "city": city, "state": "UF",
+                     "country": "Brazil", "pm25": str(10 + i), "temperature": "25", "humidity": "60", "aqi": str(10 + i)})
+    monkeypatch.setattr(main.query_offloader, "inline_rows", 0)
+    monkeypatch.setattr(main.query_offloader, "chunk_rows", 2)
+    completed = main.query_offloader.completed
+
+    response = client.get("/history/all?hours=1")
+    assert response.status_code == 200 and response.headers["ETag"]
+    body = response.json()
+    from aqi import with_aqi_category
+    assert body["data"] == with_aqi_category(read_from_csv(hours=1))
+    assert body["total_records"] == 5 and body["cities"] == ["Fortaleza", "Recife", "São Paulo"]
+    assert client.get("/cities/recife/history?hours=1").json()["total_records"] == 2
+    assert main.query_offloader.completed == completed + 2
+
+    monkeypatch.setattr(main.query_offloader, "max_pending", 0)
+    busy = client.get("/history/all?hours=1")
+    assert busy.status_code == 503 and busy.headers["Retry-After"] == "1"
+
+
+def test_query_offloader_stops_sending_chunks_after_disconnect():
+    """Testa se a desconexão do cliente interrompe a consulta entre lotes e libera a vaga"""
+    import time
+    from offload import QueryCancelled, QueryOffloader, QueryRejected
+    calls = []
+
+    def slow_chunk(path, fieldnames, offsets):
+        calls.append(list(offsets))
+        time.sleep(0.2)
+        return offsets
+
+    async def scenario():
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        offloader = QueryOffloader(lambda: None, max_pending=1, inline_rows=0, chunk_rows=2)
+        query = asyncio.ensure_future(offloader.run_chunked(receive, slow_chunk, "x.csv", [], list(range(10))))
+        await asyncio.sleep(0.05)
+        with pytest.raises(QueryRejected):
+            await offloader.run_chunked(None, slow_chunk, "x.csv", [], [1, 2, 3])
+        disconnected.set()
+        with pytest.raises(QueryCancelled):
+            await query
+        await asyncio.sleep(0.3)  # o lote em execução termina e libera a vaga
+        return offloader
+
+    offloader = asyncio.run(scenario())
+    assert calls == [[0, 1]]
+    assert offloader.stats()["pending"] == 0 and offloader.cancelled == 1 and offloader.rejected == 1
+
+
+def test_query_offloader_keeps_slot_until_running_task_finishes():
+    """Testa se a vaga só é liberada quando a tarefa já em execução termina no pool"""
+    import threading
+    from offload import QueryCancelled, QueryOffloader, QueryRejected
+    release = threading.Event()
+
+    def blocking(value):
+        release.wait(5)
+        return value
+
+    async def scenario():
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        offloader = QueryOffloader(lambda: None, max_pending=1, inline_rows=0)
+        query = asyncio.ensure_future(offloader.run(receive, blocking, 1))
+        await asyncio.sleep(0.05)
+        disconnected.set()
+        with pytest.raises(QueryCancelled):
+            await query
+        # A tarefa continua rodando: a vaga segue ocupada
+        assert offloader.stats()["pending"] == 1
+        with pytest.raises(QueryRejected):
+            await offloader.run(None, blocking, 2)
+        release.set()
+        for _ in range(100):
+            if offloader.stats()["pending"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert offloader.stats()["pending"] == 0
+        assert await offloader.run(None, blocking, 3) == 3
+
+    asyncio.run(scenario())
+
+
+def test_query_offloader_discards_result_of_abandoned_task(tmp_path):
+    """Testa se o resultado de uma tarefa abandonada é descartado quando ela termina"""
+    import threading
+    from offload import QueryCancelled, QueryOffloader
+    release = threading.Event()
+    discarded = []
+
+    def write_file(path):
+        release.wait(5)
+        path.write_text("dados")
+        return path
+
+    async def scenario():
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        offloader = QueryOffloader(lambda: None, max_pending=1, inline_rows=0)
+        query = asyncio.ensure_future(offloader.run(receive, write_file, tmp_path / "saida", discard=discarded.append))
+        await asyncio.sleep(0.05)
+        disconnected.set()
+        with pytest.raises(QueryCancelled):
+            await query
+        assert discarded == []
+        release.set()
+        for _ in range(100):
+            if offloader.stats()["pending"] == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert discarded == [tmp_path / "saida"]
+
+
+# --- Testes da Série Combinada (IQAir + OpenWeatherMap) ---
+
+def test_old_csv_header_is_upgraded_with_source_column(tmp_path):
+    """Testa se o histórico sem a coluna source é migrado (linhas antigas = iqair) uma única vez"""
+    from history_index import upgrade_csv_header
+    path = tmp_path / "antigo.csv"
+    path.write_bytes(b"timestamp,city,state,country,pm25,temperature,humidity,aqi\r\n"
+                     b"2025-11-04T12:00:00.000Z,Recife,PE,Brazil,40,28,70,40\r\n"
+                     b"2025-11-04T13:00:00.000Z,Recife,PE,Brazil,42,29,68,42\r\n")
+
+    assert upgrade_csv_header(path, CSV_HEADERS, {"source": "iqair"}) is True
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["source"] for row in rows] == ["iqair", "iqair"] and rows[1]["aqi"] == "42"
+    assert upgrade_csv_header(path, CSV_HEADERS, {"source": "iqair"}) is False
+
+    # Na subida, a linha parcial é cortada e a migração roda com o lock de escrita do WAL
+    import main
+    old = tmp_path / "antigo_parcial.csv"
+    old.write_bytes(b"timestamp,city,state,country,pm25,temperature,humidity,aqi\r\n"
+                    b"2025-11-04T12:00:00.000Z,Recife,PE,Brazil,40,28,70,40\r\n"
+                    b"2025-11-04T13:00:00.000Z,Rec")
+    main.ensure_csv_schema(old)
+    assert old.read_bytes().splitlines()[1:] == [b"2025-11-04T12:00:00.000Z,Recife,PE,Brazil,40,28,70,40,iqair,,,,,,,,"]
+
+
+def test_timeline_fuses_sources_on_hourly_grid(temp_csv_file, monkeypatch):
+    """Testa a gravação das duas fontes no mesmo histórico e a série horária combinada"""
+    import main
+    from timeline import openweather_rows
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    city = {"city": "Recife", "state": "PE", "country": "Brazil"}
+
+    save_to_csv({**city, "timestamp": (hour - timedelta(hours=1)).isoformat(), "pm25": "50",
+                 "temperature": "28", "humidity": "70", "aqi": "50"})
+    points = [{"timestamp": (hour - timedelta(hours=h)).isoformat(), "pm25": 12.0, "pm10": 20.0, "o3": 55.5,
+               "aqi_us": 60, "aqi_us_category": "Moderada", "iqar": 22, "iqar_category": "Boa"} for h in (2, 1)]
+    assert main.save_source_rows(openweather_rows(city, points)) == 2
+    assert main.save_source_rows(openweather_rows(city, points)) == 0  # horas já gravadas
+
+    body = client.get("/cities/recife/timeline?hours=3").json()
+    assert body["sources"] == {"iqair": 1, "openweather": 2} and body["total_hours"] == 3
+    assert (body["state"], body["country"]) == ("PE", "Brazil")
+    first, second, current = body["data"]
+    assert (first["aqi"], first["aqi_source"], first["pm25"], first["temperature"]) == (60, "openweather", 12.0, None)
+    assert (second["aqi"], second["aqi_source"], second["pm25"], second["temperature"]) == (50, "iqair", 12.0, 28)
+    assert (second["pm10"], second["o3"], second["co"]) == (20.0, 55.5, None)
+    assert second["openweather"] == {"aqi": 60, "iqar": 22, "pm25": 12.0, "pm10": 20.0, "co": None, "no2": None,
+                                     "o3": 55.5, "so2": None, "readings": 1}
+    assert current["aqi"] is None and current["iqair"] is None
+
+    # Os demais endpoints continuam só com as leituras da IQAir
+    assert client.get("/cities/recife/history?hours=3").json()["total_records"] == 1
+    assert client.get("/latest/recife").json()["aqi"] == "50"
+
+
+def test_collector_syncs_openweather_hours_once_per_hour(temp_csv_file, monkeypatch):
+    """Testa se a coleta grava as horas do OpenWeatherMap e não chama a API de novo na mesma hora"""
+    import main
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    monkeypatch.setattr("main._openweather_next_sync", {})
+    transport = ReplayTransport(synthetic=True)
+    calls = []
+    original = transport.handle_async_request
+
+    async def counting(request):
+        calls.append(request.url.path)
+        return await original(request)
+
+    transport.handle_async_request = counting
+    city = {"city": "Cidade Sintética", "state": "UF", "country": "Brazil"}
+
+    async def sync_twice():
+        async with httpx.AsyncClient(transport=transport) as http:
+            return await main.sync_openweather_history(http, city), await main.sync_openweather_history(http, city)
+
+    first, second = asyncio.run(sync_twice())
+    assert first >= 23 and second == 0
+    assert sum(path.endswith("air_pollution/history") for path in calls) == 1
+    with open(temp_csv_file, encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert {row["source"] for row in rows} == {"openweather"}
+    assert all(row["timestamp"].endswith(":00:00+00:00") for row in rows)
+
+
+# --- Testes da Exportação Colunar ---
+
+def test_export_filters_by_city_time_and_source(temp_csv_file, monkeypatch, tmp_path):
+    """Testa a exportação em Parquet e Arrow com filtro de cidade, intervalo, fonte e colunas"""
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    import main
+    from timeline import openweather_rows
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    for h, city in [(3, "Recife"), (2, "Recife"), (1, "Recife"), (2, "Natal")]:
+        save_to_csv({"timestamp": (hour - timedelta(hours=h)).isoformat(), "city": city, "state": "",
+                     "country": "Brazil", "pm25": "40", "temperature": "28", "humidity": "70", "aqi": str(40 + h)})
+    main.save_source_rows(openweather_rows({"city": "Recife"}, [{"timestamp": (hour - timedelta(hours=2)).isoformat(),
+                                                                 "pm25": 12.0, "aqi_us": 60}]))
+
+    start, end = (hour - timedelta(hours=2)).isoformat(), (hour - timedelta(hours=1)).isoformat()
+    response = client.get("/export", params={"cities": "recife", "start": start, "end": end})
+    assert response.status_code == 200 and response.headers["x-export-rows"] == "2"
+    path = tmp_path / "export.parquet"
+    path.write_bytes(response.content)
+    table = pq.read_table(path)
+    assert table.column_names == ["timestamp", "city", "state", "country", "source", "aqi", "aqi_category", "pm25",
+                                  "temperature", "humidity", "pm10", "co", "no2", "o3", "so2", "iqar", "iqar_category"]
+    assert sorted(table.column("source").to_pylist()) == ["iqair", "openweather"]
+    assert sorted(table.column("aqi").to_pylist()) == [42.0, 60.0]
+
+    response = client.get("/export", params={"format": "arrow", "source": "iqair", "columns": "city,aqi"})
+    path = tmp_path / "export.arrow"
+    path.write_bytes(response.content)
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    assert table.column_names == ["city", "aqi"]
+    assert table.column("city").to_pylist() == ["Natal", "Recife", "Recife", "Recife"]  # ordenado por cidade e tempo
+
+    assert client.get("/export", params={"columns": "aqi,senha"}).status_code == 422
+    assert client.get("/export", params={"cities": "Cidade Inexistente"}).status_code == 404
+    monkeypatch.setattr("main.pyarrow_available", lambda: False)
+    assert client.get("/export").status_code == 501
+
+
+# --- Testes da Gravação com WAL ---
+
+def test_ingest_recovery_replays_wal_and_truncates_partial_line(tmp_path):
+    """Testa a recuperação após queda: linha parcial cortada, registro íntegro reaplicado, corrompido descartado"""
+    from ingest_log import IngestLog, encode_record, encode_rows
+    path = tmp_path / "historico.csv"
+    row = {"timestamp": "2025-11-04T12:00:00+00:00", "city": "Recife", "state": "PE", "country": "Brazil",
+           "pm25": "40", "temperature": "28", "humidity": "70", "aqi": "40", "source": "iqair"}
+    log = IngestLog(path, fsync=False)
+    assert log.append_rows([row], CSV_HEADERS) == 1
+    committed = path.read_bytes()
+
+    # Queda no meio da escrita no CSV: o registro já estava no WAL
+    data = encode_rows([{**row, "aqi": "41"}], CSV_HEADERS)
+    log.wal_path.write_bytes(encode_record(len(committed), data))
+    path.write_bytes(committed + data[:10])
+    restarted = IngestLog(path, fsync=False)
+    restarted.recover()
+    assert path.read_bytes() == committed + data
+    assert (restarted.recovered_records, restarted.truncated_bytes) == (1, 10)
+    assert log.wal_path.read_bytes() == b""
+
+    # Registro já aplicado é descartado; registro com CRC errado não entra no CSV
+    record = encode_record(len(committed), data)
+    bad = encode_record(len(committed + data), data).replace(b"41", b"99")
+    log.wal_path.write_bytes(record + bad)
+    restarted = IngestLog(path, fsync=False)
+    restarted.recover()
+    assert path.read_bytes() == committed + data
+    assert (restarted.discarded_records, restarted.corrupt_records, restarted.recovered_records) == (1, 1, 0)
+
+
+def test_ingest_recovery_completes_torn_batch_without_duplicates(tmp_path):
+    """Testa a recuperação de um lote interrompido no meio: só as linhas que faltam são gravadas"""
+    from ingest_log import IngestLog, encode_record, encode_rows
+    path = tmp_path / "historico.csv"
+    rows = [{"timestamp": f"2025-11-04T{h:02d}:00:00+00:00", "city": "Recife", "state": "PE", "country": "Brazil",
+             "pm25": "40", "temperature": "28", "humidity": "70", "aqi": str(h), "source": "iqair"} for h in range(6)]
+    IngestLog(path, fsync=False).append_rows(rows[:2], CSV_HEADERS)
+    committed = path.read_bytes()
+
+    # Duas linhas completas e parte da terceira chegaram ao CSV antes da queda
+    data = encode_rows(rows[2:], CSV_HEADERS)
+    landed = len(b"".join(data.splitlines(keepends=True)[:2]))
+    IngestLog(path).wal_path.write_bytes(encode_record(len(committed), data))
+    path.write_bytes(committed + data[:landed + 5])
+    restarted = IngestLog(path, fsync=False)
+    restarted.recover()
+
+    with open(path, newline="", encoding="utf-8") as f:
+        aqis = [row["aqi"] for row in csv.DictReader(f)]
+    assert aqis == ["0", "1", "2", "3", "4", "5"]
+    assert (restarted.recovered_records, restarted.truncated_bytes) == (1, 5)
+
+
+def test_storage_status_reports_ingest_and_skipped_rows(temp_csv_file, monkeypatch):
+    """Testa se /storage/status expõe as gravações pelo WAL e as linhas inválidas ignoradas"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    save_to_csv({"timestamp": "2025-11-04T12:00:00.000Z", "city": "Recife", "state": "PE", "country": "Brazil",
+                 "pm25": "40", "temperature": "28", "humidity": "70", "aqi": "40"})
+    with open(temp_csv_file, "a", encoding="utf-8") as f:
+        f.write("data-invalida,Recife,PE,Brazil,1,1,1,1,iqair\n")
+
+    body = client.get("/storage/status").json()
+    assert (body["rows"], body["skipped_rows"]) == (1, 1)
+    assert body["ingest"]["rows_written"] >= 1 and body["ingest"]["corrupt_records"] == 0
+    assert "pending" in body["queries"]
+
+
+# --- Testes do Push de Leituras (SSE) ---
+
+def test_stream_replays_since_and_pushes_new_readings(temp_csv_file, monkeypatch):
+    """Testa replay a partir de `since` e entrega das leituras novas da cidade assinada"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+
+    def reading(city, aqi, when):
+        return {"timestamp": when.isoformat(), "city": city, "state": "", "country": "Brazil",
+                "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi}
+
+    save_to_csv(reading("São Paulo", "40", now - timedelta(hours=3)))
+    save_to_csv(reading("São Paulo", "41", now - timedelta(hours=1)))
+    save_to_csv(reading("Fortaleza", "20", now - timedelta(hours=1)))
+
+    async def scenario():
+        broker = ReadingBroker(lambda: temp_csv_file, poll_interval=60)
+        broker.start()
+        stream = stream_readings(broker, AsyncMock(return_value=False), cities=["Sao Paulo"],
+                                 since_epoch=(now - timedelta(hours=2)).timestamp(), heartbeat=1)
+        replayed = await stream.__anext__()
+
+        save_to_csv(reading("Fortaleza", "21", now))
+        save_to_csv(reading("São Paulo", "42", now))
+        assert broker.poll() == 2
+        pushed = await stream.__anext__()
+
+        await stream.aclose()
+        await broker.stop()
+        return replayed, pushed
+
+    replayed, pushed = asyncio.run(scenario())
+    assert replayed.startswith("id: ") and '"aqi": "41"' in replayed
+    assert "event: reading" in pushed and '"aqi": "42"' in pushed
+
+
+def test_stream_resumes_from_event_id_and_resets_when_file_is_rewritten(temp_csv_file, monkeypatch):
+    """Testa retomada pelo Last-Event-ID e evento `reset` quando o CSV foi reescrito"""
+    monkeypatch.setattr("main.CSV_FILE", temp_csv_file)
+    now = datetime.now(timezone.utc)
+    for aqi in ("40", "41", "42"):
+        save_to_csv({"timestamp": now.isoformat(), "city": "São Paulo", "state": "", "country": "Brazil",
+                     "pm25": aqi, "temperature": "", "humidity": "", "aqi": aqi})
+
+    async def first_event(last_event_id):
+        broker = ReadingBroker(lambda: temp_csv_file, poll_interval=60)
+        broker.start()
+        stream = stream_readings(broker, AsyncMock(return_value=False), cities=None,
+                                 last_event_id=last_event_id, heartbeat=0.1)
+        try:
+            return await stream.__anext__()
+        finally:
+            await stream.aclose()
+            await broker.stop()
+
+    offsets = get_history_index(temp_csv_file).offsets_for("São Paulo")
+    file_id = get_history_index(temp_csv_file).file_id
+    resumed = asyncio.run(first_event(event_id(file_id, offsets[0])))
+    assert resumed.startswith(f"id: {event_id(file_id, offsets[1])}\n") and '"aqi": "41"' in resumed
+
+    # Arquivo reescrito (novo inode): o id antigo não aponta mais para a mesma linha
+    rewritten = f"{temp_csv_file}.tmp"
+    shutil.copyfile(temp_csv_file, rewritten)
+    os.replace(rewritten, temp_csv_file)
+    assert get_history_index(temp_csv_file).file_id != file_id
+    assert asyncio.run(first_event(event_id(file_id, offsets[0]))).startswith("event: reset")
+    assert asyncio.run(first_event("123")).startswith("event: reset")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,187 @@
+"""
+Consultas pesadas (leitura de muitas linhas do CSV, agregações) fora do event loop.
+
+O handler resolve no índice em memória quais linhas precisa (rápido) e delega a
+leitura/serialização ou a agregação ao pool de processos, para que uma janela
+grande não trave as outras requisições:
+- consultas pequenas (até `inline_rows` linhas) rodam direto, sem o custo do pool
+- as grandes são divididas em lotes de `chunk_rows` linhas, enviados um de cada
+  vez: uma consulta enorme não ocupa todos os workers e pode ser interrompida
+  entre lotes
+- no máximo `max_pending` consultas ficam no pool ao mesmo tempo (executando ou
+  na fila); acima disso a nova é recusada (503) em vez de aumentar a fila
+- se o cliente desconecta, o lote em andamento é descartado e os próximos não
+  são enviados. Um lote que já começou a rodar não pode ser interrompido, então
+  a consulta só libera a vaga quando ele termina no pool
+
+Os lotes de histórico voltam já serializados em JSON (bytes), então o processo
+principal só concatena a resposta.
+"""
+
+import asyncio
+import json
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from history_index import read_csv_rows_at
+
+Receive = Callable[[], Awaitable[dict]]
+
+
+class QueryRejected(Exception):
+  """Pool cheio: a consulta não foi aceita"""
+
+
+class QueryCancelled(Exception):
+  """O cliente desconectou antes de a consulta terminar"""
+
+
+def render_rows_json(path: str, fieldnames: List[str], offsets: Sequence[int]) -> Tuple[bytes, List[str]]:
+  """
+  Executado no pool: lê as linhas (com a categoria do AQI) e devolve os itens
+  da lista JSON (sem os colchetes) e as cidades encontradas no lote.
+  """
+  from aqi import with_aqi_category  # numpy só é carregado quando necessário
+  rows = with_aqi_category([row for _, row in read_csv_rows_at(Path(path), fieldnames, offsets)])
+  body = json.dumps(rows, ensure_ascii=False, separators=(",", ":"))[1:-1]
+  return body.encode("utf-8"), sorted({row.get("city") for row in rows})
+
+
+def json_with_rows(meta: dict, fragments: List[bytes]) -> bytes:
+  """Resposta JSON com `data` (última chave) montada a partir dos lotes já serializados"""
+  head = json.dumps({**meta, "data": []}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  return head[:-3] + b"[" + b",".join(f for f in fragments if f) + b"]}"
+
+
+async def _wait_disconnect(receive: Receive) -> None:
+  while True:
+    message = await receive()
+    if message["type"] == "http.disconnect":
+      return
+
+
+def _discard_result(task: Future, discard: Callable[[Any], None]) -> None:
+  if not task.cancelled() and task.exception() is None:
+    discard(task.result())
+
+
+class QueryOffloader:
+  """Envia consultas ao pool com limite de concorrência e cancelamento por desconexão"""
+
+  def __init__(self, get_executor: Callable[[], Optional[Executor]], max_pending: int = 8,
+               inline_rows: int = 2000, chunk_rows: int = 50000):
+    self.get_executor = get_executor
+    self.max_pending = max_pending
+    self.inline_rows = inline_rows
+    self.chunk_rows = chunk_rows
+    self._threads: Optional[ThreadPoolExecutor] = None  # quando get_executor() devolve None
+    # Alterados só no event loop: não precisam de lock
+    self.pending = 0
+    self.completed = 0
+    self.rejected = 0
+    self.cancelled = 0
+
+  def _admit(self) -> None:
+    if self.pending >= self.max_pending:
+      self.rejected += 1
+      raise QueryRejected(f"{self.pending} consultas pesadas em andamento (limite {self.max_pending})")
+    self.pending += 1
+
+  def _start(self, fn: Callable, *args) -> Future:
+    executor = self.get_executor()
+    if executor is None:
+      if self._threads is None:
+        self._threads = ThreadPoolExecutor(thread_name_prefix="consulta")
+      executor = self._threads
+    return executor.submit(fn, *args)
+
+  def _release(self, task: Optional[Future]) -> None:
+    """Libera a vaga da consulta quando a última tarefa dela sai do pool"""
+    if task is None or task.done():
+      self.pending -= 1
+      return
+    loop = asyncio.get_running_loop()
+
+    def settled(_):
+      try:
+        loop.call_soon_threadsafe(self._decrement)
+      except RuntimeError:  # loop já encerrado (desligamento do servidor)
+        pass
+
+    task.add_done_callback(settled)
+
+  def _decrement(self) -> None:
+    self.pending -= 1
+
+  async def _wait(self, watcher: Optional[asyncio.Future], task: Future):
+    future = asyncio.wrap_future(task)
+    if watcher is None:
+      return await future
+    done, _ = await asyncio.wait({future, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    if future not in done:
+      task.cancel()  # ainda na fila: sai do pool; já executando: o resultado é descartado
+      raise QueryCancelled()
+    return future.result()
+
+  async def run(self, receive: Optional[Receive], fn: Callable, *args, rows: Optional[int] = None,
+                discard: Optional[Callable[[Any], None]] = None):
+    """
+    Executa `fn(*args)` no pool (uma única tarefa); direto se `rows` for pequeno.
+    Se a consulta for abandonada com a tarefa já rodando, `discard` recebe o
+    resultado quando ela terminar (ex: apagar o arquivo que ela gerou).
+    """
+    if rows is not None and rows <= self.inline_rows:
+      return fn(*args)
+    self._admit()
+    watcher = asyncio.ensure_future(_wait_disconnect(receive)) if receive is not None else None
+    task, delivered = None, False
+    try:
+      task = self._start(fn, *args)
+      result = await self._wait(watcher, task)
+      self.completed += 1
+      delivered = True
+      return result
+    except QueryCancelled:
+      self.cancelled += 1
+      raise
+    finally:
+      if discard is not None and task is not None and not delivered:
+        task.add_done_callback(lambda t: _discard_result(t, discard))
+      self._release(task)
+      if watcher is not None:
+        watcher.cancel()
+
+  async def run_chunked(self, receive: Optional[Receive], fn: Callable, path: str,
+                        fieldnames: List[str], offsets: Sequence[int], *args) -> list:
+    """Executa `fn(path, fieldnames, lote, *args)` para cada lote de offsets, em ordem"""
+    if len(offsets) <= self.inline_rows:
+      return [fn(path, fieldnames, offsets, *args)]
+
+    self._admit()
+    watcher = asyncio.ensure_future(_wait_disconnect(receive)) if receive is not None else None
+    task = None
+    try:
+      results = []
+      for start in range(0, len(offsets), self.chunk_rows):
+        chunk = offsets[start:start + self.chunk_rows]
+        task = self._start(fn, path, fieldnames, chunk, *args)
+        results.append(await self._wait(watcher, task))
+      self.completed += 1
+      return results
+    except QueryCancelled:
+      self.cancelled += 1
+      raise
+    finally:
+      self._release(task)  # só o último lote enviado pode ainda estar no pool
+      if watcher is not None:
+        watcher.cancel()
+
+  def stats(self) -> dict:
+    return {
+      "pending": self.pending,
+      "max_pending": self.max_pending,
+      "completed": self.completed,
+      "rejected": self.rejected,
+      "cancelled": self.cancelled,
+    }
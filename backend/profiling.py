@@ -0,0 +1,266 @@
+"""
+Perfilamento por requisição (opcional) para investigar endpoints lentos.
+
+Uma requisição é rastreada quando chega com o header `X-Profile` (`1` para
+etapas, `cpu` para etapas + perfil de CPU) ou quando cai na amostragem
+(`sample_rate`). Nas demais o custo é só a leitura de uma ContextVar.
+
+Durante o rastreamento, `span("nome")` e `@traced("nome")` registram a duração
+de cada etapa (geocoding, chamada à API externa, leitura do CSV...). O middleware
+completa o trace com as etapas que acontecem fora do handler:
+- validation: do início da requisição até o handler (parâmetros, dependências)
+- endpoint: o handler em si (as etapas internas ficam aninhadas nele)
+- serialize: do fim do handler até o início da resposta (validação/JSON)
+- send: envio do corpo
+
+Traces lentos (>= `slow_ms`) ou pedidos pelo header ficam nos últimos
+`max_traces` de um TraceStore. Uma fração das requisições amostradas
+(`cpu_sample_rate`) roda com cProfile; o perfil só é guardado se a requisição
+acabar sendo lenta. Só um perfil de CPU roda por vez (o cProfile é global ao
+interpretador) e, como o event loop é compartilhado, ele também inclui o que
+outras requisições executaram no mesmo intervalo.
+"""
+
+import cProfile
+import functools
+import inspect
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from fastapi.routing import APIRoute
+
+PROFILE_HEADER = b"x-profile"
+CPU_PROFILE_LINES = 30
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+_current_depth: ContextVar[int] = ContextVar("current_span_depth", default=0)
+_trace_ids = itertools.count(1)
+
+
+class Trace:
+  """Etapas medidas de uma requisição (tempos em ms relativos ao início)"""
+
+  def __init__(self, method: str, path: str, query: str, reason: str):
+    self.id = f"{int(time.time()):x}-{next(_trace_ids)}"
+    self.method = method
+    self.path = path
+    self.query = query
+    self.reason = reason
+    self.started_at = datetime.now(timezone.utc).isoformat()
+    self.start = time.perf_counter()
+    self.spans: List[dict] = []
+    self.status: Optional[int] = None
+    self.total_ms: Optional[float] = None
+    self.cpu_profile: Optional[str] = None
+
+  def elapsed_ms(self, now: Optional[float] = None) -> float:
+    return ((now if now is not None else time.perf_counter()) - self.start) * 1000
+
+  def add_span(self, name: str, start: float, end: float, depth: int = 0, **attrs) -> dict:
+    entry = {"name": name, "start_ms": round(self.elapsed_ms(start), 3),
+             "duration_ms": round((end - start) * 1000, 3), "depth": depth}
+    if attrs:
+      entry["attrs"] = attrs
+    self.spans.append(entry)  # list.append é atômico: etapas em threads do pool também entram
+    return entry
+
+  def server_timing(self) -> str:
+    """Header Server-Timing (etapas de primeiro nível, visível no DevTools do navegador)"""
+    spans = sorted((s for s in self.spans if s["depth"] <= 1), key=lambda s: s["start_ms"])
+    parts = [f'{s["name"]};dur={s["duration_ms"]:.1f}' for s in spans]
+    return ", ".join(parts)
+
+  def to_dict(self, include_profile: bool = False) -> dict:
+    result = {
+      "id": self.id,
+      "method": self.method,
+      "path": self.path,
+      "query": self.query,
+      "reason": self.reason,
+      "started_at": self.started_at,
+      "status": self.status,
+      "total_ms": self.total_ms,
+      "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+      "has_cpu_profile": self.cpu_profile is not None,
+    }
+    if include_profile:
+      result["cpu_profile"] = self.cpu_profile
+    return result
+
+
+class span:
+  """Mede uma etapa da requisição rastreada atual (não faz nada fora de um trace)"""
+
+  __slots__ = ("name", "attrs", "trace", "begin", "token")
+
+  def __init__(self, name: str, **attrs):
+    self.name = name
+    self.attrs = attrs
+    self.trace = None
+
+  def __enter__(self):
+    self.trace = _current_trace.get()
+    if self.trace is not None:
+      self.token = _current_depth.set(_current_depth.get() + 1)
+      self.begin = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if self.trace is not None:
+      end = time.perf_counter()
+      _current_depth.reset(self.token)
+      attrs = dict(self.attrs, error=exc_type.__name__) if exc_type else self.attrs
+      self.trace.add_span(self.name, self.begin, end, _current_depth.get(), **attrs)
+    return False
+
+
+def traced(name: str) -> Callable:
+  """Decorador: mede cada chamada da função (síncrona ou async) como uma etapa"""
+  def decorator(func):
+    if inspect.iscoroutinefunction(func):
+      @functools.wraps(func)
+      async def async_wrapper(*args, **kwargs):
+        with span(name):
+          return await func(*args, **kwargs)
+      return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+class TracedRoute(APIRoute):
+  """Rota que mede o handler como a etapa `endpoint` (a assinatura é preservada)"""
+
+  def __init__(self, path: str, endpoint: Callable, **kwargs):
+    super().__init__(path, traced("endpoint")(endpoint), **kwargs)
+
+
+class TraceStore:
+  """Últimos traces lentos (ou pedidos explicitamente), mais recentes primeiro"""
+
+  def __init__(self, max_traces: int = 100):
+    self._traces: deque = deque(maxlen=max_traces)
+    self._lock = threading.Lock()
+    self.recorded = 0
+
+  def add(self, trace: Trace) -> None:
+    with self._lock:
+      self._traces.appendleft(trace)
+      self.recorded += 1
+
+  def list(self, limit: int = 20, min_ms: Optional[float] = None, path: Optional[str] = None) -> List[Trace]:
+    with self._lock:
+      traces = list(self._traces)
+    if min_ms is not None:
+      traces = [t for t in traces if (t.total_ms or 0) >= min_ms]
+    if path:
+      traces = [t for t in traces if t.path.startswith(path)]
+    return traces[:limit]
+
+  def get(self, trace_id: str) -> Optional[Trace]:
+    with self._lock:
+      return next((t for t in self._traces if t.id == trace_id), None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._traces.clear()
+
+
+class ProfilingMiddleware:
+  """Middleware ASGI que abre o trace, mede as etapas externas ao handler e guarda os lentos"""
+
+  def __init__(self, app, store: TraceStore, sample_rate: float = 0.0, cpu_sample_rate: float = 0.0,
+               slow_ms: float = 500.0, exclude_paths: tuple = ()):
+    self.app = app
+    self.store = store
+    self.sample_rate = sample_rate
+    self.cpu_sample_rate = cpu_sample_rate
+    self.slow_ms = slow_ms
+    self.exclude_paths = exclude_paths
+    self._cpu_lock = threading.Lock()
+
+  def _requested_mode(self, scope) -> Optional[str]:
+    for name, value in scope.get("headers", ()):
+      if name == PROFILE_HEADER:
+        value = value.decode("latin-1").strip().lower()
+        return value if value in ("1", "cpu") else None
+    return None
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+      return await self.app(scope, receive, send)
+
+    mode = self._requested_mode(scope)
+    if mode is None and not (self.sample_rate and random.random() < self.sample_rate):
+      return await self.app(scope, receive, send)
+
+    trace = Trace(scope["method"], scope["path"], scope.get("query_string", b"").decode("latin-1"),
+                  "header" if mode else "sample")
+    want_cpu = mode == "cpu" or (mode is None and self.cpu_sample_rate and random.random() < self.cpu_sample_rate)
+    profiler = cProfile.Profile() if want_cpu and self._cpu_lock.acquire(blocking=False) else None
+    response_start: List[float] = []
+
+    async def send_wrapper(message):
+      if message["type"] == "http.response.start":
+        response_start.append(time.perf_counter())
+        trace.status = message["status"]
+        self._add_request_spans(trace, response_start[0])
+        headers = [*message.get("headers", []), (b"x-trace-id", trace.id.encode("latin-1"))]
+        timing = trace.server_timing()
+        if timing:
+          headers.append((b"server-timing", timing.encode("latin-1")))
+        message = dict(message, headers=headers)
+      await send(message)
+
+    token = _current_trace.set(trace)
+    if profiler is not None:
+      profiler.enable()
+    try:
+      await self.app(scope, receive, send_wrapper)
+    finally:
+      if profiler is not None:
+        profiler.disable()
+        self._cpu_lock.release()
+      _current_trace.reset(token)
+      end = time.perf_counter()
+      if response_start:
+        trace.add_span("send", response_start[0], end)
+      else:
+        trace.status = trace.status or 500
+      trace.total_ms = round(trace.elapsed_ms(end), 3)
+      slow = trace.total_ms >= self.slow_ms
+      if profiler is not None and (slow or mode == "cpu"):
+        trace.cpu_profile = format_profile(profiler)
+      if slow or mode is not None:
+        self.store.add(trace)
+
+  @staticmethod
+  def _add_request_spans(trace: Trace, response_start: float) -> None:
+    """validation/serialize a partir da etapa `endpoint` (se a rota foi medida)"""
+    endpoint = next((s for s in trace.spans if s["name"] == "endpoint"), None)
+    if endpoint is None:
+      return
+    begin = trace.start + endpoint["start_ms"] / 1000
+    end = begin + endpoint["duration_ms"] / 1000
+    trace.add_span("validation", trace.start, begin)
+    trace.add_span("serialize", end, max(end, response_start))
+
+
+def format_profile(profiler: cProfile.Profile, lines: int = CPU_PROFILE_LINES) -> str:
+  """Funções com maior tempo acumulado (texto do pstats)"""
+  output = io.StringIO()
+  stats = pstats.Stats(profiler, stream=output)
+  stats.sort_stats("cumulative").print_stats(lines)
+  return output.getvalue()
@@ -0,0 +1,337 @@
+"""
+Geração de relatórios no servidor.
+
+Resume o histórico de várias cidades numa única passada (médias diárias, horas
+acima do limite, piores períodos e ranking entre cidades) e gera o artefato em
+JSON, CSV ou PDF. A geração roda num pool de processos, fora do event loop, e o
+resultado fica em cache até chegar leitura nova no histórico.
+"""
+
+import csv
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from history_index import location_key, parse_timestamp, read_csv_rows_at
+
+REPORT_FORMATS = {
+  "json": "application/json",
+  "csv": "text/csv; charset=utf-8",
+  "pdf": "application/pdf",
+}
+
+# AQI US acima de 100 = insalubre para grupos sensíveis
+DEFAULT_EXCEEDANCE_AQI = 100.0
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    return float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+
+
+class _CityAccumulator:
+  """Acumula as estatísticas de uma cidade em uma passada"""
+
+  def __init__(self, row: dict):
+    self.city = row.get("city")
+    self.state = row.get("state")
+    self.country = row.get("country")
+    self.records = 0
+    self.aqi_sum = 0.0
+    self.aqi_count = 0
+    self.aqi_max: Optional[float] = None
+    self.aqi_min: Optional[float] = None
+    self.temp_sum, self.temp_count = 0.0, 0
+    self.hum_sum, self.hum_count = 0.0, 0
+    self.hourly: Dict[str, List[float]] = {}  # "YYYY-MM-DDTHH" -> [soma, n]
+
+  def add(self, row: dict, epoch: float) -> None:
+    self.records += 1
+    aqi = _to_float(row.get("aqi"))
+    if aqi is not None:
+      self.aqi_sum += aqi
+      self.aqi_count += 1
+      self.aqi_max = aqi if self.aqi_max is None else max(self.aqi_max, aqi)
+      self.aqi_min = aqi if self.aqi_min is None else min(self.aqi_min, aqi)
+      hour = datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%dT%H")
+      bucket = self.hourly.setdefault(hour, [0.0, 0])
+      bucket[0] += aqi
+      bucket[1] += 1
+    temperature = _to_float(row.get("temperature"))
+    if temperature is not None:
+      self.temp_sum += temperature
+      self.temp_count += 1
+    humidity = _to_float(row.get("humidity"))
+    if humidity is not None:
+      self.hum_sum += humidity
+      self.hum_count += 1
+
+  def summary(self, threshold: float, worst: int) -> dict:
+    hourly_means = {hour: total / n for hour, (total, n) in self.hourly.items()}
+
+    daily: Dict[str, List[float]] = {}
+    for hour, mean in hourly_means.items():
+      day = daily.setdefault(hour[:10], [0.0, 0, mean])
+      day[0] += mean
+      day[1] += 1
+      day[2] = max(day[2], mean)
+
+    worst_hours = sorted(hourly_means.items(), key=lambda item: item[1], reverse=True)[:worst]
+    return {
+      "city": self.city,
+      "state": self.state,
+      "country": self.country,
+      "records": self.records,
+      "mean_aqi": round(self.aqi_sum / self.aqi_count, 1) if self.aqi_count else None,
+      "max_aqi": self.aqi_max,
+      "min_aqi": self.aqi_min,
+      "mean_temperature": round(self.temp_sum / self.temp_count, 1) if self.temp_count else None,
+      "mean_humidity": round(self.hum_sum / self.hum_count, 1) if self.hum_count else None,
+      "exceedance_hours": sum(1 for mean in hourly_means.values() if mean > threshold),
+      "daily": [
+        {"date": day, "mean_aqi": round(total / n, 1), "max_aqi": round(peak, 1), "hours": n}
+        for day, (total, n, peak) in sorted(daily.items())
+      ],
+      "worst_periods": [{"hour": f"{hour}:00Z", "mean_aqi": round(mean, 1)} for hour, mean in worst_hours],
+    }
+
+
+def summarize_rows(rows: Iterable[dict], threshold: float = DEFAULT_EXCEEDANCE_AQI, worst: int = 3) -> dict:
+  """
+  Resume as linhas (streaming, uma passada) e monta o ranking entre cidades.
+  Cidades homônimas em estados/países diferentes são resumidas separadamente.
+  """
+  cities: Dict[tuple, _CityAccumulator] = {}
+  for row in rows:
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      continue
+    key = location_key(row.get("city"), row.get("state"), row.get("country"))
+    accumulator = cities.get(key)
+    if accumulator is None:
+      accumulator = cities[key] = _CityAccumulator(row)
+    accumulator.add(row, epoch)
+
+  summaries = [acc.summary(threshold, worst) for acc in cities.values()]
+  ranked = sorted(summaries, key=lambda s: (s["mean_aqi"] is None, -(s["mean_aqi"] or 0)))
+  for position, summary in enumerate(ranked, start=1):
+    summary["rank"] = position
+  return {
+    "exceedance_threshold_aqi": threshold,
+    "ranking": [s["city"] for s in ranked],
+    "cities": ranked,
+  }
+
+
+def compare_cities(rows: Iterable[dict], metric: str = "aqi", stable_per_hour: float = 1.0) -> List[dict]:
+  """
+  Uma passada agrupada por cidade: leitura mais recente + média, máximo e
+  tendência (inclinação por mínimos quadrados, em unidades/hora) da janela.
+  """
+  groups: Dict[tuple, dict] = {}
+  for row in rows:
+    try:
+      epoch = parse_timestamp(row["timestamp"])
+    except (KeyError, ValueError, AttributeError):
+      continue
+    key = location_key(row.get("city"), row.get("state"), row.get("country"))
+    group = groups.get(key)
+    if group is None:
+      group = groups[key] = {"latest": row, "latest_epoch": epoch, "n": 0, "sum": 0.0, "max": None,
+                             "t0": epoch, "sx": 0.0, "sy": 0.0, "sxx": 0.0, "sxy": 0.0}
+    if epoch >= group["latest_epoch"]:
+      group["latest"], group["latest_epoch"] = row, epoch
+
+    value = _to_float(row.get(metric))
+    if value is None:
+      continue
+    x = (epoch - group["t0"]) / 3600
+    group["n"] += 1
+    group["sum"] += value
+    group["max"] = value if group["max"] is None else max(group["max"], value)
+    group["sx"] += x
+    group["sy"] += value
+    group["sxx"] += x * x
+    group["sxy"] += x * value
+
+  comparison = []
+  for group in groups.values():
+    n = group["n"]
+    slope = None
+    denominator = n * group["sxx"] - group["sx"] ** 2
+    if n >= 2 and denominator > 0:
+      slope = (n * group["sxy"] - group["sx"] * group["sy"]) / denominator
+    if slope is None or abs(slope) < stable_per_hour:
+      trend = "stable"
+    else:
+      trend = "up" if slope > 0 else "down"
+    latest = group["latest"]
+    comparison.append({
+      "city": latest.get("city"),
+      "state": latest.get("state"),
+      "country": latest.get("country"),
+      "latest": latest,
+      "records": n,
+      "mean": round(group["sum"] / n, 1) if n else None,
+      "max": group["max"],
+      "trend_per_hour": round(slope, 2) if slope is not None else None,
+      "trend": trend,
+    })
+
+  comparison.sort(key=lambda c: (c["mean"] is None, -(c["mean"] or 0)))
+  return comparison
+
+
+# --- Renderização ---
+
+def render_json(report: dict) -> bytes:
+  return json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def render_csv(report: dict) -> bytes:
+  output = io.StringIO()
+  writer = csv.writer(output)
+  writer.writerow(["rank", "city", "state", "country", "records", "mean_aqi", "max_aqi", "min_aqi",
+                   "exceedance_hours", "mean_temperature", "mean_humidity", "worst_hour", "worst_hour_aqi"])
+  for s in report["cities"]:
+    worst = s["worst_periods"][0] if s["worst_periods"] else {"hour": "", "mean_aqi": ""}
+    writer.writerow([s["rank"], s["city"], s["state"], s["country"], s["records"], s["mean_aqi"], s["max_aqi"],
+                     s["min_aqi"], s["exceedance_hours"], s["mean_temperature"], s["mean_humidity"],
+                     worst["hour"], worst["mean_aqi"]])
+  return output.getvalue().encode("utf-8")
+
+
+def _report_lines(report: dict) -> List[str]:
+  lines = [
+    "Relatorio de Qualidade do Ar",
+    f"Gerado em {report['generated_at']} - ultimas {report['hours']}h",
+    f"Horas acima do limite: media horaria de AQI > {report['exceedance_threshold_aqi']:g}",
+    "",
+  ]
+  for s in report["cities"]:
+    lines.append(f"{s['rank']}. {s['city']} ({s['state']}) - {s['records']} leituras")
+    lines.append(f"   AQI medio {s['mean_aqi']}  max {s['max_aqi']}  min {s['min_aqi']}  "
+                 f"horas acima do limite {s['exceedance_hours']}")
+    for day in s["daily"]:
+      lines.append(f"   {day['date']}: media {day['mean_aqi']}  max {day['max_aqi']}")
+    if s["worst_periods"]:
+      worst = ", ".join(f"{p['hour']} ({p['mean_aqi']})" for p in s["worst_periods"])
+      lines.append(f"   Piores horarios: {worst}")
+    lines.append("")
+  return lines
+
+
+def render_pdf(report: dict, lines_per_page: int = 60) -> bytes:
+  """PDF simples (texto, Helvetica), sem dependências externas"""
+  lines = _report_lines(report)
+  pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+  def escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+  objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+             "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+  page_ids = []
+  for page in pages:
+    text = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({escape(line)}) '" for line in page) + " ET"
+    stream = text.encode("cp1252", errors="replace")
+    objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream.decode('cp1252')}\nendstream")
+    content_id = len(objects)
+    objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                   f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+    page_ids.append(len(objects))
+  objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{i} 0 R' for i in page_ids)}] /Count {len(page_ids)} >>"
+
+  out = io.BytesIO()
+  out.write(b"%PDF-1.4\n")
+  offsets = []
+  for number, body in enumerate(objects, start=1):
+    offsets.append(out.tell())
+    out.write(f"{number} 0 obj\n{body}\nendobj\n".encode("cp1252", errors="replace"))
+  xref = out.tell()
+  out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+  for offset in offsets:
+    out.write(f"{offset:010d} 00000 n \n".encode())
+  out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+  return out.getvalue()
+
+
+RENDERERS = {"json": render_json, "csv": render_csv, "pdf": render_pdf}
+
+
+def build_report(path: str, fieldnames: List[str], offsets: List[int], hours: int, fmt: str,
+                 threshold: float = DEFAULT_EXCEEDANCE_AQI) -> bytes:
+  """Lê as linhas (pelos offsets do índice), resume e renderiza. Roda no pool de processos."""
+  rows = (row for _, row in read_csv_rows_at(Path(path), fieldnames, offsets))
+  report = summarize_rows(rows, threshold)
+  report["generated_at"] = datetime.now(timezone.utc).isoformat()
+  report["hours"] = hours
+  return RENDERERS[fmt](report)
+
+
+def compare_from_csv(path: str, fieldnames: List[str], offsets: List[int], metric: str = "aqi") -> List[dict]:
+  """Comparação entre cidades lendo as linhas pelos offsets. Roda no pool de processos."""
+  return compare_cities((row for _, row in read_csv_rows_at(Path(path), fieldnames, offsets)), metric)
+
+
+# --- Pool e cache ---
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_report_pool() -> Optional[ProcessPoolExecutor]:
+  """Pool de processos (REPORT_WORKERS, padrão 2). REPORT_WORKERS=0 usa threads."""
+  global _pool
+  workers = int(os.getenv("REPORT_WORKERS", "2"))
+  if workers <= 0:
+    return None
+  with _pool_lock:
+    if _pool is None:
+      _pool = ProcessPoolExecutor(max_workers=workers)
+  return _pool
+
+
+def shutdown_report_pool() -> None:
+  global _pool
+  with _pool_lock:
+    if _pool is not None:
+      _pool.shutdown(wait=False, cancel_futures=True)
+      _pool = None
+
+
+class ReportCache:
+  """Cache LRU de artefatos, invalidado quando o histórico muda (versão do índice)"""
+
+  def __init__(self, max_entries: int = 32):
+    self.max_entries = max_entries
+    self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: tuple, version: tuple) -> Optional[bytes]:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] != version:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key: tuple, version: tuple, artifact: bytes) -> None:
+    with self._lock:
+      self._entries[key] = (version, artifact)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
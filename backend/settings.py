@@ -0,0 +1,67 @@
+"""
+Configuração do backend. O .env é carregado uma vez (no import de `main`, para
+as opções de ajuste lidas com os.getenv); as chaves das APIs só são
+resolvidas e verificadas quando usadas.
+
+Importar `main` não exige mais as chaves das APIs: sem elas (ou com
+READ_ONLY=1) o servidor sobe em modo somente leitura, servindo o histórico já
+coletado; os endpoints que consultam IQAir/OpenWeatherMap respondem 503 e o
+coletor não é iniciado.
+"""
+
+import os
+from functools import cached_property
+from typing import Optional
+
+_dotenv_loaded = False
+
+
+def load_env_once() -> None:
+  """Carrega o .env uma única vez (chamadas seguintes não fazem nada)"""
+  global _dotenv_loaded
+  if not _dotenv_loaded:
+    from dotenv import load_dotenv
+    load_dotenv()
+    _dotenv_loaded = True
+
+
+class Settings:
+  """Valores resolvidos sob demanda; `overrides` substitui o ambiente (testes, benchmarks)"""
+
+  def __init__(self, **overrides):
+    self._overrides = overrides
+
+  def _get(self, name: str, default: Optional[str] = None):
+    key = name.lower()
+    if key in self._overrides:
+      return self._overrides[key]
+    load_env_once()
+    return os.getenv(name, default)
+
+  @cached_property
+  def iqair_api_key(self) -> Optional[str]:
+    return self._get("IQAIR_API_KEY") or None
+
+  @cached_property
+  def openweather_api_key(self) -> Optional[str]:
+    return self._get("OPENWEATHER_API_KEY") or None
+
+  @cached_property
+  def read_only(self) -> bool:
+    """READ_ONLY=1, ou automaticamente quando falta alguma chave"""
+    explicit = self._get("READ_ONLY", "0")
+    if explicit in (True, "1", "true", "yes"):
+      return True
+    return not (self.iqair_api_key and self.openweather_api_key)
+
+  @property
+  def iqair_params(self) -> dict:
+    return {"key": self.iqair_api_key}
+
+  def upstream_unavailable_reason(self) -> Optional[str]:
+    """Motivo para não consultar as APIs externas (None se estiver tudo configurado)"""
+    if not self.read_only:
+      return None
+    if self._get("READ_ONLY", "0") in (True, "1", "true", "yes"):
+      return "Servidor em modo somente leitura (READ_ONLY=1)"
+    return "IQAIR_API_KEY e/ou OPENWEATHER_API_KEY não configuradas (modo somente leitura)"
@@ -0,0 +1,129 @@
+"""
+Índice espacial das cidades monitoradas.
+
+Grade regular em graus (células de `cell_deg`): cada célula guarda os pontos que
+caem nela. A busca dos k mais próximos percorre anéis de células a partir da
+célula do ponto consultado e para quando nenhuma célula ainda não visitada pode
+conter um ponto mais próximo que o k-ésimo encontrado. A caixa (bbox) visita só
+as células que a intersectam. Distâncias pela fórmula de haversine, em km.
+"""
+
+import heapq
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+  phi1, phi2 = math.radians(lat1), math.radians(lat2)
+  dphi = phi2 - phi1
+  dlmb = math.radians(lon2 - lon1)
+  a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+  """Grade lat/lon -> pontos; cada ponto é (lat, lon, item)"""
+
+  def __init__(self, points: Iterable[Tuple[float, float, dict]] = (), cell_deg: float = 0.5):
+    self.cell_deg = cell_deg
+    self.lon_cells = int(math.ceil(360 / cell_deg))
+    self.lat_cells = int(math.ceil(180 / cell_deg))
+    self.cells: Dict[Tuple[int, int], List[Tuple[float, float, dict]]] = {}
+    self.size = 0
+    for lat, lon, item in points:
+      self.add(lat, lon, item)
+
+  def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+    iy = min(int((lat + 90) // self.cell_deg), self.lat_cells - 1)
+    ix = int(((lon + 180) % 360) // self.cell_deg) % self.lon_cells
+    return iy, ix
+
+  def add(self, lat: float, lon: float, item: dict) -> None:
+    self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+    self.size += 1
+
+  def __len__(self) -> int:
+    return self.size
+
+  def _ring(self, iy: int, ix: int, r: int) -> Iterable[Tuple[int, int]]:
+    """Células na borda do quadrado de raio r (em células) em volta de (iy, ix)"""
+    if r == 0:
+      yield iy, ix
+      return
+    width = min(2 * r + 1, self.lon_cells)
+    seen = set()
+    for dy in range(-r, r + 1):
+      y = iy + dy
+      if y < 0 or y >= self.lat_cells:
+        continue
+      if abs(dy) == r:
+        columns = range(-r, -r + width)
+      else:
+        columns = (-r, r)
+      for dx in columns:
+        cell = (y, (ix + dx) % self.lon_cells)
+        if cell not in seen:
+          seen.add(cell)
+          yield cell
+
+  def _min_unvisited_km(self, lat: float, r: int) -> float:
+    """Limite inferior da distância até qualquer célula fora dos anéis 0..r"""
+    reach = r * self.cell_deg
+    # Longitude encolhe com cos(lat): usa a latitude mais extrema alcançável
+    extreme = min(90.0, abs(lat) + reach + self.cell_deg)
+    half = math.radians(min(reach, 180.0)) / 2
+    return 2 * EARTH_RADIUS_KM * max(math.cos(math.radians(extreme)), 0.0) * math.sin(half)
+
+  def nearest(self, lat: float, lon: float, k: int = 5, max_km: Optional[float] = None) -> List[Tuple[float, dict]]:
+    """Os k pontos mais próximos como (distância_km, item), do mais perto ao mais longe"""
+    if k <= 0 or not self.size:
+      return []
+    iy, ix = self._cell(lat, lon)
+    best: List[Tuple[float, int, dict]] = []  # heap de máximo (distância negativa)
+    max_r = max(self.lat_cells, self.lon_cells // 2 + 1)
+    counter = 0
+    for r in range(max_r + 1):
+      for cell in self._ring(iy, ix, r):
+        for plat, plon, item in self.cells.get(cell, ()):
+          d = haversine_km(lat, lon, plat, plon)
+          if max_km is not None and d > max_km:
+            continue
+          counter += 1
+          if len(best) < k:
+            heapq.heappush(best, (-d, counter, item))
+          elif d < -best[0][0]:
+            heapq.heapreplace(best, (-d, counter, item))
+      bound = self._min_unvisited_km(lat, r)
+      if max_km is not None and bound > max_km:
+        break
+      if len(best) == k and bound >= -best[0][0]:
+        break
+    return [(-d, item) for d, _, item in sorted(best, key=lambda b: -b[0])]
+
+  def within_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                  limit: Optional[int] = None) -> List[dict]:
+    """Pontos dentro da caixa; min_lon > max_lon indica caixa que cruza o antimeridiano"""
+    y0, x0 = self._cell(min_lat, min_lon)
+    y1, x1 = self._cell(max_lat, max_lon)
+    crosses = min_lon > max_lon
+    if not crosses and max_lon - min_lon >= 360 - self.cell_deg:
+      x0, x1 = 0, self.lon_cells - 1  # volta inteira (ex: o mundo todo)
+    elif not crosses and max_lon >= 180:
+      x1 = self.lon_cells - 1  # 180 cairia na coluna 0 ao dar a volta
+    x_count = (x1 - x0) % self.lon_cells + 1
+
+    found = []
+    for y in range(y0, y1 + 1):
+      for step in range(x_count):
+        for plat, plon, item in self.cells.get((y, (x0 + step) % self.lon_cells), ()):
+          if not min_lat <= plat <= max_lat:
+            continue
+          inside_lon = (plon >= min_lon or plon <= max_lon) if crosses else min_lon <= plon <= max_lon
+          if inside_lon:
+            found.append(item)
+            if limit is not None and len(found) >= limit:
+              return found
+    return found
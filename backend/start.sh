@@ -12,11 +12,10 @@ echo "📥 Instalando dependências..."
 pip install -q -r requirements.txt
 
 if [ ! -f ".env" ]; then
-    echo "⚠️  Arquivo .env não encontrado!"
-    echo "Crie um arquivo .env com:"
+    echo "⚠️  Arquivo .env não encontrado! Subindo em modo somente leitura."
+    echo "Para coletar, crie um arquivo .env com:"
     echo "IQAIR_API_KEY=sua_chave"
     echo "OPENWEATHER_API_KEY=sua_chave"
-    exit 1
 fi
 
 echo "🚀 Iniciando servidor..."
@@ -0,0 +1,142 @@
+"""
+Série horária combinada das fontes gravadas no histórico.
+
+O CSV guarda leituras de duas fontes, identificadas pela coluna `source`:
+- iqair: leitura atual coletada a cada 5 min (AQI US, temperatura, umidade;
+  a coluna pm25 repete o AQI US, como a IQAir informa)
+- openweather: pontos horários do air_pollution/history (concentrações de
+  PM2.5, PM10, CO, NO2, O3 e SO2 em µg/m³ e o AQI US e o IQAr calculados a
+  partir delas)
+
+As categorias (`aqi_category`, `iqar_category`) são gravadas junto com cada
+linha, na ingestão.
+
+`fuse_timeline` alinha as duas numa grade horária (início de cada hora, UTC),
+com a média de cada fonte na hora e os valores combinados:
+- aqi: o da IQAir quando houver, senão o calculado do OpenWeatherMap
+- pm25, pm10, co, no2, o3, so2: concentrações do OpenWeatherMap (a única fonte
+  com µg/m³)
+- temperature/humidity: da IQAir
+"""
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from history_index import PRIMARY_SOURCE, parse_timestamp, read_csv_rows_at, row_source
+
+OPENWEATHER_SOURCE = "openweather"
+TIMELINE_SOURCES = [PRIMARY_SOURCE, OPENWEATHER_SOURCE]
+STEP_SECONDS = 3600
+
+# Poluentes gravados da série do OpenWeatherMap (µg/m³)
+OPENWEATHER_POLLUTANTS = ("pm25", "pm10", "co", "no2", "o3", "so2")
+
+# Campos de cada fonte que entram na série
+SOURCE_FIELDS = {
+  PRIMARY_SOURCE: ("aqi", "temperature", "humidity"),
+  OPENWEATHER_SOURCE: ("aqi", "iqar") + OPENWEATHER_POLLUTANTS,
+}
+
+
+def hour_start(epoch: float) -> int:
+  return int(epoch // STEP_SECONDS * STEP_SECONDS)
+
+
+def _cell(value):
+  return value if value is not None else ""
+
+
+def openweather_rows(city_info: dict, points: Iterable[dict]) -> List[dict]:
+  """Pontos de format_pollution_history no formato do CSV (fonte openweather, hora cheia)"""
+  rows = []
+  for point in points:
+    try:
+      epoch = hour_start(parse_timestamp(point["timestamp"]))
+    except (KeyError, ValueError, AttributeError):
+      continue
+    rows.append({
+      "timestamp": datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat(),
+      "city": city_info["city"],
+      "state": city_info.get("state", ""),
+      "country": city_info.get("country", ""),
+      "temperature": "",
+      "humidity": "",
+      "aqi": _cell(point.get("aqi_us")),
+      "source": OPENWEATHER_SOURCE,
+      **{name: _cell(point.get(name)) for name in OPENWEATHER_POLLUTANTS},
+      "aqi_category": _cell(point.get("aqi_us_category")),
+      "iqar": _cell(point.get("iqar")),
+      "iqar_category": _cell(point.get("iqar_category")),
+    })
+  return rows
+
+
+def _to_float(value) -> Optional[float]:
+  try:
+    return float(value) if value not in (None, "") else None
+  except (TypeError, ValueError):
+    return None
+
+
+def fuse_timeline(rows: Iterable[dict], start_epoch: float, end_epoch: float) -> List[dict]:
+  """Uma entrada por hora de [start_epoch, end_epoch], com as médias de cada fonte"""
+  first, last = hour_start(start_epoch), hour_start(end_epoch)
+  # hora -> fonte -> campo -> [soma, contagem]
+  buckets: Dict[int, Dict[str, Dict[str, list]]] = {}
+  readings: Dict[int, Dict[str, int]] = {}
+  for row in rows:
+    source = row_source(row)
+    fields = SOURCE_FIELDS.get(source)
+    if fields is None:
+      continue
+    try:
+      hour = hour_start(parse_timestamp(row["timestamp"]))
+    except (KeyError, ValueError, AttributeError):
+      continue
+    if not first <= hour <= last:
+      continue
+    sums = buckets.setdefault(hour, {}).setdefault(source, {})
+    for name in fields:
+      value = _to_float(row.get(name))
+      if value is not None:
+        acc = sums.setdefault(name, [0.0, 0])
+        acc[0] += value
+        acc[1] += 1
+    counts = readings.setdefault(hour, {})
+    counts[source] = counts.get(source, 0) + 1
+
+  timeline = []
+  for hour in range(first, last + 1, STEP_SECONDS):
+    per_source = {}
+    for source, fields in SOURCE_FIELDS.items():
+      sums = buckets.get(hour, {}).get(source)
+      if sums is None:
+        per_source[source] = None
+        continue
+      values = {name: (round(sums[name][0] / sums[name][1], 1) if name in sums else None) for name in fields}
+      per_source[source] = {**values, "readings": readings[hour][source]}
+
+    iqair, owm = per_source[PRIMARY_SOURCE], per_source[OPENWEATHER_SOURCE]
+    aqi, aqi_source = None, None
+    if iqair and iqair["aqi"] is not None:
+      aqi, aqi_source = iqair["aqi"], PRIMARY_SOURCE
+    elif owm and owm["aqi"] is not None:
+      aqi, aqi_source = owm["aqi"], OPENWEATHER_SOURCE
+    timeline.append({
+      "timestamp": datetime.fromtimestamp(hour, tz=timezone.utc).isoformat(),
+      "aqi": aqi,
+      "aqi_source": aqi_source,
+      **{name: (owm[name] if owm else None) for name in OPENWEATHER_POLLUTANTS},
+      "temperature": iqair["temperature"] if iqair else None,
+      "humidity": iqair["humidity"] if iqair else None,
+      **per_source,
+    })
+  return timeline
+
+
+def timeline_from_csv(path: str, fieldnames: List[str], offsets: List[int],
+                      start_epoch: float, end_epoch: float) -> List[dict]:
+  """Série combinada lendo as linhas pelos offsets. Roda no pool de processos."""
+  rows = (row for _, row in read_csv_rows_at(Path(path), fieldnames, offsets))
+  return fuse_timeline(rows, start_epoch, end_epoch)
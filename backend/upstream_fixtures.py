@@ -0,0 +1,294 @@
+"""
+Gravação e replay das respostas da IQAir/OpenWeatherMap para testes de carga.
+
+- `record`: proxy que repassa as chamadas para as APIs reais e grava cada
+  resposta em disco (sem as chaves de API).
+- `serve`: servidor de replay que devolve as respostas gravadas com latência
+  configurável e, opcionalmente, gera respostas sintéticas determinísticas para
+  milhares de cidades.
+- `cities`: gera o arquivo de registro com as cidades sintéticas.
+
+Uso típico (offline e reprodutível):
+  python upstream_fixtures.py cities --count 5000 > cidades_sinteticas.json
+  python upstream_fixtures.py serve --dir fixtures --synthetic --latency-ms 50 --port 9000
+
+  IQAIR_API_URL=http://localhost:9000/v2/ \\
+  OPENWEATHER_API_URL=http://localhost:9000/data/2.5/ \\
+  OPENWEATHER_GEO_URL=http://localhost:9000/geo/1.0/ \\
+  CITIES_FILE=cidades_sinteticas.json COLLECT_DELAY_SECONDS=0 python main.py
+
+Em processo, `ReplayTransport` pode ser usado direto no httpx (ver bench_replay.py).
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import sys
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import httpx
+
+from city_registry import normalize_city_key
+
+# Parâmetros que não entram na chave da fixture
+SECRET_PARAMS = {"key", "appid"}
+VOLATILE_PARAMS = {"start", "end"}  # janela do histórico: rebaseada no replay
+
+UPSTREAM_HOSTS = {
+  "/v2/": "http://api.airvisual.com",
+  "/data/": "https://api.openweathermap.org",
+  "/geo/": "https://api.openweathermap.org",
+}
+
+HISTORY_PATH = "/data/2.5/air_pollution/history"
+
+
+def fixture_key(method: str, url: httpx.URL) -> str:
+  """Chave estável da requisição: método + caminho + parâmetros (sem segredos)"""
+  params = sorted(
+    (k, v) for k, v in url.params.multi_items()
+    if k not in SECRET_PARAMS and k not in VOLATILE_PARAMS
+  )
+  canonical = f"{method.upper()} {url.path}?{urlencode(params)}"
+  return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class FixtureStore:
+  """Respostas gravadas em disco, um arquivo JSON por requisição"""
+
+  def __init__(self, directory: Path):
+    self.directory = Path(directory)
+    self._cache: Optional[Dict[str, dict]] = None
+
+  def _load_all(self) -> Dict[str, dict]:
+    if self._cache is None:
+      self._cache = {}
+      if self.directory.exists():
+        for file in self.directory.glob("*.json"):
+          self._cache[file.stem] = json.loads(file.read_text(encoding="utf-8"))
+    return self._cache
+
+  def __len__(self) -> int:
+    return len(self._load_all())
+
+  def save(self, method: str, url: httpx.URL, status_code: int, content_type: str, body: bytes) -> None:
+    self.directory.mkdir(parents=True, exist_ok=True)
+    key = fixture_key(method, url)
+    params = {k: v for k, v in url.params.items() if k not in SECRET_PARAMS}
+    fixture = {
+      "request": {"method": method.upper(), "path": url.path, "params": params},
+      "status_code": status_code,
+      "content_type": content_type,
+      "body": body.decode("utf-8", errors="replace"),
+    }
+    (self.directory / f"{key}.json").write_text(json.dumps(fixture, ensure_ascii=False), encoding="utf-8")
+    self._load_all()[key] = fixture
+
+  def load(self, method: str, url: httpx.URL) -> Optional[dict]:
+    return self._load_all().get(fixture_key(method, url))
+
+
+# --- Respostas sintéticas ---
+
+def synthetic_cities(count: int) -> List[dict]:
+  """Cidades sintéticas com coordenadas dentro do território brasileiro"""
+  cities = []
+  for i in range(count):
+    rng = random.Random(i)
+    cities.append({
+      "city": f"Cidade Sintetica {i:05d}",
+      "state": f"Estado Sintetico {i % 27:02d}",
+      "country": "Brazil",
+      "lat": round(rng.uniform(-33.0, 5.0), 4),
+      "lon": round(rng.uniform(-73.0, -35.0), 4),
+    })
+  return cities
+
+
+class SyntheticUpstream:
+  """Gera respostas determinísticas (mesma cidade -> mesmos valores) no formato das APIs"""
+
+  def _rng(self, *parts) -> random.Random:
+    return random.Random(zlib.crc32("|".join(str(p) for p in parts).encode("utf-8")))
+
+  def respond(self, url: httpx.URL) -> Optional[Tuple[int, object]]:
+    params = url.params
+    path = url.path
+    now = datetime.now(timezone.utc)
+
+    if path.endswith("/v2/countries"):
+      return 200, {"status": "success", "data": [{"country": "Brazil"}]}
+    if path.endswith("/v2/states"):
+      return 200, {"status": "success", "data": [{"state": f"Estado Sintetico {i:02d}"} for i in range(27)]}
+    if path.endswith("/v2/cities"):
+      state = params.get("state", "")
+      cities = [c for c in synthetic_cities(1000) if c["state"] == state]
+      return 200, {"status": "success", "data": [{"city": c["city"]} for c in cities]}
+    if path.endswith("/v2/city"):
+      rng = self._rng(normalize_city_key(params.get("city")), now.strftime("%Y%m%d%H%M"))
+      aqi = rng.randint(5, 180)
+      ts = now.replace(second=0, microsecond=0).isoformat().replace("+00:00", ".000Z")
+      position = self._rng(normalize_city_key(params.get("city")))  # mesma posição do geocoding
+      lat, lon = round(position.uniform(-33.0, 5.0), 4), round(position.uniform(-73.0, -35.0), 4)
+      return 200, {"status": "success", "data": {
+        "city": params.get("city"), "state": params.get("state"), "country": params.get("country"),
+        "location": {"type": "Point", "coordinates": [lon, lat]},
+        "current": {
+          "weather": {"ts": ts, "tp": rng.randint(12, 36), "hu": rng.randint(30, 95), "pr": 1013, "ws": round(rng.uniform(0, 8), 1)},
+          "pollution": {"ts": ts, "aqius": aqi, "mainus": "p2", "aqicn": int(aqi * 0.7), "maincn": "p2"},
+        }
+      }}
+    if path.endswith("/geo/1.0/direct"):
+      name = (params.get("q") or "").split(",")[0]
+      rng = self._rng(normalize_city_key(name))
+      return 200, [{"name": name, "lat": round(rng.uniform(-33.0, 5.0), 4), "lon": round(rng.uniform(-73.0, -35.0), 4), "country": "BR"}]
+    if path.endswith("/air_pollution/history"):
+      start, end = int(params.get("start", 0)), int(params.get("end", 0))
+      base = self._rng(params.get("lat"), params.get("lon")).uniform(5, 60)
+      points = []
+      for dt in range(start - start % 3600 + 3600, end + 1, 3600):
+        rng = self._rng(params.get("lat"), params.get("lon"), dt)
+        pm25 = max(0.5, base + rng.gauss(0, base * 0.2))
+        points.append({"dt": dt, "main": {"aqi": min(5, 1 + int(pm25 // 15))}, "components": {
+          "pm2_5": round(pm25, 2), "pm10": round(pm25 * 1.6, 2), "co": round(200 + pm25 * 8, 2),
+          "no2": round(pm25 * 0.6, 2), "o3": round(rng.uniform(10, 120), 2), "so2": round(rng.uniform(0.5, 15), 2),
+        }})
+      return 200, {"coord": {"lat": params.get("lat"), "lon": params.get("lon")}, "list": points}
+    return None
+
+
+def rebase_history(body: str, url: httpx.URL) -> str:
+  """Desloca os pontos gravados do histórico para a janela [start, end] pedida"""
+  start, end = url.params.get("start"), url.params.get("end")
+  if start is None or end is None:
+    return body
+  data = json.loads(body)
+  points = data.get("list", [])
+  if not points:
+    return body
+  shift = int(end) - max(p["dt"] for p in points)
+  shifted = [{**p, "dt": p["dt"] + shift} for p in points]
+  data["list"] = [p for p in shifted if p["dt"] >= int(start)]
+  return json.dumps(data)
+
+
+def replay_response(store: Optional[FixtureStore], synthetic: Optional[SyntheticUpstream], method: str, url: httpx.URL) -> Tuple[int, str, bytes]:
+  """Resolve a resposta: gravação em disco primeiro, depois sintética, senão 404"""
+  fixture = store.load(method, url) if store else None
+  if fixture:
+    body = fixture["body"]
+    if url.path.endswith(HISTORY_PATH) and fixture["status_code"] == 200:
+      body = rebase_history(body, url)
+    return fixture["status_code"], fixture["content_type"], body.encode("utf-8")
+
+  generated = synthetic.respond(url) if synthetic else None
+  if generated:
+    status, payload = generated
+    return status, "application/json", json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+  return 404, "application/json", json.dumps({"status": "fail", "data": {"message": "fixture not found"}}).encode("utf-8")
+
+
+# --- Transports httpx ---
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+  """Repassa para o transport real e grava cada resposta no FixtureStore"""
+
+  def __init__(self, store: FixtureStore, wrapped: Optional[httpx.AsyncBaseTransport] = None):
+    self.store = store
+    self.wrapped = wrapped or httpx.AsyncHTTPTransport()
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    response = await self.wrapped.handle_async_request(request)
+    body = await response.aread()
+    content_type = response.headers.get("content-type", "application/json")
+    self.store.save(request.method, request.url, response.status_code, content_type, body)
+    return httpx.Response(response.status_code, headers={"content-type": content_type}, content=body, request=request)
+
+  async def aclose(self) -> None:
+    await self.wrapped.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+  """Serve respostas gravadas/sintéticas com latência configurável, sem rede"""
+
+  def __init__(self, store: Optional[FixtureStore] = None, latency: float = 0.0, synthetic: bool = False):
+    self.store = store
+    self.latency = latency
+    self.synthetic = SyntheticUpstream() if synthetic else None
+    self.requests = 0
+
+  async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+    self.requests += 1
+    if self.latency:
+      await asyncio.sleep(self.latency)
+    status, content_type, body = replay_response(self.store, self.synthetic, request.method, request.url)
+    return httpx.Response(status, headers={"content-type": content_type}, content=body, request=request)
+
+
+# --- Servidores (proxy de gravação / replay) ---
+
+def create_fixture_app(mode: str, store: FixtureStore, latency: float = 0.0, synthetic: bool = False):
+  """App FastAPI que grava (mode='record') ou reproduz (mode='serve') as APIs"""
+  from fastapi import FastAPI, Request, Response
+
+  app = FastAPI(title=f"Upstream fixtures ({mode})")
+  transport = RecordingTransport(store) if mode == "record" else ReplayTransport(store, latency, synthetic)
+  client = httpx.AsyncClient(transport=transport, timeout=30.0)
+
+  @app.get("/{path:path}")
+  async def upstream(path: str, request: Request):
+    prefix = next((p for p in UPSTREAM_HOSTS if f"/{path}".startswith(p)), None)
+    host = UPSTREAM_HOSTS[prefix] if prefix else "http://replay.local"
+    url = httpx.URL(f"{host}/{path}", params=list(request.query_params.multi_items()))
+    upstream_response = await client.get(url)
+    return Response(
+      content=upstream_response.content,
+      status_code=upstream_response.status_code,
+      media_type=upstream_response.headers.get("content-type")
+    )
+
+  return app
+
+
+def main_cli(argv: Optional[List[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description="Gravação/replay das APIs IQAir e OpenWeatherMap")
+  sub = parser.add_subparsers(dest="command", required=True)
+
+  record = sub.add_parser("record", help="Proxy que grava as respostas reais")
+  record.add_argument("--dir", type=Path, default=Path("fixtures"))
+  record.add_argument("--port", type=int, default=9001)
+
+  serve = sub.add_parser("serve", help="Servidor de replay")
+  serve.add_argument("--dir", type=Path, default=Path("fixtures"))
+  serve.add_argument("--port", type=int, default=9000)
+  serve.add_argument("--latency-ms", type=float, default=0.0)
+  serve.add_argument("--synthetic", action="store_true", help="Gera respostas para requisições não gravadas")
+
+  cities = sub.add_parser("cities", help="Imprime um registro JSON de cidades sintéticas")
+  cities.add_argument("--count", type=int, default=1000)
+
+  args = parser.parse_args(argv)
+
+  if args.command == "cities":
+    json.dump(synthetic_cities(args.count), sys.stdout, ensure_ascii=False, indent=1)
+    return
+
+  import uvicorn
+  store = FixtureStore(args.dir)
+  if args.command == "record":
+    app = create_fixture_app("record", store)
+  else:
+    print(f"📼 {len(store)} respostas gravadas em {args.dir}")
+    app = create_fixture_app("serve", store, args.latency_ms / 1000, args.synthetic)
+  uvicorn.run(app, host="0.0.0.0", port=args.port)
+
+
+if __name__ == "__main__":
+  main_cli()
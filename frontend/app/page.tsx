@@ -9,7 +9,7 @@ import { CityComparison } from "@/components/city-comparison"
 import { ReportGenerator } from "@/components/report-generator"
 import { Button } from "@/components/ui/button"
 import { RefreshCw, Wind } from "lucide-react"
-import { getCurrentCityData, getCityHistory } from "../lib/api"
+import { getCurrentCityData, getCityTimeline } from "../lib/api"
 
 const CIDADE_PARA_ESTADO: Record<string, string> = {
   "São Paulo": "São Paulo",
@@ -28,20 +28,20 @@ export default function AirQualityDashboard() {
     setLoading(true)
     setError(null)
     try {
-      // Primeiro busca o histórico p/ extrair estado correto
-      const historyResp = await getCityHistory(city, 24)
-      let estado = (historyResp.data && historyResp.data[0]?.state) || CIDADE_PARA_ESTADO[city] || ""
+      // Série horária local (IQAir + OpenWeatherMap): gráficos, relatório e estado da cidade
+      const timeline = await getCityTimeline(city, 24)
+      let estado = timeline.state || CIDADE_PARA_ESTADO[city] || ""
       // Busque os dados atuais apenas se o estado está preenchido
       const current = estado ? await getCurrentCityData(city, estado, "Brazil") : { pm25: undefined, temperature: undefined, humidity: undefined }
       setAirQualityData({
         city,
         current: current, // já está {pm25, temperature, humidity, ...}
-        historical: (historyResp.data || []).map((d:any) => ({
+        timeline: timeline.data || [],
+        historical: (timeline.data || []).filter((d:any) => d.pm25 !== null).map((d:any) => ({
           timestamp: d.timestamp,
           pm25: Number(d.pm25),
-          
-          temperature: Number(d.temperature),
-          state: d.state
+          temperature: d.temperature === null ? NaN : Number(d.temperature),
+          state: timeline.state
         }))
       })
     } catch(err:any) {
@@ -88,9 +88,9 @@ export default function AirQualityDashboard() {
             <>
               <HealthAlert data={airQualityData.current} />
               <AirQualityIndicators data={airQualityData.current} />
-              <TimeSeriesCharts data={airQualityData.historical} city={selectedCity} state={CIDADE_PARA_ESTADO[selectedCity]} country="Brazil" />
+              <TimeSeriesCharts data={airQualityData.timeline} />
               <CityComparison currentCity={selectedCity} />
-              <ReportGenerator city={selectedCity} data={airQualityData} />
+              <ReportGenerator city={selectedCity} />
             </>
           )}
         </div>
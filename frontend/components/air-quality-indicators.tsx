@@ -10,6 +10,7 @@ interface AirQualityIndicatorsProps {
     pm25: number
     temperature: number
     humidity: number
+    category?: string | null // categoria do AQI US calculada no backend
   }
 }
 
@@ -36,19 +37,25 @@ export function AirQualityIndicators({ data: _data }: AirQualityIndicatorsProps)
   if (error) return <div className="text-red-600">{error}</div>
   if (!data) return <div>Nenhum dado disponível</div>
 
-  const getAirQualityLevel = (pm25: number) => {
-    if (pm25 <= 12) return { level: "Bom", color: "success", description: "Qualidade do ar excelente" }
-    if (pm25 <= 35) return { level: "Moderado", color: "warning", description: "Qualidade do ar aceitável" }
-    if (pm25 <= 55)
-      return {
-        level: "Insalubre para grupos sensíveis",
-        color: "warning",
-        description: "Grupos sensíveis devem ter cuidado",
-      }
-    return { level: "Insalubre", color: "danger", description: "Risco à saúde elevado" }
+  // Cor e descrição de cada categoria do AQI US (as faixas são calculadas no backend)
+  const getAirQualityLevel = (category?: string | null) => {
+    switch (category) {
+      case "Boa":
+        return { level: "Boa", color: "success", description: "Qualidade do ar excelente" }
+      case "Moderada":
+        return { level: "Moderada", color: "warning", description: "Qualidade do ar aceitável" }
+      case "Insalubre para grupos sensíveis":
+        return { level: category, color: "warning", description: "Grupos sensíveis devem ter cuidado" }
+      case "Insalubre":
+      case "Muito insalubre":
+      case "Perigosa":
+        return { level: category, color: "danger", description: "Risco à saúde elevado" }
+      default:
+        return { level: "Sem dados", color: "border", description: "Categoria indisponível" }
+    }
   }
 
-  const airQuality = getAirQualityLevel(data.pm25)
+  const airQuality = getAirQualityLevel(data.category)
   const pm25 = Number(data.pm25)
   const temperature = Number(data.temperature)
   const humidity = Number(data.humidity)
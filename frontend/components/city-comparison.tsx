@@ -3,7 +3,7 @@
 import { useEffect, useState } from "react"
 import { Card } from "@/components/ui/card"
 import { BarChart, Bar, XAxis, YAxis, CartesianGrid, Tooltip, ResponsiveContainer, Cell } from "recharts"
-import { getAllHistory } from "../lib/api"
+import { getComparison } from "../lib/api"
 
 interface CityComparisonProps {
   currentCity: string
@@ -18,23 +18,14 @@ export function CityComparison({ currentCity }: CityComparisonProps) {
   useEffect(() => {
     setLoading(true)
     setError(null)
-    getAllHistory(1) // busca dados da última hora para dados "atuais"
+    getComparison(1) // última leitura de cada cidade, agregada no backend
       .then((data) => {
-        // Agrupa por cidade e pega o último registro de cada uma
-        const cityGroups: Record<string, any[]> = {}
-        if (!data.data) return setError('Dados não disponíveis no backend!')
-        data.data.forEach((item: any) => {
-          if (!cityGroups[item.city]) cityGroups[item.city] = []
-          cityGroups[item.city].push(item)
-        })
-        const lastByCity = Object.entries(cityGroups).map(([city, group]) => {
-          const last = group[group.length - 1]
-          return {
-            city,
-            pm25: Number(last.pm25),
-            color: Number(last.pm25) <= 20 ? "hsl(var(--success))" : "hsl(var(--warning))"
-          }
-        })
+        if (!data.cities) return setError('Dados não disponíveis no backend!')
+        const lastByCity = data.cities.map((item: any) => ({
+          city: item.city,
+          pm25: Number(item.latest.pm25),
+          color: Number(item.latest.pm25) <= 20 ? "hsl(var(--success))" : "hsl(var(--warning))"
+        }))
         setComparisonData(lastByCity)
         setLoading(false)
       })
@@ -2,12 +2,13 @@
 
 import { useEffect, useState } from "react"
 import { Alert, AlertDescription, AlertTitle } from "@/components/ui/alert"
-import { AlertTriangle, CheckCircle, AlertCircle } from "lucide-react"
+import { AlertTriangle, AlertCircle } from "lucide-react"
 import { getCurrentCityData } from "../lib/api"
 
 interface HealthAlertProps {
   data: {
     pm25: number
+    category?: string | null // categoria do AQI US calculada no backend
   }
 }
 
@@ -28,58 +29,53 @@ export function HealthAlert({ data: _data }: HealthAlertProps) {
   if (error) return <div className="text-red-600">{error}</div>
   if (!data) return null
 
-  const getAlertInfo = (pm25: number) => {
-    if (pm25 <= 12) {
-      return {
-        show: false,
-        variant: "default" as const,
-        icon: CheckCircle,
-        title: "Qualidade do ar boa",
-        description: "O ar está limpo e saudável para todos.",
-      }
-    }
-    if (pm25 <= 35) {
-      return {
-        show: true,
-        variant: "default" as const,
-        icon: AlertCircle,
-        title: "Qualidade do ar moderada",
-        description:
-          "A qualidade do ar é aceitável. Pessoas extremamente sensíveis devem considerar limitar atividades ao ar livre prolongadas.",
-      }
-    }
-    if (pm25 <= 55) {
-      return {
-        show: true,
-        variant: "default" as const,
-        icon: AlertTriangle,
-        title: "Atenção: Insalubre para grupos sensíveis",
-        description:
-          "Crianças, idosos e pessoas com problemas respiratórios devem evitar atividades prolongadas ao ar livre.",
-      }
-    }
-    return {
-      show: true,
-      variant: "destructive" as const,
-      icon: AlertTriangle,
-      title: "Alerta: Risco à saúde elevado",
-      description:
-        "A qualidade do ar está insalubre. Todos devem evitar atividades ao ar livre e manter janelas fechadas.",
+  // Texto de cada categoria do AQI US (as faixas são calculadas no backend)
+  const getAlertInfo = (category?: string | null) => {
+    switch (category) {
+      case "Boa":
+        return null
+      case "Moderada":
+        return {
+          variant: "default" as const,
+          icon: AlertCircle,
+          className: "",
+          title: "Qualidade do ar moderada",
+          description:
+            "A qualidade do ar é aceitável. Pessoas extremamente sensíveis devem considerar limitar atividades ao ar livre prolongadas.",
+        }
+      case "Insalubre para grupos sensíveis":
+        return {
+          variant: "default" as const,
+          icon: AlertTriangle,
+          className: "border-warning bg-warning/10",
+          title: "Atenção: Insalubre para grupos sensíveis",
+          description:
+            "Crianças, idosos e pessoas com problemas respiratórios devem evitar atividades prolongadas ao ar livre.",
+        }
+      case "Insalubre":
+      case "Muito insalubre":
+      case "Perigosa":
+        return {
+          variant: "destructive" as const,
+          icon: AlertTriangle,
+          className: "border-danger bg-danger/10",
+          title: `Alerta: qualidade do ar ${category.toLowerCase()}`,
+          description:
+            "A qualidade do ar está insalubre. Todos devem evitar atividades ao ar livre e manter janelas fechadas.",
+        }
+      default:
+        return null
     }
   }
 
-  const alert = getAlertInfo(data.pm25)
-  const Icon = alert.icon
-
-  if (!alert.show && data.pm25 <= 12) {
+  const alert = getAlertInfo(data.category)
+  if (!alert) {
     return null
   }
+  const Icon = alert.icon
 
   return (
-    <Alert
-      variant={alert.variant}
-      className={data.pm25 > 55 ? "border-danger bg-danger/10" : data.pm25 > 35 ? "border-warning bg-warning/10" : ""}
-    >
+    <Alert variant={alert.variant} className={alert.className}>
       <Icon className="h-5 w-5" />
       <AlertTitle className="text-lg font-semibold">{alert.title}</AlertTitle>
       <AlertDescription className="text-sm leading-relaxed">{alert.description}</AlertDescription>
@@ -4,113 +4,82 @@ import { useState } from "react"
 import { Card } from "@/components/ui/card"
 import { Button } from "@/components/ui/button"
 import { FileText, Download } from "lucide-react"
-import { getCurrentCityData, getCityHistory } from "../lib/api"
+import { getReport, getReportUrl } from "../lib/api"
 
 interface ReportGeneratorProps {
   city: string
-  data: any
+  hours?: number
 }
 
-export function ReportGenerator({ city, data }: ReportGeneratorProps) {
+// Resumo de uma cidade no relatório gerado pelo backend (/reports)
+interface CitySummary {
+  city: string
+  state?: string
+  records: number
+  mean_aqi: number | null
+  max_aqi: number | null
+  min_aqi: number | null
+  mean_temperature: number | null
+  mean_humidity: number | null
+  exceedance_hours: number
+  daily: { date: string; mean_aqi: number; max_aqi: number }[]
+  worst_periods: { hour: string; mean_aqi: number }[]
+}
+
+export function ReportGenerator({ city, hours = 24 }: ReportGeneratorProps) {
   const [generating, setGenerating] = useState(false)
-  const [report, setReport] = useState<string | null>(null)
+  const [report, setReport] = useState<{ summary: CitySummary; threshold: number; generatedAt: string } | null>(null)
   const [error, setError] = useState<string|null>(null)
 
   const generateReport = async () => {
     setGenerating(true)
     setError(null)
     try {
-      const current = data?.current || {}
-      const historical = data?.historical || []
-
-      const formatNumber = (value: any, digits = 1) => {
-        const num = Number(value)
-        return isFinite(num) ? num.toFixed(digits) : "N/D"
-      }
-
-      const pm25 = current.pm25
-      const temperature = current.temperature
-      const humidity = current.humidity
-
-      const quality =
-        typeof pm25 === "number" && isFinite(pm25)
-          ? pm25 <= 12
-            ? "boa"
-            : pm25 <= 35
-            ? "moderada"
-            : pm25 <= 55
-            ? "insalubre para grupos sensíveis"
-            : "insalubre"
-          : "desconhecida"
-
-      // Média PM2.5 das últimas 24h
-      let pm25Media = "N/D"
-      if (historical.length > 0) {
-        const validPm25 = historical.map((item: any) => Number(item.pm25)).filter((v: number) => isFinite(v))
-        if (validPm25.length > 0) {
-          pm25Media = (validPm25.reduce((acc: number, v: number) => acc + v, 0) / validPm25.length).toFixed(1)
-        }
-      }
-
-      let recomendacao = "Dados insuficientes para recomendação."
-      if (typeof pm25 === "number" && isFinite(pm25)) {
-        if (pm25 > 55) {
-          recomendacao = "⚠️ Evite atividades ao ar livre. Mantenha janelas fechadas."
-        } else if (pm25 > 35) {
-          recomendacao = "⚠️ Grupos sensíveis devem limitar atividades ao ar livre."
-        } else if (pm25 > 12) {
-          recomendacao = "ℹ️ Qualidade do ar aceitável para a maioria das pessoas."
-        } else {
-          recomendacao = "✓ Qualidade do ar excelente. Aproveite atividades ao ar livre."
-        }
+      // Médias, horas acima do limite e piores horários calculados no backend
+      const data = await getReport([city], hours)
+      const summary = data?.cities?.[0]
+      if (!summary) {
+        throw new Error(data?.detail || `Nenhum dado nas últimas ${hours} horas`)
       }
-
-      const reportText = `
-RELATÓRIO DE QUALIDADE DO AR - ${city}
-Data: ${new Date().toLocaleDateString("pt-BR")}
-Hora: ${new Date().toLocaleTimeString("pt-BR")}
-
-RESUMO EXECUTIVO
-Hoje, ${city} apresentou níveis ${quality} de poluição do ar.
-
-INDICADORES PRINCIPAIS
-- PM2.5: ${formatNumber(pm25, 1)} µg/m³
-- Temperatura: ${formatNumber(temperature, 1)}°C
-- Umidade: ${formatNumber(humidity, 0)}%
-
-CLASSIFICAÇÃO
-A qualidade do ar foi classificada como "${quality}".
-
-RECOMENDAÇÕES
-${recomendacao}
-
-ANÁLISE DAS ÚLTIMAS 24 HORAS
-A concentração média de PM2.5 nas últimas 24 horas foi de ${pm25Media} µg/m³.
-
----
-Relatório gerado automaticamente pelo Dashboard de Qualidade do Ar
-      `.trim()
-      setReport(reportText)
+      setReport({ summary, threshold: data.exceedance_threshold_aqi, generatedAt: data.generated_at })
     } catch(err:any) {
+      setReport(null)
       setError('Erro ao gerar relatório: '+(err?.message || err))
     } finally {
       setGenerating(false)
     }
   }
 
-  const downloadReport = () => {
-    if (!report) return
+  const formatNumber = (value: number | null, digits = 1) =>
+    value !== null && isFinite(value) ? value.toFixed(digits) : "N/D"
 
-    const blob = new Blob([report], { type: "text/plain" })
-    const url = URL.createObjectURL(blob)
-    const a = document.createElement("a")
-    a.href = url
-    a.download = `relatorio-qualidade-ar-${city}-${new Date().toISOString().split("T")[0]}.txt`
-    document.body.appendChild(a)
-    a.click()
-    document.body.removeChild(a)
-    URL.revokeObjectURL(url)
-  }
+  const reportText = (() => {
+    if (!report) return null
+    const s = report.summary
+    const daily = s.daily.map((d) => `- ${d.date}: média ${formatNumber(d.mean_aqi)}, máximo ${formatNumber(d.max_aqi)}`)
+    const worst = s.worst_periods.map((p) => `${p.hour} (${formatNumber(p.mean_aqi)})`).join(", ")
+    return `
+RELATÓRIO DE QUALIDADE DO AR - ${s.city}${s.state ? ` (${s.state})` : ""}
+Gerado em: ${new Date(report.generatedAt).toLocaleString("pt-BR")} - últimas ${hours} horas
+
+INDICADORES (AQI US)
+- Média: ${formatNumber(s.mean_aqi)}
+- Máximo: ${formatNumber(s.max_aqi)}
+- Mínimo: ${formatNumber(s.min_aqi)}
+- Horas acima de ${report.threshold}: ${s.exceedance_hours}
+- Temperatura média: ${formatNumber(s.mean_temperature)}°C
+- Umidade média: ${formatNumber(s.mean_humidity, 0)}%
+
+MÉDIAS DIÁRIAS
+${daily.join("\n") || "- N/D"}
+
+PIORES HORÁRIOS
+${worst || "N/D"}
+
+---
+${s.records} leituras. Relatório gerado pelo backend do Dashboard de Qualidade do Ar
+    `.trim()
+  })()
 
   return (
     <Card className="p-6">
@@ -126,10 +95,20 @@ Relatório gerado automaticamente pelo Dashboard de Qualidade do Ar
               {generating ? "Gerando..." : "Gerar Relatório"}
             </Button>
             {report && (
-              <Button onClick={downloadReport} variant="outline">
-                <Download className="h-4 w-4 mr-2" />
-                Baixar
-              </Button>
+              <>
+                <Button asChild variant="outline">
+                  <a href={getReportUrl([city], hours, "pdf")} download>
+                    <Download className="h-4 w-4 mr-2" />
+                    PDF
+                  </a>
+                </Button>
+                <Button asChild variant="outline">
+                  <a href={getReportUrl([city], hours, "csv")} download>
+                    <Download className="h-4 w-4 mr-2" />
+                    CSV
+                  </a>
+                </Button>
+              </>
             )}
           </div>
         </div>
@@ -140,9 +119,9 @@ Relatório gerado automaticamente pelo Dashboard de Qualidade do Ar
           </div>
         )}
 
-        {report && (
+        {reportText && (
           <div className="rounded-lg bg-muted p-4">
-            <pre className="whitespace-pre-wrap text-sm font-mono text-foreground leading-relaxed">{report}</pre>
+            <pre className="whitespace-pre-wrap text-sm font-mono text-foreground leading-relaxed">{reportText}</pre>
           </div>
         )}
       </div>
@@ -1,77 +1,32 @@
 "use client"
 
-import { useEffect, useState } from "react"
 import { Card } from "@/components/ui/card"
 import { LineChart, Line, XAxis, YAxis, CartesianGrid, Tooltip, ResponsiveContainer, Legend } from "recharts"
-import { getCityPollution24h } from "../lib/api" 
 
 interface TimeSeriesChartsProps {
+  // Série de /cities/{city}/timeline (uma entrada por hora, concentrações do OpenWeatherMap)
   data: Array<{
     timestamp: string
-    pm25: number
-    temperature: number
-  }>,
-  city: string
-  state: string
-  country: string
+    pm25: number | null
+    pm10: number | null
+  }>
 }
 
-export function TimeSeriesCharts({ data, city, state, country }: TimeSeriesChartsProps) {
-  let setData
-  [data, setData] = useState<any[]>([])
-  const [loading, setLoading] = useState(true)
-  const [error, setError] = useState<string | null>(null)
-
-useEffect(() => {
-    async function fetchData() {
-      try {
-        setLoading(true)
-        setError(null)
-      
-        const currentCity = city
-        const currentState = state
-        const currentCountry = country
-
-        const response = await getCityPollution24h(currentCity, currentState, currentCountry)
-
-        const responseData = response.data 
-
-        if (!responseData || !Array.isArray(responseData) || responseData.length === 0) {
-          setError("Sem dados disponíveis (TESTE).")
-          setLoading(false)
-          return
-        }
-
-        setData(responseData)
-        
-
-      } catch (err) {
-        console.error("Erro ao buscar dados da cidade:", err)
-        setError(err instanceof Error ? err.message : "Erro desconhecido")
-      } finally {
-        setLoading(false)
-      }
-    }
-
-    fetchData()
-    
-  }, [])
-
+export function TimeSeriesCharts({ data }: TimeSeriesChartsProps) {
   const formatTime = (timestamp: string) => {
     const date = new Date(timestamp)
     return date.getHours().toString().padStart(2, "0") + ":00"
   }
 
-  const chartData = data.map((item) => ({
+  const chartData = data.filter((item) => item.pm25 !== null || item.pm10 !== null).map((item) => ({
     time: formatTime(item.timestamp),
     pm25: item.pm25,
     pm10: item.pm10,
   }))
   
 
-  if (loading)
-    return <Card className="p-6">Carregando dados (Teste São Paulo)...</Card>
-  if (error) return <Card className="p-6 text-red-600">{error}</Card>
+  if (chartData.length === 0)
+    return <Card className="p-6 text-muted-foreground">Sem dados de poluentes nas últimas 24 horas.</Card>
 
   return (
     <div className="grid gap-6 lg:grid-cols-2">
@@ -28,15 +28,17 @@ export async function getCurrentCityData(city: string, state: string, country: s
   return res.json();
 }
 
-// Histórico de uma cidade (por horas)
-export async function getCityHistory(city: string, hours = 24) {
-  const res = await fetch(`${API_BASE_URL}/cities/${encodeURIComponent(city)}/history?hours=${hours}`);
+// Histórico de uma cidade (por horas). `since` retorna só leituras posteriores ao cursor
+export async function getCityHistory(city: string, hours = 24, since?: string) {
+  const cursor = since ? `&since=${encodeURIComponent(since)}` : "";
+  const res = await fetch(`${API_BASE_URL}/cities/${encodeURIComponent(city)}/history?hours=${hours}${cursor}`);
   return res.json();
 }
 
-// Histórico geral (todas as cidades)
-export async function getAllHistory(hours = 48) {
-  const res = await fetch(`${API_BASE_URL}/history/all?hours=${hours}`);
+// Histórico geral (todas as cidades). `since` retorna só leituras posteriores ao cursor
+export async function getAllHistory(hours = 48, since?: string) {
+  const cursor = since ? `&since=${encodeURIComponent(since)}` : "";
+  const res = await fetch(`${API_BASE_URL}/history/all?hours=${hours}${cursor}`);
   return res.json();
 }
 
@@ -63,3 +65,86 @@ export async function getCityPollution24h(city: string, state: string, country:
   // 3. Retorna o OBJETO JSON inteiro (ex: { city: "...", data: [...] })
   return res.json();
 }
+
+// Push de novas leituras (Server-Sent Events). Retorna função para encerrar.
+// O navegador reconecta sozinho enviando Last-Event-ID e recebe só o que perdeu;
+// se o histórico foi reescrito nesse meio tempo, chega um evento "reset" (recarregar).
+export function subscribeReadings(
+  cities: string[],
+  onReading: (reading: any) => void,
+  since?: string,
+  onReset?: () => void
+) {
+  const params = new URLSearchParams()
+  if (cities.length) params.set("cities", cities.join(","))
+  if (since) params.set("since", since)
+  const source = new EventSource(`${API_BASE_URL}/stream?${params.toString()}`)
+  source.addEventListener("reading", (event) => onReading(JSON.parse((event as MessageEvent).data)))
+  if (onReset) source.addEventListener("reset", () => onReset())
+  return () => source.close()
+}
+
+// Alertas ativos avaliados no backend (regras com duração e histerese)
+export async function getAlerts(city?: string) {
+  const query = city ? `?city=${encodeURIComponent(city)}` : "";
+  const res = await fetch(`${API_BASE_URL}/alerts${query}`);
+  return res.json();
+}
+
+// Última leitura de cada cidade (mapa mantido na gravação, sem varrer o histórico)
+export async function getLatest(cities: string[] = []) {
+  const query = cities.length ? `?cities=${encodeURIComponent(cities.join(","))}` : "";
+  const res = await fetch(`${API_BASE_URL}/latest${query}`);
+  return res.json();
+}
+
+// Cidades monitoradas mais próximas de um ponto
+export async function getNearby(lat: number, lon: number, k = 5) {
+  const res = await fetch(`${API_BASE_URL}/nearby?lat=${lat}&lon=${lon}&k=${k}`);
+  return res.json();
+}
+
+// Cidades dentro da área visível do mapa
+export async function getCitiesInBounds(minLat: number, minLon: number, maxLat: number, maxLon: number) {
+  const res = await fetch(`${API_BASE_URL}/bbox?min_lat=${minLat}&min_lon=${minLon}&max_lat=${maxLat}&max_lon=${maxLon}`);
+  return res.json();
+}
+
+// Última leitura + estatísticas da janela por cidade (uma entrada por cidade)
+export async function getComparison(hours = 1, metric = "aqi") {
+  const res = await fetch(`${API_BASE_URL}/comparison?hours=${hours}&metric=${metric}`);
+  return res.json();
+}
+
+// Previsão horária das próximas horas (modelos ajustados no backend)
+export async function getCityForecast(city: string, horizon = 6, metric = "aqi") {
+  const res = await fetch(`${API_BASE_URL}/cities/${encodeURIComponent(city)}/forecast?horizon=${horizon}&metric=${metric}`);
+  return res.json();
+}
+
+// Série horária combinada (IQAir + OpenWeatherMap) gravada no backend
+export async function getCityTimeline(city: string, hours = 24) {
+  const res = await fetch(`${API_BASE_URL}/cities/${encodeURIComponent(city)}/timeline?hours=${hours}`);
+  return res.json();
+}
+
+// Relatório consolidado gerado no backend (json, csv ou pdf)
+export function getReportUrl(cities: string[] = [], hours = 24, format: "json" | "csv" | "pdf" = "pdf") {
+  const params = new URLSearchParams({ hours: String(hours), format })
+  if (cities.length) params.set("cities", cities.join(","))
+  return `${API_BASE_URL}/reports?${params.toString()}`
+}
+
+export async function getReport(cities: string[] = [], hours = 24) {
+  const res = await fetch(getReportUrl(cities, hours, "json"));
+  return res.json();
+}
+
+// Download do histórico em formato colunar (Parquet ou Arrow IPC) para análise
+export function getExportUrl(cities: string[] = [], start?: string, end?: string, format: "parquet" | "arrow" = "parquet") {
+  const params = new URLSearchParams({ format })
+  if (cities.length) params.set("cities", cities.join(","))
+  if (start) params.set("start", start)
+  if (end) params.set("end", end)
+  return `${API_BASE_URL}/export?${params.toString()}`
+}